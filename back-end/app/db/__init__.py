@@ -1,19 +1,85 @@
 # Database setup package
 import os
 from pathlib import Path
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 # Default DB lives alongside this package (configurable via env)
 _DEFAULT_DB_PATH = Path(__file__).resolve().parent / "imageuplift.db"
 DATABASE_URL = os.getenv("DATABASE_URL", f"sqlite:///{_DEFAULT_DB_PATH}")
 
-# SQLite needs this extra arg; Postgres doesn't
-connect_args = {}
-if DATABASE_URL.startswith("sqlite"):
-    connect_args = {"check_same_thread": False}
+# Pool sized for the conversion executor (one session per in-flight conversion) plus headroom
+# for list/thumb/analytics reads; overflow covers bursts on the request threadpool.
+CONVERSION_WORKERS = int(os.getenv("CONVERSION_WORKERS", "4"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(CONVERSION_WORKERS + 4)))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "16"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
 
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
+# SQLite tuning, applied to every new connection. WAL lets readers run alongside the single
+# writer and makes commits an append instead of a journal rewrite; synchronous=NORMAL is
+# durable across application crashes in WAL mode (only an OS crash can lose the last commits).
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "15000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", str(64 * 1024)))
+
+# DB_WRITE_BATCH=1 routes conversion inserts through a single writer thread (app.db.writer)
+DB_WRITE_BATCH = os.getenv("DB_WRITE_BATCH", "0").lower() in {"1", "true", "yes"}
+
+
+def sqlite_pragmas(journal_mode=None, synchronous=None, busy_timeout_ms=None, mmap_size=None, cache_size_kb=None):
+    """PRAGMA statements run on each new SQLite connection (None falls back to the env settings)."""
+    journal_mode = journal_mode or SQLITE_JOURNAL_MODE
+    synchronous = synchronous or SQLITE_SYNCHRONOUS
+    pragmas = [
+        # only takes effect on a new database file; retention then hands free pages back in small steps
+        "PRAGMA auto_vacuum=INCREMENTAL",
+        f"PRAGMA journal_mode={journal_mode}",
+        f"PRAGMA synchronous={synchronous}",
+        f"PRAGMA busy_timeout={busy_timeout_ms if busy_timeout_ms is not None else SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA mmap_size={mmap_size if mmap_size is not None else SQLITE_MMAP_SIZE}",
+        # negative cache_size is in KiB rather than pages
+        f"PRAGMA cache_size=-{cache_size_kb if cache_size_kb is not None else SQLITE_CACHE_SIZE_KB}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+    return pragmas
+
+
+def make_engine(url: str = DATABASE_URL, pragmas=None, **engine_kwargs):
+    """
+    Create an engine with the pool/pragma configuration above. `pragmas` overrides the SQLite
+    PRAGMA list (the contention benchmark uses this to compare journal modes).
+    """
+    is_sqlite = url.startswith("sqlite")
+    in_memory = is_sqlite and (url in {"sqlite://", "sqlite:///:memory:"} or "mode=memory" in url)
+
+    kwargs = {}
+    if is_sqlite:
+        # SQLite needs this extra arg; Postgres doesn't
+        kwargs["connect_args"] = {"check_same_thread": False}
+    if not in_memory:
+        kwargs.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                      pool_pre_ping=not is_sqlite)
+    kwargs.update(engine_kwargs)
+    new_engine = create_engine(url, **kwargs)
+
+    if is_sqlite:
+        statements = sqlite_pragmas() if pragmas is None else pragmas
+
+        @event.listens_for(new_engine, "connect")
+        def _apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+            finally:
+                cursor.close()
+
+    return new_engine
+
+
+engine = make_engine()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
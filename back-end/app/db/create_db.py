@@ -10,8 +10,10 @@ from pathlib import Path
 DB_PATH = Path(__file__).resolve().parent / "imageuplift.db"
 os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
 
-from . import Base, engine, SessionLocal  # noqa: E402
+from . import engine, SessionLocal  # noqa: E402
 from . import models  # noqa: E402
+from .migrate import upgrade  # noqa: E402
+from app.features.analytics.rollup import rebuild_rollups  # noqa: E402
 
 
 def main():
@@ -19,7 +21,7 @@ def main():
         DB_PATH.unlink()
         print(f"Deleted existing DB at {DB_PATH}")
 
-    Base.metadata.create_all(bind=engine)
+    upgrade(engine)
     session = SessionLocal()
 
     try:
@@ -136,6 +138,7 @@ def main():
 
         session.add_all(conversions)
         session.commit()
+        rebuild_rollups(session)
         print("Database created and seeded with dummy data.")
         print(f"Images: {len(images)}, Recommendations: {len(recs)}, Conversions: {len(conversions)}")
         print(f"DB path: {DB_PATH}")
@@ -0,0 +1,226 @@
+"""
+Versioned schema migrations.
+
+`create_all` only creates missing tables, so it can never add an index or column to a database
+that already exists. Schema changes are therefore listed in MIGRATIONS with increasing version
+numbers and recorded in the `schema_version` table once applied. Each migration runs in its own
+transaction holding the database's write lock (BEGIN IMMEDIATE on SQLite, an advisory lock on
+PostgreSQL), so workers booting together apply it once. Migrations must still be idempotent
+(IF NOT EXISTS, "add column if missing"): version 1 creates every table the current models
+define, so later migrations may find their tables and indexes already present.
+
+App startup calls `ensure_schema`, which costs one `SELECT max(version)` when the database is
+current; set DB_AUTO_MIGRATE=0 to make startup fail instead of migrating, and run the
+migrations from a deploy step:
+
+    python -m app.db.migrate            # upgrade to the latest version
+    python -m app.db.migrate --status   # print current / latest version
+"""
+import argparse
+import hashlib
+import os
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Tuple
+
+from loguru import logger
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from . import Base, engine
+from . import models
+
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1").lower() in {"1", "true", "yes"}
+
+# arbitrary key for pg_advisory_xact_lock so concurrent workers migrate one at a time
+_PG_LOCK_KEY = 0x1A6E0F7
+
+
+def _index(model, name: str):
+    return next(i for i in model.__table__.indexes if i.name == name)
+
+
+def _create_indexes(conn: Connection, *indexes):
+    # IF NOT EXISTS rather than checkfirst: SQLite cannot reflect expression indexes
+    for index in indexes:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _baseline(conn: Connection):
+    Base.metadata.create_all(conn)
+
+
+def _performance_indexes(conn: Connection):
+    _create_indexes(
+        conn,
+        _index(models.Conversion, "ix_conversions_created_at"),
+        _index(models.Conversion, "ix_conversions_mode_created_at"),
+        _index(models.Conversion, "ix_conversions_image_id"),
+        _index(models.Recommendation, "ix_recommendations_image_id"),
+        _index(models.Recommendation, "ix_recommendations_ai_image_type"),
+    )
+
+
+def _backfill_rollups(conn: Connection):
+    # databases that predate the rollup tables have history but empty counters
+    from app.features.analytics.rollup import rebuild_rollups
+
+    # rebuild_rollups reads columns that later migrations add; they must exist by now
+    _preview_flags(conn)
+    has_rollups = conn.execute(select(func.count()).select_from(models.ConversionRollup)).scalar()
+    has_history = conn.execute(select(func.count()).select_from(models.Conversion)).scalar()
+    if has_history and not has_rollups:
+        with Session(bind=conn, join_transaction_mode="create_savepoint") as session:
+            rebuild_rollups(session)
+
+
+def _conversion_thumbnails(conn: Connection):
+    table = models.ConversionThumbnail.__table__
+    conn.execute(CreateTable(table, if_not_exists=True))
+    _create_indexes(conn, *table.indexes)
+
+
+def _add_columns(conn: Connection, model, *names: str):
+    """ALTER TABLE ... ADD COLUMN for model columns the table does not have yet."""
+    table = model.__table__
+    existing = {c["name"] for c in inspect(conn).get_columns(table.name)}
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        ddl = f"ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(dialect=conn.dialect)}"
+        if column.server_default is not None:
+            # existing rows take the default, so NOT NULL columns can be added too
+            default = column.server_default.arg.compile(dialect=conn.dialect)
+            ddl += f" DEFAULT {default}" + ("" if column.nullable else " NOT NULL")
+        conn.exec_driver_sql(ddl)
+
+
+def _svg_output_variants(conn: Connection):
+    _add_columns(conn, models.Conversion, "output_gzip_blob", "output_br_blob", "output_stats")
+
+
+def _preview_flags(conn: Connection):
+    for model in (models.Conversion, models.ConversionRollup, models.LatencyBin):
+        _add_columns(conn, model, "preview")
+
+
+def _conversion_jobs(conn: Connection):
+    table = models.ConversionJob.__table__
+    conn.execute(CreateTable(table, if_not_exists=True))
+    _create_indexes(conn, *table.indexes)
+
+
+def _recommendation_cache(conn: Connection):
+    _add_columns(conn, models.Image, "content_hash")
+    _add_columns(conn, models.Recommendation, "metadata_version", "heuristics_version")
+    _create_indexes(conn, _index(models.Image, "ix_images_content_hash"))
+    # existing recommendations came from the first metadata extractor; their settings are
+    # recomputed from that metadata on first use (heuristics_version stays NULL)
+    recommendations = models.Recommendation.__table__
+    conn.execute(
+        recommendations.update()
+        .where(recommendations.c.metadata_version.is_(None), recommendations.c.metadata_json.isnot(None))
+        .values(metadata_version=1)
+    )
+    # only images with a recommendation can be cache hits; one blob in memory at a time
+    images = models.Image.__table__
+    unhashed = conn.execute(
+        select(images.c.id).where(
+            images.c.content_hash.is_(None),
+            images.c.original_blob.isnot(None),
+            images.c.id.in_(select(recommendations.c.image_id)),
+        )
+    ).scalars().all()
+    for image_id in unhashed:
+        blob = conn.execute(select(images.c.original_blob).where(images.c.id == image_id)).scalar()
+        digest = hashlib.sha256(blob).hexdigest()
+        conn.execute(images.update().where(images.c.id == image_id).values(content_hash=digest))
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "baseline schema", _baseline),
+    (2, "conversion/recommendation indexes", _performance_indexes),
+    (3, "backfill analytics rollups", _backfill_rollups),
+    (4, "conversion thumbnail cache", _conversion_thumbnails),
+    (5, "pre-compressed SVG outputs", _svg_output_variants),
+    (6, "preview conversions", _preview_flags),
+    (7, "conversion job queue", _conversion_jobs),
+    (8, "recommendation cache", _recommendation_cache),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(bind: Engine = engine) -> int:
+    """Highest applied version; 0 for a database without a schema_version table."""
+    try:
+        with bind.connect() as conn:
+            return conn.execute(select(func.max(models.SchemaVersion.version))).scalar() or 0
+    except (OperationalError, ProgrammingError):
+        return 0
+
+
+@contextmanager
+def _locked_transaction(bind: Engine) -> Iterator[Connection]:
+    """Transaction that holds the schema lock until commit."""
+    with bind.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            # take the write lock up front (pysqlite would only BEGIN before the first DML)
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        elif conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _PG_LOCK_KEY})
+        yield conn
+
+
+def upgrade(bind: Engine = engine) -> int:
+    """Apply pending migrations, each in its own transaction. Returns the resulting version."""
+    if bind.url.drivername.startswith("sqlite") and bind.url.database:
+        os.makedirs(os.path.dirname(os.path.abspath(bind.url.database)), exist_ok=True)
+    with _locked_transaction(bind) as conn:
+        conn.execute(CreateTable(models.SchemaVersion.__table__, if_not_exists=True))
+
+    version = current_version(bind)
+    for number, description, apply in MIGRATIONS:
+        if number <= version:
+            continue
+        with _locked_transaction(bind) as conn:
+            # another worker may have applied it while we waited for the lock
+            applied = conn.execute(
+                select(models.SchemaVersion.version).where(models.SchemaVersion.version == number)
+            ).first()
+            if not applied:
+                logger.info(f"🛠️  Applying migration {number}: {description}")
+                apply(conn)
+                conn.execute(models.SchemaVersion.__table__.insert().values(version=number, description=description))
+        version = number
+    return version
+
+
+def ensure_schema(bind: Engine = engine):
+    """Startup hook: no-op when current, otherwise migrate (or refuse with DB_AUTO_MIGRATE=0)."""
+    version = current_version(bind)
+    if version >= LATEST_VERSION:
+        return
+    if not DB_AUTO_MIGRATE:
+        raise RuntimeError(
+            f"Database schema is at version {version}, expected {LATEST_VERSION}. Run `python -m app.db.migrate`."
+        )
+    upgrade(bind)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply ImageUpLift database migrations")
+    parser.add_argument("--status", action="store_true", help="Only print the current and latest version")
+    args = parser.parse_args()
+
+    if args.status:
+        print(f"Schema version {current_version()} (latest {LATEST_VERSION})")
+        return
+    version = upgrade()
+    print(f"✅ Database at schema version {version}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 # app/db/models.py
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, LargeBinary, DateTime
+from sqlalchemy import Boolean, Column, Integer, String, Float, ForeignKey, LargeBinary, DateTime, Index, UniqueConstraint, false
 from sqlalchemy.types import JSON
 from sqlalchemy.sql import func
 
@@ -16,12 +16,15 @@ class Image(Base):
     original_filename = Column(String, nullable=False)
     size_bytes = Column(Integer, nullable=True)
     original_blob = Column(LargeBinary, nullable=True)
+    content_hash = Column(String(64), nullable=True)  # sha256 of the upload; finds cached recommendations
     created_at = Column(
         DateTime(timezone=True),
         server_default=func.now(),
         nullable=False,
     )
 
+    __table_args__ = (Index("ix_images_content_hash", "content_hash"),)
+
 
 class Recommendation(Base):
     """
@@ -30,24 +33,32 @@ class Recommendation(Base):
     __tablename__ = "recommendations"
 
     id = Column(Integer, primary_key=True, index=True)
-    image_id = Column(Integer, ForeignKey("images.id"), nullable=True)
+    image_id = Column(Integer, ForeignKey("images.id"), nullable=True, index=True)
     recommended_mode = Column(String, nullable=True)  # vectorize | outline | enhance
     vector_params = Column(JSON, nullable=True)       # dict of vector settings
     outline_params = Column(JSON, nullable=True)      # dict with low/high, etc.
     metadata_json = Column(JSON, nullable=True)       # full metadata payload from analysis
     confidence_score = Column(Float, nullable=True)
+    # recommend_settings.METADATA_VERSION / HEURISTICS_VERSION that produced metadata_json / the settings
+    metadata_version = Column(Integer, nullable=True)
+    heuristics_version = Column(Integer, nullable=True)
     created_at = Column(
         DateTime(timezone=True),
         server_default=func.now(),
         nullable=False,
     )
 
+    # metadata_json ->> 'ai_image_type' (json_extract on SQLite), as built by analytics/queries.json_text
+    __table_args__ = (
+        Index("ix_recommendations_ai_image_type", metadata_json["ai_image_type"].as_string()),
+    )
+
 
 class Conversion(Base):
     __tablename__ = "conversions"
 
     id = Column(Integer, primary_key=True, index=True)
-    image_id = Column(Integer, ForeignKey("images.id"), nullable=True)
+    image_id = Column(Integer, ForeignKey("images.id"), nullable=True, index=True)
     image_name = Column(String, nullable=False)
     image_type = Column(String, nullable=True)        # e.g. "image/png"
     mode = Column(String, nullable=False)             # "vectorize" | "outline" | "enhance"
@@ -58,8 +69,181 @@ class Conversion(Base):
     output_mime = Column(String, nullable=True)
     output_size_bytes = Column(Integer, nullable=True)
     output_thumb_blob = Column(LargeBinary, nullable=True)
+    # pre-compressed SVG outputs, served by Accept-Encoding (see conversion/svg_optimize.py)
+    output_gzip_blob = Column(LargeBinary, nullable=True)
+    output_br_blob = Column(LargeBinary, nullable=True)
+    output_stats = Column(JSON, nullable=True)        # raw/optimized/encoded sizes, path counts
+    # low-resolution tuning run (conversion/preview.py); kept out of the gallery and default analytics
+    preview = Column(Boolean, nullable=False, default=False, server_default=false())
+    created_at = Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False,
+        index=True,
+    )
+
+    # gallery/list pages and per-mode analytics scan by recency
+    __table_args__ = (Index("ix_conversions_mode_created_at", "mode", "created_at"),)
+
+
+class ConversionJob(Base):
+    """
+    A queued conversion for the worker nodes (see conversion/job_store.py): the input is the stored
+    image, the result a regular conversions row. Workers claim a job by leasing it and extend the
+    lease with heartbeats; a job whose lease runs out is picked up again.
+    """
+    __tablename__ = "conversion_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String, nullable=True, index=True)  # client token (progress/cancel), optional
+    image_id = Column(Integer, ForeignKey("images.id"), nullable=False)
+    image_name = Column(String, nullable=False)
+    image_type = Column(String, nullable=True)
+    mode = Column(String, nullable=False)
+    params = Column(JSON, nullable=True)               # chosen_params of the request
+    preview = Column(Boolean, nullable=False, default=False, server_default=false())
+    status = Column(String, nullable=False, default="queued")  # queued | running | done | failed | cancelled
+    cancel_requested = Column(Boolean, nullable=False, default=False, server_default=false())
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    available_at = Column(DateTime(timezone=True), nullable=False)  # not claimed before (retry backoff)
+    worker = Column(String, nullable=True)             # lease holder
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    progress = Column(JSON, nullable=True)             # {"stage": ..., "done": ..., "total": ...}
+    error = Column(String, nullable=True)
+    conversion_id = Column(Integer, ForeignKey("conversions.id"), nullable=True)
+    created_at = Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False,
+    )
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    # claim scans: queued jobs by due time, running jobs by lease expiry
+    __table_args__ = (Index("ix_conversion_jobs_status_available", "status", "available_at"),)
+
+
+class ConversionThumbnail(Base):
+    """
+    Cached raster preview of a conversion output at one size (longest side in px), rendered on
+    first request or right after the conversion (see conversion/thumbnails.py).
+    """
+    __tablename__ = "conversion_thumbnails"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversion_id = Column(Integer, ForeignKey("conversions.id"), nullable=False)
+    size = Column(Integer, nullable=False)
+    mime = Column(String, nullable=False)
+    blob = Column(LargeBinary, nullable=False)
+    created_at = Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False,
+    )
+
+    __table_args__ = (UniqueConstraint("conversion_id", "size", name="uq_conversion_thumbnails_size"),)
+
+
+class ConversionRollup(Base):
+    """
+    Hourly/daily conversion counters per mode, image type and device (see analytics/rollup.py).
+    Rows are summed on read, so a bucket may be split across several rows.
+    """
+    __tablename__ = "conversion_rollups"
+
+    id = Column(Integer, primary_key=True, index=True)
+    granularity = Column(String, nullable=False)      # hour | day
+    bucket = Column(String, nullable=False)           # "YYYY-MM-DD HH" | "YYYY-MM-DD" (UTC)
+    mode = Column(String, nullable=False)
+    image_type = Column(String, nullable=True)
+    device = Column(String, nullable=True)
+    preview = Column(Boolean, nullable=False, default=False, server_default=false())
+    count = Column(Integer, nullable=False, default=0)
+    total_time = Column(Float, nullable=False, default=0.0)
+    output_count = Column(Integer, nullable=False, default=0)  # rows with a known output size
+    total_output_bytes = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_conversion_rollups_bucket", "granularity", "bucket"),)
+
+
+class ImageTypeRollup(Base):
+    """
+    Hourly/daily counters of recommendation content types (metadata_json.ai_image_type).
+    """
+    __tablename__ = "image_type_rollups"
+
+    id = Column(Integer, primary_key=True, index=True)
+    granularity = Column(String, nullable=False)
+    bucket = Column(String, nullable=False)
+    ai_image_type = Column(String, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_image_type_rollups_bucket", "granularity", "bucket"),)
+
+
+class ConversionStage(Base):
+    """
+    Wall-clock seconds spent in one pipeline stage of a conversion (upload, decode, esrgan, trace, ...).
+    """
+    __tablename__ = "conversion_stages"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversion_id = Column(Integer, ForeignKey("conversions.id"), nullable=False, index=True)
+    stage = Column(String, nullable=False)
+    seconds = Column(Float, nullable=False)
+
+
+class LatencyBin(Base):
+    """
+    Daily latency histogram per mode and stage ("total" = Conversion.time_taken), stored as
+    quantile-sketch bins (see analytics/sketch.py) so percentiles merge with SUM() over any window.
+    """
+    __tablename__ = "latency_bins"
+
+    id = Column(Integer, primary_key=True, index=True)
+    bucket = Column(String, nullable=False)           # "YYYY-MM-DD" (UTC)
+    mode = Column(String, nullable=False)
+    stage = Column(String, nullable=False)
+    preview = Column(Boolean, nullable=False, default=False, server_default=false())
+    bin = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_latency_bins_bucket", "bucket", "mode", "stage"),)
+
+
+class ProfileArtifact(Base):
+    """
+    Profiler output captured for a profiled request (CPU profile, torch profiler table/trace).
+    """
+    __tablename__ = "profile_artifacts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversion_id = Column(Integer, ForeignKey("conversions.id"), nullable=True, index=True)
+    image_id = Column(Integer, ForeignKey("images.id"), nullable=True, index=True)
+    endpoint = Column(String, nullable=False)         # convert | recommend
+    reason = Column(String, nullable=True)            # requested | sampled
+    name = Column(String, nullable=False)             # e.g. "esrgan.torch.json"
+    content_type = Column(String, nullable=True)
+    blob = Column(LargeBinary, nullable=False)
     created_at = Column(
         DateTime(timezone=True),
         server_default=func.now(),
         nullable=False,
     )
+
+
+class SchemaVersion(Base):
+    """
+    Applied schema migrations (see app/db/migrate.py); the highest version is the current schema.
+    """
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at = Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        nullable=False,
+    )
@@ -0,0 +1,115 @@
+"""
+Single-writer batching for inserts (enabled with DB_WRITE_BATCH=1).
+
+SQLite allows one writer at a time, so concurrent conversions committing large blobs queue on
+the database lock and each pays its own commit (WAL append + sync). The BatchWriter funnels
+units of work through one thread that commits up to DB_WRITE_BATCH_SIZE of them per
+transaction. A unit of work is a callable taking the writer's Session and returning a plain
+value (ids, not ORM objects); callers get a Future resolved after the commit.
+
+If a batch fails, it is rolled back and its units are replayed one transaction each, so a bad
+unit only fails its own Future. A unit may therefore run more than once: effects outside the
+session (metrics, stage timings) belong after its Future resolves, or must start over each run.
+"""
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+from loguru import logger
+from sqlalchemy.orm import Session
+
+from . import SessionLocal
+
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "32"))
+DB_WRITE_BATCH_WAIT_MS = float(os.getenv("DB_WRITE_BATCH_WAIT_MS", "5"))
+
+UnitOfWork = Callable[[Session], object]
+
+
+class BatchWriter:
+    def __init__(self, session_factory=SessionLocal, max_batch: int = DB_WRITE_BATCH_SIZE,
+                 max_wait_ms: float = DB_WRITE_BATCH_WAIT_MS):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[Optional[Tuple[UnitOfWork, Future]]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, work: UnitOfWork) -> Future:
+        future = Future()
+        self._queue.put((work, future))
+        return future
+
+    def close(self, timeout: Optional[float] = None):
+        """Flush queued work and stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _next_batch(self) -> Tuple[List[Tuple[UnitOfWork, Future]], bool]:
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        stop = False
+        # linger briefly so writers arriving together share one commit
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get(timeout=self.max_wait)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    def _run(self):
+        while True:
+            batch, stop = self._next_batch()
+            if batch:
+                self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch: List[Tuple[UnitOfWork, Future]]):
+        session = self.session_factory()
+        try:
+            results = [work(session) for work, _ in batch]
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            if len(batch) > 1:
+                logger.warning(f"Batched write of {len(batch)} failed ({e}); retrying individually")
+                for item in batch:
+                    self._commit([item])
+            else:
+                batch[0][1].set_exception(e)
+            return
+        finally:
+            session.close()
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+_writer: Optional[BatchWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> BatchWriter:
+    """Process-wide writer, started on first use."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BatchWriter()
+        return _writer
+
+
+def shutdown():
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
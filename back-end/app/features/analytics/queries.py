@@ -0,0 +1,39 @@
+"""
+Dialect-aware SQL expression builders for analytics queries (SQLite and PostgreSQL).
+
+The rollup tables store portable string bucket keys ("YYYY-MM-DD HH" / "YYYY-MM-DD", UTC),
+so the endpoints themselves only need SUM/GROUP BY/substr. Everything that derives those keys
+or reads JSON from the raw tables goes through these helpers instead of SQLite's strftime and
+json_extract, so rebuilds and ad-hoc queries run inside the database on either backend.
+"""
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import ColumnElement
+
+# strftime formats (SQLite) and their to_char equivalents (PostgreSQL), keyed like rollup.GRANULARITIES
+_SQLITE_FORMATS = {"hour": "%Y-%m-%d %H", "day": "%Y-%m-%d"}
+_POSTGRES_FORMATS = {"hour": "YYYY-MM-DD HH24", "day": "YYYY-MM-DD"}
+
+
+def dialect_name(db: Session) -> str:
+    return db.get_bind().dialect.name
+
+
+def bucket_expr(dialect: str, column, granularity: str) -> ColumnElement:
+    """Rollup bucket key of a timestamp column, computed in the database (UTC)."""
+    if dialect == "sqlite":
+        # SQLite stores CURRENT_TIMESTAMP values, which are already UTC
+        return func.strftime(_SQLITE_FORMATS[granularity], column)
+    if dialect == "postgresql":
+        # timestamptz -> UTC wall time, truncated, then formatted like the Python-side keys
+        utc = func.timezone("UTC", column)
+        return func.to_char(func.date_trunc(granularity, utc), _POSTGRES_FORMATS[granularity])
+    raise NotImplementedError(f"Unsupported database dialect for analytics: {dialect}")
+
+
+def json_text(column, key: str) -> ColumnElement:
+    """
+    `column ->> key` as text: json_extract() on SQLite, ->> on PostgreSQL. The same expression
+    is used by the expression indexes in models.py, so the planner can match them.
+    """
+    return column[key].as_string()
@@ -0,0 +1,209 @@
+"""
+Rollup counters backing the analytics endpoints.
+
+Conversions and recommendations bump hourly/daily counters in the same transaction that
+writes them, so the dashboard reads O(buckets) rows no matter how large history gets.
+`rebuild_rollups` recomputes every counter from the raw tables; run it after seeding or
+importing data, or periodically as a compactor (it also folds split buckets back into one row):
+
+    python -m app.features.analytics.rollup
+"""
+import datetime as dt
+from typing import Optional
+
+from sqlalchemy import String, cast, func, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from app.db import SessionLocal
+from app.db.models import (
+    Conversion,
+    ConversionRollup,
+    ConversionStage,
+    ImageTypeRollup,
+    LatencyBin,
+    Recommendation,
+)
+from app.features.analytics.queries import bucket_expr, dialect_name, json_text
+from app.features.analytics.sketch import bin_index
+
+# bucket key formats (UTC); the hour key starts with the day key so substr() can slice it
+GRANULARITIES = {
+    "hour": "%Y-%m-%d %H",
+    "day": "%Y-%m-%d",
+}
+
+
+def bucket_keys(ts: Optional[dt.datetime] = None) -> dict:
+    ts = ts or dt.datetime.utcnow()
+    if ts.tzinfo is not None:
+        # aware timestamps (PostgreSQL timestamptz) -> naive UTC, matching SQLite's CURRENT_TIMESTAMP
+        ts = ts.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return {granularity: ts.strftime(fmt) for granularity, fmt in GRANULARITIES.items()}
+
+
+def _bump(db: Session, model, keys: dict, increments: dict):
+    """
+    Atomically add `increments` to the rollup row matching `keys`, inserting it if missing.
+    Two writers racing on a new bucket may both insert; readers always sum, so that is harmless
+    and the next rebuild merges the rows again.
+    """
+    updated = (
+        db.query(model)
+        .filter_by(**keys)
+        .update(
+            {getattr(model, col): getattr(model, col) + value for col, value in increments.items()},
+            synchronize_session=False,
+        )
+    )
+    if not updated:
+        db.add(model(**keys, **increments))
+        db.flush()
+
+
+def record_conversion(db: Session, conv: Conversion, stages: Optional[dict] = None, sign: int = 1):
+    """
+    Count a conversion into its hour/day buckets and its latencies (total + per-stage seconds)
+    into the daily latency sketch. Use sign=-1 when the row is deleted.
+    Does not commit; call it before the caller's commit so counters and rows stay in sync.
+    """
+    has_size = conv.output_size_bytes is not None
+    increments = {
+        "count": sign,
+        "total_time": sign * (conv.time_taken or 0.0),
+        "output_count": sign * int(has_size),
+        "total_output_bytes": sign * (conv.output_size_bytes or 0),
+    }
+    for granularity, bucket in bucket_keys(conv.created_at).items():
+        keys = {
+            "granularity": granularity,
+            "bucket": bucket,
+            "mode": conv.mode,
+            "image_type": conv.image_type,
+            "device": conv.device,
+            "preview": bool(conv.preview),
+        }
+        _bump(db, ConversionRollup, keys, increments)
+
+    day = bucket_keys(conv.created_at)["day"]
+    latencies = {"total": conv.time_taken, **(stages or {})}
+    for stage, seconds in latencies.items():
+        if seconds is None:
+            continue
+        keys = {"bucket": day, "mode": conv.mode, "stage": stage, "preview": bool(conv.preview), "bin": bin_index(seconds)}
+        _bump(db, LatencyBin, keys, {"count": sign})
+
+
+def record_recommendation(db: Session, rec: Recommendation):
+    """
+    Count a recommendation's content type (metadata_json.ai_image_type) into its buckets.
+    """
+    meta = rec.metadata_json
+    if not meta:
+        return
+    ai_type = meta.get("ai_image_type") or "unknown"
+    for granularity, bucket in bucket_keys(rec.created_at).items():
+        keys = {"granularity": granularity, "bucket": bucket, "ai_image_type": ai_type}
+        _bump(db, ImageTypeRollup, keys, {"count": 1})
+
+
+def conversion_counts(dialect: str, granularity: str) -> Select:
+    """conversions grouped into ConversionRollup rows (bucket, dimensions, counters)."""
+    bucket = bucket_expr(dialect, Conversion.created_at, granularity)
+    return (
+        select(
+            bucket.label("bucket"),
+            Conversion.mode,
+            Conversion.image_type,
+            Conversion.device,
+            Conversion.preview,
+            func.count(Conversion.id),
+            func.coalesce(func.sum(Conversion.time_taken), 0.0),
+            func.count(Conversion.output_size_bytes),
+            func.coalesce(func.sum(Conversion.output_size_bytes), 0),
+        )
+        .group_by(bucket, Conversion.mode, Conversion.image_type, Conversion.device, Conversion.preview)
+    )
+
+
+def image_type_counts(dialect: str, granularity: str) -> Select:
+    """
+    recommendations grouped into ImageTypeRollup rows (bucket, ai_image_type, count); rows without
+    metadata are skipped like record_recommendation does (JSON null is stored as the text 'null').
+    """
+    ai_type = func.coalesce(func.nullif(json_text(Recommendation.metadata_json, "ai_image_type"), ""), "unknown")
+    has_meta = Recommendation.metadata_json.isnot(None) & cast(Recommendation.metadata_json, String).notin_(["null", "{}"])
+    bucket = bucket_expr(dialect, Recommendation.created_at, granularity)
+    return select(bucket, ai_type, func.count(Recommendation.id)).where(has_meta).group_by(bucket, ai_type)
+
+
+def rebuild_rollups(db: Session):
+    """
+    Recompute all rollup rows from `conversions` and `recommendations`. Counters are grouped in
+    the database (see analytics/queries.py); only the latency sketch bins, which need a log,
+    are computed here.
+    """
+    db.query(ConversionRollup).delete(synchronize_session=False)
+    db.query(ImageTypeRollup).delete(synchronize_session=False)
+    db.query(LatencyBin).delete(synchronize_session=False)
+
+    dialect = dialect_name(db)
+    for granularity in GRANULARITIES:
+        rows = db.execute(conversion_counts(dialect, granularity)).all()
+        db.add_all(
+            ConversionRollup(
+                granularity=granularity,
+                bucket=b,
+                mode=mode,
+                image_type=image_type,
+                device=device,
+                preview=preview,
+                count=count,
+                total_time=total_time,
+                output_count=output_count,
+                total_output_bytes=total_bytes,
+            )
+            for b, mode, image_type, device, preview, count, total_time, output_count, total_bytes in rows
+        )
+
+    for granularity in GRANULARITIES:
+        rows = db.execute(image_type_counts(dialect, granularity)).all()
+        db.add_all(
+            ImageTypeRollup(granularity=granularity, bucket=b, ai_image_type=t, count=c)
+            for b, t, c in rows
+        )
+
+    bins = {}
+
+    def add_latency(created_at, mode, preview, stage, seconds):
+        key = (bucket_keys(created_at)["day"], mode, bool(preview), stage, bin_index(seconds))
+        bins[key] = bins.get(key, 0) + 1
+
+    rows = db.query(Conversion.created_at, Conversion.mode, Conversion.preview, Conversion.time_taken).yield_per(1000)
+    for created_at, mode, preview, seconds in rows:
+        add_latency(created_at, mode, preview, "total", seconds)
+    rows = (
+        db.query(Conversion.created_at, Conversion.mode, Conversion.preview, ConversionStage.stage, ConversionStage.seconds)
+        .join(ConversionStage, ConversionStage.conversion_id == Conversion.id)
+        .yield_per(1000)
+    )
+    for created_at, mode, preview, stage, seconds in rows:
+        add_latency(created_at, mode, preview, stage, seconds)
+    db.add_all(
+        LatencyBin(bucket=b, mode=m, preview=p, stage=st, bin=idx, count=c)
+        for (b, m, p, st, idx), c in bins.items()
+    )
+    db.commit()
+
+
+def main():
+    session = SessionLocal()
+    try:
+        rebuild_rollups(session)
+        print("✅ Analytics rollups rebuilt.")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
+import datetime as dt
+from typing import Optional
+
 from fastapi import APIRouter, Depends
 from sqlalchemy.orm import Session
 from sqlalchemy import func, desc
 from app.db import get_db
-from app.db.models import Conversion, Recommendation
+from app.db.models import ConversionRollup, ImageTypeRollup, LatencyBin
+from app.features.analytics.sketch import QuantileSketch
 
 router = APIRouter(prefix="/analytics", tags=["Analytics"])
 
@@ -11,22 +15,26 @@ router = APIRouter(prefix="/analytics", tags=["Analytics"])
 # -----------------------------------------
 @router.get("/summary")
 def get_summary(db: Session = Depends(get_db)):
-    total = db.query(Conversion).count()
+    daily = db.query(ConversionRollup).filter(ConversionRollup.granularity == "day", ConversionRollup.preview.is_(False))
+    total, total_time = daily.with_entities(
+        func.coalesce(func.sum(ConversionRollup.count), 0),
+        func.coalesce(func.sum(ConversionRollup.total_time), 0.0),
+    ).one()
 
+    count_expr = func.sum(ConversionRollup.count)
     mode_row = (
-        db.query(Conversion.mode, func.count().label("count"))
-        .group_by(Conversion.mode)
+        daily.with_entities(ConversionRollup.mode, count_expr.label("count"))
+        .group_by(ConversionRollup.mode)
         .order_by(desc("count"))
         .first()
     )
     most_used_mode = mode_row.mode if mode_row else None
 
-    avg_time = db.query(func.avg(Conversion.time_taken)).scalar() or 0
-    avg_time = round(avg_time, 2)
+    avg_time = round(total_time / total, 2) if total else 0
 
     type_row = (
-        db.query(Conversion.image_type, func.count().label("count"))
-        .group_by(Conversion.image_type)
+        daily.with_entities(ConversionRollup.image_type, count_expr.label("count"))
+        .group_by(ConversionRollup.image_type)
         .order_by(desc("count"))
         .first()
     )
@@ -46,8 +54,10 @@ def get_summary(db: Session = Depends(get_db)):
 @router.get("/mode-usage")
 def mode_usage(db: Session = Depends(get_db)):
     rows = (
-        db.query(Conversion.mode, func.count().label("count"))
-        .group_by(Conversion.mode)
+        db.query(ConversionRollup.mode, func.sum(ConversionRollup.count).label("count"))
+        .filter(ConversionRollup.granularity == "day", ConversionRollup.preview.is_(False))
+        .group_by(ConversionRollup.mode)
+        .having(func.sum(ConversionRollup.count) > 0)
         .all()
     )
     return {mode: count for mode, count in rows}
@@ -58,15 +68,15 @@ def mode_usage(db: Session = Depends(get_db)):
 # -----------------------------------------
 @router.get("/daily-trend")
 def daily_trend(db: Session = Depends(get_db)):
-    date_expr = func.date(Conversion.created_at)   # FIXED
-
     rows = (
         db.query(
-            date_expr.label("date"),
-            func.count(Conversion.id).label("count")
+            ConversionRollup.bucket.label("date"),
+            func.sum(ConversionRollup.count).label("count")
         )
-        .group_by(date_expr)
-        .order_by(date_expr)
+        .filter(ConversionRollup.granularity == "day", ConversionRollup.preview.is_(False))
+        .group_by(ConversionRollup.bucket)
+        .having(func.sum(ConversionRollup.count) > 0)
+        .order_by(ConversionRollup.bucket)
         .all()
     )
     return [{"date": r.date, "count": r.count} for r in rows]
@@ -76,16 +86,19 @@ def daily_trend(db: Session = Depends(get_db)):
 # 5. TIME BY MODE
 # -----------------------------------------
 @router.get("/time-by-mode")
-def time_by_mode(db: Session = Depends(get_db)):
+def time_by_mode(preview: bool = False, db: Session = Depends(get_db)):
     rows = (
         db.query(
-            Conversion.mode,
-            func.avg(Conversion.time_taken).label("avg_time")
+            ConversionRollup.mode,
+            func.sum(ConversionRollup.total_time),
+            func.sum(ConversionRollup.count),
         )
-        .group_by(Conversion.mode)
+        .filter(ConversionRollup.granularity == "day", ConversionRollup.preview.is_(preview))
+        .group_by(ConversionRollup.mode)
+        .having(func.sum(ConversionRollup.count) > 0)
         .all()
     )
-    return [{"mode": mode, "avg_time": round(avg, 2)} for mode, avg in rows]
+    return [{"mode": mode, "avg_time": round(total / count, 2)} for mode, total, count in rows]
 
 
 # -----------------------------------------
@@ -93,13 +106,16 @@ def time_by_mode(db: Session = Depends(get_db)):
 # -----------------------------------------
 @router.get("/peak-hours")
 def peak_hours(db: Session = Depends(get_db)):
+    hour_expr = func.substr(ConversionRollup.bucket, 12, 2)  # "YYYY-MM-DD HH" -> "HH"
     rows = (
         db.query(
-            func.strftime('%H', Conversion.created_at).label("hour"),   # FIXED
-            func.count().label("count")
+            hour_expr.label("hour"),
+            func.sum(ConversionRollup.count).label("count")
         )
-        .group_by("hour")
-        .order_by("hour")
+        .filter(ConversionRollup.granularity == "hour", ConversionRollup.preview.is_(False))
+        .group_by(hour_expr)
+        .having(func.sum(ConversionRollup.count) > 0)
+        .order_by(hour_expr)
         .all()
     )
     return [{"hour": hour, "count": count} for hour, count in rows]
@@ -110,14 +126,13 @@ def peak_hours(db: Session = Depends(get_db)):
 # -----------------------------------------
 @router.get("/image-types")
 def image_types(db: Session = Depends(get_db)):
-    rows = db.query(Recommendation.metadata_json).all()
-    buckets = {}
-    for (meta,) in rows:
-        if not meta:
-            continue
-        ctype = meta.get("ai_image_type") or "unknown"
-        buckets[ctype] = buckets.get(ctype, 0) + 1
-    return [{"type": t, "count": c} for t, c in buckets.items()]
+    rows = (
+        db.query(ImageTypeRollup.ai_image_type, func.sum(ImageTypeRollup.count))
+        .filter(ImageTypeRollup.granularity == "day")
+        .group_by(ImageTypeRollup.ai_image_type)
+        .all()
+    )
+    return [{"type": t, "count": c} for t, c in rows]
 
 
 # -----------------------------------------
@@ -127,15 +142,57 @@ def image_types(db: Session = Depends(get_db)):
 def output_size_by_mode(db: Session = Depends(get_db)):
     rows = (
         db.query(
-            Conversion.mode,
-            func.avg(Conversion.output_size_bytes).label("avg_size")
+            ConversionRollup.mode,
+            func.sum(ConversionRollup.total_output_bytes),
+            func.sum(ConversionRollup.output_count),
         )
-        .group_by(Conversion.mode)
+        .filter(ConversionRollup.granularity == "day", ConversionRollup.preview.is_(False))
+        .group_by(ConversionRollup.mode)
+        .having(func.sum(ConversionRollup.count) > 0)
         .all()
     )
     return [
-        {"mode": mode, "avg_size": round((avg or 0) / (1024 * 1024), 3)}  # MB
-        for mode, avg in rows
+        {"mode": mode, "avg_size": round((total / count if count else 0) / (1024 * 1024), 3)}  # MB
+        for mode, total, count in rows
+    ]
+
+
+# -----------------------------------------
+# 13. LATENCY PERCENTILES (quantile sketch over the last `days` days)
+# -----------------------------------------
+def _latency_sketches(db: Session, days: int, mode: Optional[str] = None, stage: Optional[str] = None,
+                      preview: bool = False):
+    since = (dt.datetime.utcnow() - dt.timedelta(days=max(days, 1) - 1)).strftime("%Y-%m-%d")
+    q = (
+        db.query(LatencyBin.mode, LatencyBin.stage, LatencyBin.bin, func.sum(LatencyBin.count))
+        .filter(LatencyBin.bucket >= since, LatencyBin.preview.is_(preview))
+        .group_by(LatencyBin.mode, LatencyBin.stage, LatencyBin.bin)
+    )
+    if mode:
+        q = q.filter(LatencyBin.mode == mode.lower())
+    if stage:
+        q = q.filter(LatencyBin.stage == stage)
+    sketches = {}
+    for row_mode, row_stage, idx, count in q.all():
+        if count > 0:
+            sketches.setdefault((row_mode, row_stage), QuantileSketch()).bins[idx] = count
+    return sketches
+
+
+@router.get("/latency-percentiles")
+def latency_percentiles(days: int = 7, preview: bool = False, db: Session = Depends(get_db)):
+    sketches = _latency_sketches(db, days, stage="total", preview=preview)
+    return [{"mode": mode, **sketch.summary()} for (mode, _), sketch in sorted(sketches.items())]
+
+
+@router.get("/stage-percentiles")
+def stage_percentiles(days: int = 7, mode: Optional[str] = None, preview: bool = False,
+                      db: Session = Depends(get_db)):
+    sketches = _latency_sketches(db, days, mode=mode, preview=preview)
+    return [
+        {"mode": row_mode, "stage": stage, **sketch.summary()}
+        for (row_mode, stage), sketch in sorted(sketches.items())
+        if stage != "total"
     ]
 
 
@@ -0,0 +1,60 @@
+"""
+Streaming quantile sketch for latencies (DDSketch-style log buckets).
+
+A value v lands in bin ceil(log_gamma(v)); every value in a bin is within RELATIVE_ACCURACY of the
+bin's representative value, so any quantile read back is accurate to ~1% regardless of how many
+samples were merged. Bins are plain integer counters, which is what lets the analytics layer keep
+them in rollup rows and merge them with SUM() across any time window.
+"""
+import math
+from typing import Dict, Iterable, Optional
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(GAMMA)
+MIN_VALUE = 1e-4  # seconds; anything faster is reported as this
+
+
+def bin_index(value: float) -> int:
+    return int(math.ceil(math.log(max(value, MIN_VALUE)) / _LOG_GAMMA))
+
+
+def bin_value(index: int) -> float:
+    """Representative value of a bin (the point with equal relative error to both edges)."""
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+class QuantileSketch:
+    def __init__(self, bins: Optional[Dict[int, int]] = None):
+        self.bins: Dict[int, int] = dict(bins or {})
+
+    @property
+    def count(self) -> int:
+        return sum(self.bins.values())
+
+    def add(self, value: float, count: int = 1):
+        idx = bin_index(value)
+        self.bins[idx] = self.bins.get(idx, 0) + count
+
+    def merge(self, other: "QuantileSketch"):
+        for idx, count in other.bins.items():
+            self.bins[idx] = self.bins.get(idx, 0) + count
+
+    def quantile(self, q: float) -> Optional[float]:
+        total = self.count
+        if total <= 0:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for idx in sorted(self.bins):
+            seen += self.bins[idx]
+            if seen > rank:
+                return bin_value(idx)
+        return bin_value(max(self.bins))
+
+    def summary(self, quantiles: Iterable[float] = (0.5, 0.9, 0.99)) -> dict:
+        out = {"count": self.count}
+        for q in quantiles:
+            value = self.quantile(q)
+            out[f"p{round(q * 100):g}"] = round(value, 3) if value is not None else None
+        return out
@@ -0,0 +1,285 @@
+"""
+Admission control for /conversion/convert, /conversion/sweep and /conversion/recommend.
+
+Every request is priced in estimated worker-seconds before it runs:
+
+- convert:    mode x input megapixels x upscale tier. The rate (seconds per megapixel) is the
+              median over the last ADMISSION_HISTORY_ROWS stored conversions of the same mode,
+              tier and device (time_taken / chosen_params.megapixels), refreshed every
+              ADMISSION_REFRESH_SECONDS; with fewer than ADMISSION_MIN_SAMPLES rows the upscalers.py
+              cost model plus PRIOR_SECONDS_PER_MP is used. Vectorize only upscales when the gate
+              says so (upscale_gate.py), so its estimate weights the tier's rate by the share of
+              recent vectorize runs that did upscale. Previews cost their mode's median preview
+              time (the proxy size does not follow the input).
+- sweep:      one convert of the mode at its default tier (the shared decode/upscale and the first
+              trace) plus one untiered convert per further variant (the extra traces).
+- recommend:  a moving average of observed /recommend durations (ADMISSION_RECOMMEND_SECONDS
+              until the first one finishes).
+
+and admitted only when both hold:
+
+- the client's token bucket (ADMISSION_CLIENT_BURST seconds, refilled at ADMISSION_CLIENT_RATE
+  seconds per second) has the cost in it; a job costlier than the burst needs a full bucket and
+  leaves it in debt. The estimate is trued up with the measured duration when the request ends.
+- the estimated work in flight stays within ADMISSION_GLOBAL_BUDGET seconds (default 300 per
+  conversion worker); a single job above the budget only runs on an idle node.
+
+Otherwise the request is answered 429 with Retry-After (when the bucket will hold the cost, or an
+estimate of when enough in-flight work drains). Clients are keyed by address (the first
+X-Forwarded-For hop with ADMISSION_TRUST_PROXY=1); requests with the admin token skip the client
+buckets. Buckets and the budget are per API process. ADMISSION_ENABLED=0 admits everything.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from statistics import median
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from loguru import logger
+from sqlalchemy import desc
+
+from app import metrics
+from app.db import CONVERSION_WORKERS, SessionLocal, models
+from app.features.conversion import upscalers
+from app.features.helpers import profiling
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1").lower() in {"1", "true", "yes"}
+ADMISSION_CLIENT_RATE = float(os.getenv("ADMISSION_CLIENT_RATE", "1.0"))
+ADMISSION_CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "300"))
+ADMISSION_GLOBAL_BUDGET = float(os.getenv("ADMISSION_GLOBAL_BUDGET", str(300 * CONVERSION_WORKERS)))
+ADMISSION_TRUST_PROXY = os.getenv("ADMISSION_TRUST_PROXY", "0").lower() in {"1", "true", "yes"}
+ADMISSION_HISTORY_ROWS = int(os.getenv("ADMISSION_HISTORY_ROWS", "500"))
+ADMISSION_MIN_SAMPLES = int(os.getenv("ADMISSION_MIN_SAMPLES", "5"))
+ADMISSION_REFRESH_SECONDS = float(os.getenv("ADMISSION_REFRESH_SECONDS", "300"))
+ADMISSION_RECOMMEND_SECONDS = float(os.getenv("ADMISSION_RECOMMEND_SECONDS", "2.0"))
+ADMISSION_MIN_COST = float(os.getenv("ADMISSION_MIN_COST", "0.2"))
+
+# pipeline cost besides the upscale (trace, Canny), seconds per input megapixel
+PRIOR_SECONDS_PER_MP = {"vectorize": 2.0, "outline": 0.3, "enhance": 0.1}
+PREVIEW_PRIOR_SECONDS = 0.5
+# rows smaller than this are dominated by fixed costs and would inflate the per-MP rate
+_MIN_SAMPLE_MP = 0.05
+_MAX_CLIENTS = 10000
+_EWMA_WEIGHT = 0.2
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float, cost: float):
+        super().__init__(f"Over the {reason} budget; retry in {math.ceil(retry_after)} s")
+        self.reason = reason  # client | global
+        self.retry_after = retry_after
+        self.cost = cost
+
+
+def too_many_requests(e: AdmissionRejected) -> JSONResponse:
+    retry_after = max(1, math.ceil(e.retry_after))
+    return JSONResponse(
+        status_code=429,
+        content={"error": str(e), "reason": e.reason, "estimated_seconds": round(e.cost, 2), "retry_after": retry_after},
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+def client_key(request: Request) -> str:
+    if ADMISSION_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+# -----------------------
+# Cost estimates
+# -----------------------
+
+class CostModel:
+    """Seconds-per-megapixel rates from conversion history, reloaded when stale."""
+
+    def __init__(self):
+        self._rates: Dict[Tuple[str, str, str], float] = {}
+        self._upscale_share: Dict[str, float] = {}
+        self._loaded_at = 0.0
+        self._loading = threading.Lock()
+        self.recommend_seconds = ADMISSION_RECOMMEND_SECONDS
+
+    def refresh_if_stale(self):
+        """Reload the rates in the background when they are older than ADMISSION_REFRESH_SECONDS."""
+        if time.monotonic() - self._loaded_at > ADMISSION_REFRESH_SECONDS and not self._loading.locked():
+            self._loaded_at = time.monotonic()
+            threading.Thread(target=self.refresh, name="admission-costs", daemon=True).start()
+
+    def refresh(self):
+        """Reload the rates (blocking DB read)."""
+        if not self._loading.acquire(blocking=False):
+            return  # another request is already reloading
+        try:
+            with SessionLocal() as db:
+                rows = (
+                    db.query(models.Conversion.mode, models.Conversion.device, models.Conversion.time_taken,
+                             models.Conversion.preview, models.Conversion.chosen_params)
+                    .filter(models.Conversion.output_size_bytes.isnot(None))
+                    .order_by(desc(models.Conversion.id))
+                    .limit(ADMISSION_HISTORY_ROWS)
+                    .all()
+                )
+            samples: Dict[Tuple[str, str, str], list] = {}
+            upscaled: Dict[str, list] = {}
+            for mode, device, seconds, preview, params in rows:
+                megapixels = (params or {}).get("megapixels")
+                if preview:
+                    # previews run on a proxy of bounded size: priced per request, not per megapixel
+                    samples.setdefault((mode, "preview", device or "cpu"), []).append(seconds)
+                    continue
+                if not megapixels or megapixels < _MIN_SAMPLE_MP:
+                    continue
+                tier = params.get("upscale_tier") or "none"
+                samples.setdefault((mode, tier, device or "cpu"), []).append(seconds / megapixels)
+                if mode == "vectorize":
+                    upscaled.setdefault(device or "cpu", []).append(tier != "none")
+            self._rates = {key: median(v) for key, v in samples.items() if len(v) >= ADMISSION_MIN_SAMPLES}
+            self._upscale_share = {d: sum(v) / len(v) for d, v in upscaled.items() if len(v) >= ADMISSION_MIN_SAMPLES}
+        except Exception as e:
+            logger.warning(f"Admission cost history unavailable, using the prior costs: {e}")
+        finally:
+            self._loaded_at = time.monotonic()
+            self._loading.release()
+
+    def _prior(self, mode: str, tier: str, megapixels: float, device: str) -> float:
+        if tier == "preview":
+            return PREVIEW_PRIOR_SECONDS
+        seconds = PRIOR_SECONDS_PER_MP.get(mode, 1.0) * megapixels
+        if tier != "none":
+            seconds += upscalers.estimate_seconds(tier, megapixels, device, in_process=mode == "enhance")
+        return seconds
+
+    def _seconds(self, mode: str, tier: str, megapixels: float, device: str) -> float:
+        rate = self._rates.get((mode, tier, device))
+        if rate is None:
+            return self._prior(mode, tier, megapixels, device)
+        return rate if tier == "preview" else rate * megapixels
+
+    def convert(self, mode: str, megapixels: float, tier: Optional[str], preview: bool, device: str) -> float:
+        self.refresh_if_stale()
+        if preview:
+            tier = "preview"
+        tier = tier or "none"
+        seconds = self._seconds(mode, tier, megapixels, device)
+        if mode == "vectorize" and tier not in ("none", "preview"):
+            share = self._upscale_share.get(device)
+            if share is not None:
+                seconds = share * seconds + (1 - share) * self._seconds(mode, "none", megapixels, device)
+        return max(seconds, ADMISSION_MIN_COST)
+
+    def sweep(self, mode: str, megapixels: float, variants: int, preview: bool, device: str) -> float:
+        shared = self.convert(mode, megapixels, None if preview else upscalers.DEFAULT_TIER.get(mode), preview, device)
+        trace = self.convert(mode, megapixels, None, preview, device)
+        return shared + max(variants - 1, 0) * trace
+
+    def recommend(self) -> float:
+        return max(self.recommend_seconds, ADMISSION_MIN_COST)
+
+    def observe_recommend(self, seconds: float):
+        self.recommend_seconds += _EWMA_WEIGHT * (seconds - self.recommend_seconds)
+
+
+COSTS = CostModel()
+
+
+# -----------------------
+# Budgets
+# -----------------------
+
+class TokenBucket:
+    def __init__(self, now: float):
+        self.tokens = ADMISSION_CLIENT_BURST
+        self.updated = now
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(ADMISSION_CLIENT_BURST, self.tokens + (now - self.updated) * ADMISSION_CLIENT_RATE)
+        self.updated = now
+        return self.tokens
+
+
+class Ticket:
+    """An admitted request's share of the budgets; release() it when the request ends."""
+
+    def __init__(self, controller: Optional["Controller"], client: Optional[str], cost: float):
+        self.cost = cost
+        self._controller = controller
+        self._client = client
+
+    def release(self, seconds: Optional[float] = None):
+        """Return the in-flight budget and settle the client's bucket with the measured `seconds`."""
+        if self._controller is not None:
+            self._controller.release(self, seconds)
+            self._controller = None
+
+
+class Controller:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()  # least recently admitted first
+        self.in_flight = 0.0
+        metrics.ADMISSION_BUDGET_SECONDS.set(ADMISSION_GLOBAL_BUDGET)
+
+    def admit(self, endpoint: str, client: Optional[str], cost: float) -> Ticket:
+        """A Ticket for `cost` seconds, or AdmissionRejected. `client` None skips the client bucket."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = None
+            if client is not None:
+                bucket = self._bucket(client, now)
+                needed = min(cost, ADMISSION_CLIENT_BURST)
+                tokens = bucket.refill(now)
+                if tokens < needed:
+                    metrics.ADMISSION_REJECTED.labels(endpoint=endpoint, reason="client").inc()
+                    raise AdmissionRejected("client", (needed - tokens) / ADMISSION_CLIENT_RATE, cost)
+            if self.in_flight > 0 and self.in_flight + cost > ADMISSION_GLOBAL_BUDGET:
+                # drains at about CONVERSION_WORKERS seconds of estimated work per second
+                excess = self.in_flight if cost > ADMISSION_GLOBAL_BUDGET else self.in_flight + cost - ADMISSION_GLOBAL_BUDGET
+                metrics.ADMISSION_REJECTED.labels(endpoint=endpoint, reason="global").inc()
+                raise AdmissionRejected("global", excess / max(CONVERSION_WORKERS, 1), cost)
+            if bucket is not None:
+                bucket.tokens -= cost
+            self.in_flight += cost
+            metrics.ADMISSION_BUDGET_USED.set(self.in_flight)
+        return Ticket(self, client, cost)
+
+    def release(self, ticket: Ticket, seconds: Optional[float]):
+        with self._lock:
+            self.in_flight = max(self.in_flight - ticket.cost, 0.0)
+            metrics.ADMISSION_BUDGET_USED.set(self.in_flight)
+            bucket = self._buckets.get(ticket._client) if ticket._client is not None else None
+            if bucket is not None and seconds is not None:
+                bucket.tokens = min(ADMISSION_CLIENT_BURST, bucket.tokens + ticket.cost - seconds)
+
+    def _bucket(self, client: str, now: float) -> TokenBucket:
+        bucket = self._buckets.get(client)
+        if bucket is not None:
+            self._buckets.move_to_end(client)
+            return bucket
+        # drop the least recently seen clients: theirs are the buckets closest to refilled
+        while len(self._buckets) >= _MAX_CLIENTS:
+            self._buckets.popitem(last=False)
+        bucket = self._buckets[client] = TokenBucket(now)
+        return bucket
+
+    def usage(self) -> dict:
+        with self._lock:
+            return {"in_flight_seconds": round(self.in_flight, 2), "budget_seconds": ADMISSION_GLOBAL_BUDGET,
+                    "clients": len(self._buckets)}
+
+
+CONTROLLER = Controller()
+
+
+def admit(request: Request, endpoint: str, cost: float) -> Ticket:
+    """Admit a request costing `cost` estimated seconds (see module docstring) or raise AdmissionRejected."""
+    if not ADMISSION_ENABLED:
+        return Ticket(None, None, cost)
+    client = None if profiling.is_admin(request) else client_key(request)
+    return CONTROLLER.admit(endpoint, client, cost)
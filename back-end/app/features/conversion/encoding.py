@@ -0,0 +1,283 @@
+"""
+Output encoding for raster results (enhance).
+
+The upscaled image is encoded once, in memory, into the format the request negotiated:
+
+- `output_format` (png | webp | avif | jpeg) when the request names one
+- otherwise the Accept header: the explicitly listed image types by q-value, ties broken by
+  ENCODE_PREFERENCE (webp, avif, jpeg, png); wildcards, no header or only unsupported types
+  give ENCODE_DEFAULT_FORMAT (png, the historical output)
+
+and at the requested effort: `quality` for webp/avif/jpeg (ENCODE_WEBP_QUALITY 90,
+ENCODE_AVIF_QUALITY 60, ENCODE_JPEG_QUALITY 92) and `png_level` (0-9, ENCODE_PNG_LEVEL 3).
+A format the image cannot be written in (webp above 16383 px, avif without libavif in Pillow)
+falls back to png.
+
+PNG is written by PngStream: rows are Up-filtered and deflated in ENCODE_CHUNK_BYTES chunks on
+ENCODE_EXECUTOR (ENCODE_THREADS threads; zlib releases the GIL), pigz-style: every chunk is a
+raw deflate stream ended with a sync flush, the pieces are concatenated behind one zlib header
+and an Adler-32 of all the data. Chunks do not share a dictionary, which costs well under 1% on
+photo-sized chunks. tiled_io streams huge outputs through the same encoder. webp and jpeg go
+through cv2.imencode, avif through Pillow (libavif, ENCODE_THREADS threads).
+"""
+import io
+import os
+import re
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image, features
+
+from app import metrics
+from app.features.helpers.timing import StageTimer
+
+ENCODE_DEFAULT_FORMAT = os.getenv("ENCODE_DEFAULT_FORMAT", "png")
+ENCODE_PREFERENCE = [f.strip() for f in os.getenv("ENCODE_PREFERENCE", "webp,avif,jpeg,png").split(",") if f.strip()]
+ENCODE_PNG_LEVEL = int(os.getenv("ENCODE_PNG_LEVEL", "3"))
+ENCODE_WEBP_QUALITY = int(os.getenv("ENCODE_WEBP_QUALITY", "90"))
+ENCODE_AVIF_QUALITY = int(os.getenv("ENCODE_AVIF_QUALITY", "60"))
+ENCODE_JPEG_QUALITY = int(os.getenv("ENCODE_JPEG_QUALITY", "92"))
+ENCODE_THREADS = int(os.getenv("ENCODE_THREADS", str(os.cpu_count() or 1)))
+ENCODE_CHUNK_BYTES = int(os.getenv("ENCODE_CHUNK_BYTES", str(1 << 20)))
+
+ENCODE_EXECUTOR = ThreadPoolExecutor(max_workers=max(ENCODE_THREADS, 1), thread_name_prefix="encode")
+
+# format -> (mime type, file extension)
+FORMATS = {
+    "png": ("image/png", ".png"),
+    "webp": ("image/webp", ".webp"),
+    "avif": ("image/avif", ".avif"),
+    "jpeg": ("image/jpeg", ".jpg"),
+}
+EXTENSIONS = {".png": "png", ".webp": "webp", ".avif": "avif", ".jpg": "jpeg", ".jpeg": "jpeg"}
+_MIME_FORMATS = {mime: fmt for fmt, (mime, _) in FORMATS.items()}
+_MAX_SIDE = {"webp": 16383, "jpeg": 65535, "avif": 65536}
+
+_ACCEPT_ITEM = re.compile(r"^\s*([^;\s]+)\s*(?:;(.*))?$")
+_Q = re.compile(r"(?:^|;)\s*q\s*=\s*([0-9.]+)")
+
+_PNG_COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+_PNG_IDAT_BYTES = 1 << 20
+# zlib header (deflate, 32K window) with the FLEVEL zlib itself writes for the level
+_ZLIB_HEADERS = {0: b"\x78\x01", 1: b"\x78\x01", 2: b"\x78\x5e", 3: b"\x78\x5e", 4: b"\x78\x5e", 5: b"\x78\x5e",
+                 6: b"\x78\x9c", 7: b"\x78\xda", 8: b"\x78\xda", 9: b"\x78\xda"}
+
+
+class EncodingError(ValueError):
+    pass
+
+
+def available(fmt: str) -> bool:
+    return fmt in FORMATS and (fmt != "avif" or bool(features.check("avif")))
+
+
+def negotiate(accept: Optional[str], requested: Optional[str] = None) -> str:
+    """The output format for an explicit `requested` format or else the Accept header."""
+    if requested:
+        fmt = EXTENSIONS.get("." + requested.lower().lstrip("."), requested.lower())
+        if fmt not in FORMATS:
+            raise EncodingError(f"Unsupported output_format {requested!r} (choose from {', '.join(FORMATS)})")
+        return fmt
+    offers = []
+    for item in (accept or "").split(","):
+        m = _ACCEPT_ITEM.match(item)
+        if not m:
+            continue
+        fmt = _MIME_FORMATS.get(m.group(1).lower())
+        q = _Q.search(m.group(2) or "")
+        try:
+            weight = float(q.group(1)) if q else 1.0
+        except ValueError:
+            continue
+        if fmt and weight > 0 and available(fmt):
+            rank = ENCODE_PREFERENCE.index(fmt) if fmt in ENCODE_PREFERENCE else len(ENCODE_PREFERENCE)
+            offers.append((-weight, rank, fmt))
+    return min(offers)[2] if offers else ENCODE_DEFAULT_FORMAT
+
+
+def format_for(path: str) -> str:
+    """Format of a file name's extension (png for anything else)."""
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), "png")
+
+
+# -----------------------
+# PNG
+# -----------------------
+
+def _deflate_chunk(data: bytes, level: int, final: bool) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelDeflate:
+    """compressobj-like zlib stream whose chunks are deflated independently on ENCODE_EXECUTOR."""
+
+    def __init__(self, level: int, threads: int = ENCODE_THREADS):
+        self.level = min(max(level, 0), 9)
+        self._parallel = threads > 1
+        self._adler = 1
+        self._pending: deque = deque()
+        self._max_pending = max(threads, 1) * 2  # bounds the chunks held in memory
+        self._header = _ZLIB_HEADERS[self.level]
+
+    def _collect(self, wait_for: int) -> bytes:
+        out = [self._header]
+        self._header = b""
+        while self._pending and (len(self._pending) > wait_for or self._pending[0].done()):
+            out.append(self._pending.popleft().result())
+        return b"".join(out)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compressed output that is ready (possibly none yet)."""
+        if not data:
+            return b""
+        self._adler = zlib.adler32(data, self._adler)
+        if not self._parallel:
+            header, self._header = self._header, b""
+            return header + _deflate_chunk(data, self.level, final=False)
+        self._pending.append(ENCODE_EXECUTOR.submit(_deflate_chunk, data, self.level, False))
+        return self._collect(self._max_pending)
+
+    def flush(self) -> bytes:
+        """The rest of the stream: pending chunks, the final (empty) block and the Adler-32."""
+        rest = self._collect(0)
+        return rest + _deflate_chunk(b"", self.level, final=True) + struct.pack(">I", self._adler & 0xFFFFFFFF)
+
+
+class PngStream:
+    """
+    PNG encoder writing to a binary file object: 8-bit rows (gray/BGR/BGRA, as cv2) are
+    Up-filtered and deflated (ParallelDeflate) as they arrive.
+    """
+
+    def __init__(self, out, width: int, height: int, channels: int, level: int = ENCODE_PNG_LEVEL,
+                 threads: int = ENCODE_THREADS):
+        self.width, self.height, self.channels = width, height, channels
+        self.rows = 0
+        self._out = out
+        self._zlib = ParallelDeflate(level, threads)
+        self._pending = bytearray()
+        self._previous = np.zeros(width * channels, np.uint8)
+        out.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, _PNG_COLOR_TYPES[channels], 0, 0, 0))
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self._out.write(struct.pack(">I", len(data)) + kind + data)
+        self._out.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def _emit(self, data: bytes):
+        self._pending += data
+        if len(self._pending) >= _PNG_IDAT_BYTES:
+            self._chunk(b"IDAT", bytes(self._pending))
+            self._pending.clear()
+
+    def write(self, rows: np.ndarray):
+        # ENCODE_CHUNK_BYTES at a time: the deflate unit, and small temporaries next to the caller's buffer
+        step = max(1, ENCODE_CHUNK_BYTES // max(rows[0].nbytes, 1))
+        for start in range(0, len(rows), step):
+            self._write(rows[start:start + step])
+
+    def _write(self, rows: np.ndarray):
+        if rows.ndim == 3:
+            rows = rows[..., [2, 1, 0, 3][:rows.shape[2]]]  # BGR(A) -> RGB(A)
+        flat = rows.reshape(len(rows), -1)
+        # Up filter (type 2): each byte minus the one above it, mod 256
+        filtered = np.empty((len(flat), flat.shape[1] + 1), np.uint8)
+        filtered[:, 0] = 2
+        filtered[0, 1:] = flat[0] - self._previous
+        filtered[1:, 1:] = flat[1:] - flat[:-1]
+        self._previous = flat[-1].copy()
+        self.rows += len(flat)
+        self._emit(self._zlib.compress(filtered.tobytes()))
+
+    def finish(self):
+        if self.rows != self.height:
+            raise ValueError(f"PNG has {self.rows} of {self.height} rows")
+        self._emit(self._zlib.flush())
+        self._chunk(b"IDAT", bytes(self._pending))
+        self._pending.clear()
+        self._chunk(b"IEND", b"")
+
+
+def encode_png(img: np.ndarray, level: int = ENCODE_PNG_LEVEL) -> bytes:
+    if img.dtype != np.uint8:
+        # 16-bit stays 16-bit; libpng's single-threaded writer handles it
+        ok, buf = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, level])
+        if not ok:
+            raise EncodingError("PNG encoding failed")
+        return buf.tobytes()
+    out = io.BytesIO()
+    stream = PngStream(out, img.shape[1], img.shape[0], 1 if img.ndim == 2 else img.shape[2], level)
+    stream.write(img)
+    stream.finish()
+    return out.getvalue()
+
+
+# -----------------------
+# Encoding
+# -----------------------
+
+def _to_8bit(img: np.ndarray) -> np.ndarray:
+    return img if img.dtype == np.uint8 else (img / 257).astype(np.uint8)
+
+
+def usable_format(fmt: str, img: np.ndarray) -> str:
+    """`fmt`, or png when the image cannot be written in it."""
+    if fmt not in FORMATS or not available(fmt) or max(img.shape[:2]) > _MAX_SIDE.get(fmt, 1 << 31):
+        return "png"
+    return fmt
+
+
+def encode(img: np.ndarray, fmt: str, quality: Optional[int] = None,
+           png_level: Optional[int] = None) -> Tuple[bytes, str]:
+    """(encoded bytes, format used) for a cv2 image (gray/BGR/BGRA, 8 or 16 bit)."""
+    fmt = usable_format(fmt, img)
+    if fmt == "png":
+        return encode_png(img, ENCODE_PNG_LEVEL if png_level is None else png_level), fmt
+    img = _to_8bit(img)
+    if fmt == "jpeg":
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = img[..., :3]  # no alpha in JPEG
+        ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality or ENCODE_JPEG_QUALITY])
+    elif fmt == "webp":
+        ok, buf = cv2.imencode(".webp", img, [cv2.IMWRITE_WEBP_QUALITY, quality or ENCODE_WEBP_QUALITY])
+    else:
+        if img.ndim == 2:
+            pil = Image.fromarray(img)
+        else:
+            pil = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA if img.shape[2] == 4 else cv2.COLOR_BGR2RGB))
+        out = io.BytesIO()
+        pil.save(out, "AVIF", quality=quality or ENCODE_AVIF_QUALITY, max_threads=ENCODE_THREADS)
+        return out.getvalue(), fmt
+    if not ok:
+        raise EncodingError(f"{fmt} encoding failed")
+    return buf.tobytes(), fmt
+
+
+def process(data: bytes, fmt: str, timer: StageTimer) -> Tuple[bytes, dict, dict]:
+    """
+    The raster counterpart of svg_optimize.process: (data, {}, stats) for a pipeline's encoded
+    output, where stats (conversions.output_stats) holds the format, size and encode time taken
+    from the timer's "encode" stage (None when encoding was part of a tiled upscale).
+    """
+    encode_seconds = timer.stages.get("encode")
+    stats = {"format": fmt, "bytes": len(data),
+             "encode_seconds": round(encode_seconds, 4) if encode_seconds is not None else None}
+    try:
+        from app.features.conversion import tiled_io  # imports this module; tiled outputs exceed PIL's default limit
+
+        stats["width"], stats["height"] = tiled_io.image_size(io.BytesIO(data))
+        stats["bits_per_pixel"] = round(len(data) * 8 / (stats["width"] * stats["height"]), 3)
+    except Exception:
+        pass  # a format this Pillow cannot read back (avif without libavif) keeps the rest
+
+    metrics.RASTER_BYTES.labels(format=fmt).inc(len(data))
+    if encode_seconds is not None:
+        metrics.ENCODE_SECONDS.labels(format=fmt).observe(encode_seconds)
+    # already compressed: no gzip/br variants
+    return data, {}, stats
@@ -3,76 +3,103 @@ import os
 import cv2
 import torch
 from datetime import datetime
-from basicsr.archs.rrdbnet_arch import RRDBNet
-from realesrgan import RealESRGANer
 
+from app.features.conversion import encoding, tiled_io, upscalers
+from app.features.helpers.profiling import cpu_profile, torch_profile
+from app.features.helpers.timing import StageTimer
 
-def main():
+
+def build_parser():
     parser = argparse.ArgumentParser(description="Realistic Photo Upscaler using Real-ESRGAN")
     parser.add_argument("--input", type=str, required=True, help="Path to input image")
     parser.add_argument("--output", type=str, default="output", help="Output directory")
     parser.add_argument("--scale", type=int, default=4, help="Upscale factor (default: 4)")
-    parser.add_argument("--model_path", type=str, default="RealESRGAN_x4plus.pth",
-                        help="Path to the RealESRGAN_x4plus model (.pth)")
+    parser.add_argument("--tier", choices=upscalers.TIERS, default="x4plus",
+                        help="Upscaler: fast (interpolation), anime6b or x4plus Real-ESRGAN (default: x4plus)")
+    parser.add_argument("--model_path", type=str, default=None,
+                        help="Weights (.pth) for the ESRGAN tier (default: the tier's file in app/weights)")
     parser.add_argument("--base_name", type=str, default=None, help="Base name override for output file")
+    parser.add_argument("--format", choices=list(encoding.FORMATS) + ["source"], default="source",
+                        help="Output format (default: source, the input's format when supported, else png)")
+    parser.add_argument("--quality", type=int, default=None,
+                        help="webp/avif/jpeg quality 1-100 (default: ENCODE_*_QUALITY)")
+    parser.add_argument("--png_level", type=int, default=None,
+                        help="PNG compression level 0-9 (default: ENCODE_PNG_LEVEL)")
+    parser.add_argument("--timings_out", type=str, default=None, help="Write per-stage timings (JSON) here")
+    parser.add_argument("--profile_dir", type=str, default=None, help="Write CPU/torch profiles into this directory")
 
     # NEW: Tiling options
     parser.add_argument("--tile", type=int, default=1024,
                         help="Tile size for tiled upscaling (default: 1024). Set to 0 to disable.")
     parser.add_argument("--tile_pad", type=int, default=10,
                         help="Padding for each tile to avoid seams (default: 10).")
+    return parser
 
-    args = parser.parse_args()
+
+def main():
+    args = build_parser().parse_args()
 
     os.makedirs(args.output, exist_ok=True)
 
+    with cpu_profile(args.profile_dir, "enhance"):
+        upscale(args)
+
+
+def upscale(args):
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"🧠 Using device: {device}")
+    timer = StageTimer()
+
+    with timer.stage("load_model"):
+        # RRDBNet (6 or 23 blocks) in a tiled RealESRGANer, or the interpolation upsampler
+        upsampler = upscalers.load_upsampler(args.tier, device, args.tile, args.tile_pad, args.scale,
+                                             args.model_path)
+
+    filename = os.path.basename(args.input)
+    name, _ = os.path.splitext(filename)
+    base = args.base_name or name
+    ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+
+    fmt = encoding.format_for(filename) if args.format == "source" else args.format
 
-    # RRDBNet architecture for Real-ESRGAN
-    model = RRDBNet(
-        num_in_ch=3,
-        num_out_ch=3,
-        num_feat=64,
-        num_block=23,
-        num_grow_ch=32,
-        scale=args.scale
-    )
-
-    # Initialize RealESRGANer with tiling
-    upsampler = RealESRGANer(
-        scale=args.scale,
-        model_path=args.model_path,
-        model=model,
-        tile=args.tile,          # <<< tiling enabled
-        tile_pad=args.tile_pad,  # <<< tile padding
-        pre_pad=0,
-        half=not device == "cpu",
-        gpu_id=None if device == "cpu" else 0
-    )
-
-    img = cv2.imread(args.input, cv2.IMREAD_UNCHANGED)
+    if tiled_io.is_large(args.input):
+        # decoded to disk, upscaled tile by tile and streamed into a PNG (see tiled_io.py)
+        out_path = os.path.join(args.output, f"{base}_real_upscaled_{ts}.png")
+        print(f"🧩 Large input: tiled upscaling using {upscalers.MODEL_NAMES[args.tier]} (tile={args.tile}, pad={args.tile_pad})...")
+        if fmt != "png":
+            print(f"⚠️  Large outputs are always written as PNG, not {fmt}")
+        tiled_io.upscale_file(args.input, out_path, upsampler, args.scale, timer, upscalers.stage_name(args.tier),
+                              tile=args.tile or tiled_io.TILED_TILE, pad=args.tile_pad, png_level=args.png_level)
+        timer.dump(args.timings_out)
+        print(f"✅ Image successfully upscaled and saved to: {out_path}")
+        return out_path
+
+    with timer.stage("decode"):
+        img = cv2.imread(args.input, cv2.IMREAD_UNCHANGED)
     if img is None:
         print(f"❌ Failed to read image: {args.input}")
         return
 
-    print(f"🚀 Upscaling using RealESRGAN (tile={args.tile}, pad={args.tile_pad})...")
+    print(f"🚀 Upscaling using {upscalers.MODEL_NAMES[args.tier]} (tile={args.tile}, pad={args.tile_pad})...")
 
     try:
-        output, _ = upsampler.enhance(img, outscale=args.scale)
+        with timer.stage(upscalers.stage_name(args.tier)), torch_profile(args.profile_dir, "esrgan"):
+            output, _ = upsampler.enhance(img, outscale=args.scale)
     except RuntimeError as e:
         print("❌ Error during upscaling:", e)
         print("💡 Try using a smaller --tile value to avoid CUDA OOM (e.g., 256 or 128).")
         return
 
-    filename = os.path.basename(args.input)
-    name, ext = os.path.splitext(filename)
-    base = args.base_name or name
-    ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
-    out_path = os.path.join(args.output, f"{base}_real_upscaled_{ts}{ext}")
-    cv2.imwrite(out_path, output)
+    with timer.stage("encode"):
+        data, fmt = encoding.encode(output, fmt, args.quality, args.png_level)
+    out_path = os.path.join(args.output, f"{base}_real_upscaled_{ts}{encoding.FORMATS[fmt][1]}")
+    with timer.stage("write"):
+        with open(out_path, "wb") as f:
+            f.write(data)
+    timer.dump(args.timings_out)
 
     print(f"✅ Image successfully upscaled and saved to: {out_path}")
+    return out_path
 
 
 if __name__ == "__main__":
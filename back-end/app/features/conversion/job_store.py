@@ -0,0 +1,276 @@
+"""
+Shared conversion queue in the database, for running conversions on separate worker nodes.
+
+With CONVERSION_QUEUE=1 the API stays thin: /conversion/convert stores the upload in the images
+table (the blob store every node shares) plus a conversion_jobs row, and `python -m app.worker`
+processes (app/worker.py, any number of them on any node with the same DATABASE_URL) claim the
+jobs, run the pipeline and store the result as a regular conversions row. Without it nothing
+changes: the API runs pipelines itself.
+
+Leases:
+
+- claim:      a compare-and-set UPDATE turns a due queued job (or a running one whose lease ran
+              out) into running under this worker's id, with a lease of QUEUE_LEASE_SECONDS. The
+              WHERE clause repeats the "claimable" condition, so only one worker's UPDATE matches;
+              no SELECT ... FOR UPDATE is needed, and several processes on one SQLite file
+              behave like several nodes on PostgreSQL.
+- heartbeat:  every QUEUE_HEARTBEAT_SECONDS the worker extends its lease and stores the job's
+              progress (stage, ESRGAN tiles). A heartbeat that finds the lease taken over, or the
+              job flagged by a cancel request, stops the local run.
+- finish:     the conversion rows and the job's final state commit in one transaction, and only
+              while the lease is held, so a job whose lease was taken over is stored once.
+- retry:      a failed attempt goes back to the queue after QUEUE_RETRY_BACKOFF_SECONDS * 2^(n-1)
+              until max_attempts (QUEUE_MAX_ATTEMPTS) runs are used up. A worker that dies
+              mid-job stops heartbeating; once the lease expires another worker claims the job,
+              which counts as the next attempt.
+
+The waiting API request polls the row every QUEUE_POLL_SECONDS and answers like an inline
+conversion; with `Prefer: respond-async`, or after QUEUE_WAIT_SECONDS, it answers 202 with the
+job to poll at GET /conversion/queue/{id}.
+"""
+import asyncio
+import datetime as dt
+import os
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import Session
+
+from app.db import SessionLocal, models
+
+_TRUTHY = {"1", "true", "yes"}
+
+CONVERSION_QUEUE = os.getenv("CONVERSION_QUEUE", "0").lower() in _TRUTHY
+QUEUE_LEASE_SECONDS = float(os.getenv("QUEUE_LEASE_SECONDS", "60"))
+QUEUE_HEARTBEAT_SECONDS = float(os.getenv("QUEUE_HEARTBEAT_SECONDS", "10"))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+QUEUE_RETRY_BACKOFF_SECONDS = float(os.getenv("QUEUE_RETRY_BACKOFF_SECONDS", "5"))
+QUEUE_POLL_SECONDS = float(os.getenv("QUEUE_POLL_SECONDS", "0.5"))
+QUEUE_WAIT_SECONDS = float(os.getenv("QUEUE_WAIT_SECONDS", "600"))
+# due jobs a claim tries before giving up for this round (others may win the first ones)
+QUEUE_CLAIM_CANDIDATES = int(os.getenv("QUEUE_CLAIM_CANDIDATES", "8"))
+
+FINAL_STATES = {"done", "failed", "cancelled"}
+
+Job = models.ConversionJob
+
+
+def _now() -> dt.datetime:
+    return dt.datetime.utcnow()
+
+
+def _lease_end(now: dt.datetime) -> dt.datetime:
+    return now + dt.timedelta(seconds=QUEUE_LEASE_SECONDS)
+
+
+def _claimable(now: dt.datetime):
+    return and_(
+        Job.attempts < Job.max_attempts,
+        Job.cancel_requested.is_(False),
+        or_(
+            and_(Job.status == "queued", Job.available_at <= now),
+            and_(Job.status == "running", Job.lease_expires_at < now),
+        ),
+    )
+
+
+def _held(job_id: int, worker: str):
+    return and_(Job.id == job_id, Job.worker == worker, Job.status == "running")
+
+
+# -----------------------
+# API side
+# -----------------------
+
+def enqueue(db: Session, image_id: int, image_name: str, image_type: Optional[str], mode: str, params: dict,
+            preview: bool, job_id: Optional[str] = None) -> models.ConversionJob:
+    """Add a queued job for a stored image; does not commit."""
+    job = Job(
+        job_id=job_id,
+        image_id=image_id,
+        image_name=image_name,
+        image_type=image_type,
+        mode=mode,
+        params=params,
+        preview=preview,
+        status="queued",
+        attempts=0,
+        max_attempts=QUEUE_MAX_ATTEMPTS,
+        available_at=_now(),
+    )
+    db.add(job)
+    db.flush()
+    return job
+
+
+def get(db: Session, queue_id: int) -> Optional[models.ConversionJob]:
+    return db.get(Job, queue_id)
+
+
+def latest_for_job_id(db: Session, job_id: str) -> Optional[models.ConversionJob]:
+    """The most recent queued conversion posted with this client job_id."""
+    return db.query(Job).filter(Job.job_id == job_id).order_by(Job.id.desc()).first()
+
+
+def cancel(db: Session, job: models.ConversionJob) -> bool:
+    """
+    Cancel a queued job outright, or flag a running one for its worker (stopped at the next
+    heartbeat). Commits; False when the job has already finished.
+    """
+    if job.status in FINAL_STATES:
+        return False
+    updated = db.query(Job).filter(Job.id == job.id, Job.status == "queued").update(
+        {"status": "cancelled", "cancel_requested": True, "finished_at": _now()}, synchronize_session=False
+    )
+    if not updated:
+        updated = db.query(Job).filter(Job.id == job.id, Job.status == "running").update(
+            {"cancel_requested": True}, synchronize_session=False
+        )
+    db.commit()
+    db.refresh(job)
+    return bool(updated)
+
+
+def describe(job: models.ConversionJob) -> dict:
+    return {
+        "queue_id": job.id,
+        "job_id": job.job_id,
+        "mode": job.mode,
+        "preview": bool(job.preview),
+        "status": job.status,
+        "cancel_requested": bool(job.cancel_requested),
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "worker": job.worker,
+        "progress": job.progress,
+        "error": job.error,
+        "image_id": job.image_id,
+        "conversion_id": job.conversion_id,
+        "output_url": f"/conversion/output/{job.conversion_id}" if job.status == "done" and job.conversion_id else None,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def summary(db: Session) -> dict:
+    """Job counts by status, and the age of the oldest job still waiting."""
+    counts = dict(db.query(Job.status, func.count()).group_by(Job.status).all())
+    oldest = db.query(func.min(Job.created_at)).filter(Job.status == "queued").scalar()
+    waited = (_now() - oldest).total_seconds() if oldest is not None else None
+    return {
+        "enabled": CONVERSION_QUEUE,
+        "counts": {s: counts.get(s, 0) for s in ("queued", "running", "done", "failed", "cancelled")},
+        "oldest_queued_seconds": round(waited, 1) if waited is not None else None,
+        "workers": db.query(func.count(func.distinct(Job.worker))).filter(Job.status == "running").scalar(),
+    }
+
+
+def _status(queue_id: int) -> Tuple[str, Optional[int]]:
+    with SessionLocal() as db:
+        row = db.query(Job.status, Job.conversion_id).filter(Job.id == queue_id).first()
+    return (row.status, row.conversion_id) if row else ("failed", None)
+
+
+async def wait(queue_id: int, timeout: float = QUEUE_WAIT_SECONDS) -> Tuple[str, Optional[int]]:
+    """Poll until the job finishes or `timeout` passes; returns (status, conversion id)."""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        status, conversion_id = await asyncio.to_thread(_status, queue_id)
+        if status in FINAL_STATES or asyncio.get_running_loop().time() >= deadline:
+            return status, conversion_id
+        await asyncio.sleep(QUEUE_POLL_SECONDS)
+
+
+# -----------------------
+# Worker side
+# -----------------------
+
+def claim(worker: str, modes: Optional[Iterable[str]] = None) -> Optional[models.ConversionJob]:
+    """Lease the next due job to `worker` (a detached row), or None when there is none."""
+    now = _now()
+    with SessionLocal(expire_on_commit=False) as db:
+        q = db.query(Job.id).filter(_claimable(now))
+        if modes:
+            q = q.filter(Job.mode.in_(list(modes)))
+        candidates = [r.id for r in q.order_by(Job.available_at, Job.id).limit(QUEUE_CLAIM_CANDIDATES)]
+        for queue_id in candidates:
+            won = db.query(Job).filter(Job.id == queue_id, _claimable(now)).update(
+                {
+                    "status": "running",
+                    "worker": worker,
+                    "attempts": Job.attempts + 1,
+                    "lease_expires_at": _lease_end(now),
+                    "heartbeat_at": now,
+                    "started_at": func.coalesce(Job.started_at, now),
+                    "error": None,
+                },
+                synchronize_session=False,
+            )
+            db.commit()
+            if won:
+                return db.get(Job, queue_id)
+    return None
+
+
+def heartbeat(queue_id: int, worker: str, progress: Optional[dict] = None) -> Tuple[bool, bool]:
+    """Extend the lease and store `progress`; returns (lease still held, cancel requested)."""
+    now = _now()
+    with SessionLocal() as db:
+        values = {"heartbeat_at": now, "lease_expires_at": _lease_end(now)}
+        if progress is not None:
+            values["progress"] = progress
+        held = db.query(Job).filter(_held(queue_id, worker)).update(values, synchronize_session=False)
+        cancel_requested = db.query(Job.cancel_requested).filter(Job.id == queue_id).scalar()
+        db.commit()
+    return bool(held), bool(cancel_requested)
+
+
+def finish(db: Session, queue_id: int, worker: str, status: str, conversion_id: Optional[int] = None,
+           error: Optional[str] = None) -> bool:
+    """
+    Record the final state in the caller's transaction (next to the conversion rows); False when
+    the lease is no longer held, in which case the caller rolls back.
+    """
+    return bool(db.query(Job).filter(_held(queue_id, worker)).update(
+        {"status": status, "conversion_id": conversion_id, "error": error, "finished_at": _now(),
+         "lease_expires_at": None},
+        synchronize_session=False,
+    ))
+
+
+def retry_or_fail(queue_id: int, worker: str, attempts: int, max_attempts: int, error: str) -> Optional[str]:
+    """
+    After a failed attempt: requeue with backoff while attempts remain ("queued"), else "failed".
+    Returns the new status, or None when the lease was lost meanwhile.
+    """
+    now = _now()
+    with SessionLocal() as db:
+        if attempts < max_attempts:
+            delay = QUEUE_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1)
+            values = {"status": "queued", "worker": None, "lease_expires_at": None, "error": error,
+                      "available_at": now + dt.timedelta(seconds=delay)}
+        else:
+            values = {"status": "failed", "error": error, "finished_at": now, "lease_expires_at": None}
+        updated = db.query(Job).filter(_held(queue_id, worker)).update(values, synchronize_session=False)
+        db.commit()
+    return values["status"] if updated else None
+
+
+def expire_abandoned() -> int:
+    """Fail running jobs whose lease expired with no attempts left (their worker died each time)."""
+    now = _now()
+    with SessionLocal() as db:
+        expired = db.query(Job).filter(
+            Job.status == "running", Job.lease_expires_at < now, Job.attempts >= Job.max_attempts
+        ).update(
+            {"status": "failed", "error": "Worker lost on the final attempt", "finished_at": now,
+             "lease_expires_at": None},
+            synchronize_session=False,
+        )
+        # cancel requests for jobs whose worker is gone would otherwise never be answered
+        expired += db.query(Job).filter(
+            Job.status == "running", Job.lease_expires_at < now, Job.cancel_requested.is_(True)
+        ).update({"status": "cancelled", "finished_at": now, "lease_expires_at": None}, synchronize_session=False)
+        db.commit()
+    return expired
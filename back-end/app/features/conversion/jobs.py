@@ -0,0 +1,358 @@
+"""
+Progress reporting and cancellation for running conversions.
+
+A client that wants feedback sends a `job_id` (any token of its choosing, e.g. a UUID) with
+POST /conversion/convert and opens GET /conversion/jobs/{job_id}/events (Server-Sent Events)
+before or while the conversion runs. Events:
+
+- `state`:    queued | running
+- `stage`:    a pipeline stage started or finished (upload, decode, esrgan, trace, ...)
+- `progress`: ESRGAN tiles done / total, parsed from the Real-ESRGAN child's "Tile i/n" lines
+- `done`:     final status (done | failed | cancelled), with the conversion id or error
+
+A request coalesced with an identical running conversion (singleflight.py) receives that
+conversion's events, mirrored from the flight's own job.
+
+Past events are replayed to late subscribers (and after Last-Event-ID on reconnect).
+POST /conversion/jobs/{job_id}/cancel stops the job: stages that have not started are skipped,
+and pipeline child processes (the ESRGAN scripts with their vtracer child, potrace) are killed
+as a process group, so the worker thread is free again right away.
+
+Child processes report stages through StageTimer's progress lines (PROGRESS_ENV). Jobs live in
+this process only: with several uvicorn workers the events endpoint needs sticky routing.
+Finished jobs are kept for JOB_TTL_SECONDS for late subscribers.
+"""
+import asyncio
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from app import metrics
+from app.features.helpers.timing import PROGRESS_ENV, PROGRESS_PREFIX
+
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "300"))
+JOB_KILL_GRACE_SECONDS = float(os.getenv("JOB_KILL_GRACE_SECONDS", "3"))
+JOB_KEEPALIVE_SECONDS = float(os.getenv("JOB_KEEPALIVE_SECONDS", "15"))
+
+JOB_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# printed by RealESRGANer.tile_process for every tile
+_TILE_LINE = re.compile(r"^\s*Tile (\d+)/(\d+)\s*$")
+
+ACTIVE_STATES = {"queued", "running"}
+FINAL_STATES = {"done", "failed", "cancelled"}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """Event log + cancellation flag for one conversion; safe to use from any thread."""
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.mode: Optional[str] = None
+        self.state = "pending"  # subscribed to, not started yet
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.current_stage: Optional[str] = None
+        self.events: List[dict] = []
+        self._subscribers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+        self._processes: List[subprocess.Popen] = []
+        self._mirrors: List["Job"] = []
+        self._cancel_callbacks: List[Callable[[], None]] = []
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    # -- events --
+
+    def publish(self, kind: str, **data):
+        with self._lock:
+            event = {"id": len(self.events) + 1, "event": kind, "data": {**data, "t": round(time.time() - self.created, 3)}}
+            self.events.append(event)
+            subscribers = list(self._subscribers)
+            mirrors = list(self._mirrors) if kind != "done" else []
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:  # subscriber's loop already closed
+                pass
+        for mirror in mirrors:
+            mirror._mirrored(kind, data)
+
+    def _mirrored(self, kind: str, data: dict):
+        if kind == "state":
+            self.set_state(data["state"])
+            return
+        if kind == "stage" and data["phase"] == "start":
+            self.current_stage = data["stage"]
+        self.publish(kind, **data)
+
+    def mirror_to(self, job: "Job"):
+        """Republish this job's progress (everything but `done`) on `job`, starting from its current stage."""
+        with self._lock:
+            self._mirrors.append(job)
+        if self.state == "running":
+            job.set_state("running")
+        if self.current_stage:
+            job._mirrored("stage", {"stage": self.current_stage, "phase": "start"})
+
+    def subscribe(self, after: int = 0) -> Tuple[List[dict], asyncio.Queue]:
+        """Events after `after` so far, plus a queue receiving every later one."""
+        queue: asyncio.Queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers.append((asyncio.get_running_loop(), queue))
+            return [e for e in self.events if e["id"] > after], queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers = [(loop, q) for loop, q in self._subscribers if q is not queue]
+
+    def set_state(self, state: str, **data):
+        if self.state in FINAL_STATES:
+            return
+        self.state = state
+        if state in FINAL_STATES:
+            self.finished = time.time()
+            if state == "cancelled":
+                metrics.CONVERSIONS_CANCELLED.labels(mode=self.mode or "unknown").inc()
+            self.publish("done", status=state, **data)
+        else:
+            self.publish("state", state=state, **data)
+
+    def on_stage(self, stage: str, phase: str):
+        """StageTimer listener: publishes the stage and refuses to start new ones once cancelled."""
+        if phase == "start":
+            self.check()
+            self.current_stage = stage
+        self.publish("stage", stage=stage, phase=phase)
+
+    def on_tile(self, done: int, total: int):
+        self.publish("progress", stage=self.current_stage or "esrgan", done=done, total=total,
+                     fraction=round(done / total, 4) if total else None)
+
+    def snapshot(self) -> dict:
+        last_progress = next((e["data"] for e in reversed(self.events) if e["event"] == "progress"), None)
+        return {
+            "job_id": self.id,
+            "mode": self.mode,
+            "state": self.state,
+            "stage": self.current_stage,
+            "progress": last_progress,
+            "events": len(self.events),
+        }
+
+    # -- cancellation --
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled(f"Job {self.id} cancelled")
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """Call `callback` (from the cancelling thread) when the job is cancelled, or now if it already is."""
+        with self._lock:
+            if not self.cancelled:
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self) -> bool:
+        """Request cancellation; returns False when the job has already finished."""
+        if self.state in FINAL_STATES:
+            return False
+        with self._lock:
+            self._cancelled.set()
+            processes = list(self._processes)
+            callbacks = list(self._cancel_callbacks)
+        for process in processes:
+            _terminate(process)
+        for callback in callbacks:
+            callback()
+        if self.state == "pending":
+            self.set_state("cancelled")
+        return True
+
+    def attach(self, process: subprocess.Popen):
+        with self._lock:
+            self._processes.append(process)
+        if self.cancelled:  # cancelled while the process was starting
+            _terminate(process)
+
+    def detach(self, process: subprocess.Popen):
+        with self._lock:
+            self._processes = [p for p in self._processes if p is not process]
+
+
+_jobs: Dict[str, Job] = {}
+_jobs_lock = threading.Lock()
+_local = threading.local()
+
+
+def _purge_expired(now: float):
+    for job_id, job in list(_jobs.items()):
+        age = now - (job.finished or job.created)
+        if (job.finished or job.state == "pending") and age > JOB_TTL_SECONDS:
+            del _jobs[job_id]
+
+
+def get(job_id: str) -> Optional[Job]:
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def get_or_create(job_id: str) -> Job:
+    """Existing job or a pending one, so events can be subscribed to before the conversion starts."""
+    with _jobs_lock:
+        _purge_expired(time.time())
+        job = _jobs.get(job_id)
+        if job is None:
+            job = _jobs[job_id] = Job(job_id)
+        return job
+
+
+def start(job_id: str, mode: str) -> Optional[Job]:
+    """
+    Register a conversion under `job_id`; None when that id is taken by another conversion. A job
+    cancelled while still pending is returned as is (the caller checks `cancelled`).
+    """
+    with _jobs_lock:
+        _purge_expired(time.time())
+        job = _jobs.get(job_id)
+        if job is not None and (job.state in ACTIVE_STATES or (job.finished and not job.cancelled)):
+            return None
+        if job is None:
+            job = _jobs[job_id] = Job(job_id)
+        job.mode = mode
+        if not job.cancelled:
+            job.set_state("queued", mode=mode)
+    return job
+
+
+def current() -> Optional[Job]:
+    """Job of the conversion running on this thread, if any."""
+    return getattr(_local, "job", None)
+
+
+@contextmanager
+def activate(job: Optional[Job]) -> Iterator[Optional[Job]]:
+    """Mark `job` running on this (executor) thread; raises JobCancelled if it was cancelled while queued."""
+    if job is None:
+        yield None
+        return
+    job.check()
+    job.set_state("running")
+    _local.job = job
+    try:
+        yield job
+    finally:
+        _local.job = None
+
+
+# -----------------------
+# Child processes
+# -----------------------
+
+def _terminate(process: subprocess.Popen):
+    """SIGTERM the process group, SIGKILL it if still alive after JOB_KILL_GRACE_SECONDS."""
+    def send(sig):
+        if process.poll() is not None:
+            return
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, sig)
+            else:  # pragma: no cover - non-POSIX
+                process.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    send(signal.SIGTERM)
+    killer = threading.Timer(JOB_KILL_GRACE_SECONDS, send, args=(getattr(signal, "SIGKILL", signal.SIGTERM),))
+    killer.daemon = True
+    killer.start()
+
+
+def _relay(line: str, job: Job):
+    """Forward a child's stdout line to the log and turn progress lines into job events."""
+    if line.startswith(PROGRESS_PREFIX):
+        try:
+            update = json.loads(line[len(PROGRESS_PREFIX):])
+            job.publish("stage", stage=update["stage"], phase=update["phase"])
+            if update["phase"] == "start":
+                job.current_stage = update["stage"]
+        except (ValueError, KeyError):
+            pass
+        return
+    sys.stdout.write(line)
+    m = _TILE_LINE.match(line)
+    if m:
+        job.on_tile(int(m.group(1)), int(m.group(2)))
+
+
+def run_process(cmd: List[str], job: Optional[Job] = None):
+    """
+    subprocess.run(cmd, check=True) that the current job (if any) can cancel. The child runs in
+    its own session so grandchildren go down with it, and its stdout is relayed line by line.
+    Raises JobCancelled when the job was cancelled while the child ran.
+    """
+    job = job or current()
+    if job is None:
+        subprocess.run(cmd, check=True)
+        return
+    job.check()
+    env = {**os.environ, PROGRESS_ENV: "1", "PYTHONUNBUFFERED": "1"}
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, env=env,
+        start_new_session=hasattr(os, "killpg"),
+    )
+    job.attach(process)
+    try:
+        for line in process.stdout:
+            _relay(line, job)
+        returncode = process.wait()
+    finally:
+        job.detach(process)
+        process.stdout.close()
+    if job.cancelled:
+        raise JobCancelled(f"Job {job.id} cancelled")
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+# -----------------------
+# Server-Sent Events
+# -----------------------
+
+def _sse(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+async def stream(job: Job, after: int = 0):
+    """SSE body: replayed events, then live ones until the job finishes (keepalive comments in between)."""
+    backlog, queue = job.subscribe(after)
+    try:
+        for event in backlog:
+            yield _sse(event)
+            if event["event"] == "done":
+                return
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=JOB_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield _sse(event)
+            if event["event"] == "done":
+                return
+    finally:
+        job.unsubscribe(queue)
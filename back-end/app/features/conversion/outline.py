@@ -1,18 +1,27 @@
 import argparse
 import os
-import subprocess
 import cv2
 import numpy as np
 from datetime import datetime
+
+from app.features.conversion import jobs, tiled_io, tiled_outline, tracers
+from app.features.helpers.timing import StageTimer
 
-def detect_edges(image_path, low_threshold=100, high_threshold=200):
+def blur_image(image_path):
     img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
     if img is None:
         raise FileNotFoundError(f"Failed to read image: {image_path}")
 
     # Use Gaussian blur before Canny to reduce noise
-    blurred = cv2.GaussianBlur(img, (5, 5), 0)
+    return cv2.GaussianBlur(img, (5, 5), 0)
+
+
+def detect_edges(image_path, low_threshold=100, high_threshold=200):
+    return edges_from_blurred(blur_image(image_path), low_threshold, high_threshold)
+
 
+def edges_from_blurred(blurred, low_threshold=100, high_threshold=200):
+    """Canny on an already blurred grayscale image (see blur_image); reused across threshold sweeps."""
     # Apply Canny edge detection
     edges = cv2.Canny(blurred, low_threshold, high_threshold)
 
@@ -30,34 +39,14 @@ def save_as_pbm(edge_img, temp_path):
     height, width = edge_img.shape
     with open(temp_path, 'wb') as f:
         f.write(f"P4\n{width} {height}\n".encode())
-        for y in range(height):
-            row = edge_img[y]
-            byte = 0
-            bits_count = 0
-            for pixel in row:
-                bit = 0 if pixel == 255 else 1  # PBM: 1 = black, 0 = white
-                byte = (byte << 1) | bit
-                bits_count += 1
-                if bits_count == 8:
-                    f.write(bytes([byte]))
-                    byte = 0
-                    bits_count = 0
-            if bits_count > 0:
-                byte <<= (8 - bits_count)
-                f.write(bytes([byte]))
-
-
-def potrace_to_svg(pbm_path, svg_path):
-    cmd = [
-        "potrace",
-        pbm_path,
-        "--svg",
-        "--flat",
-        "--longcoding",
-        "--opttolerance", "0.2",
-        "-o", svg_path
-    ]
-    subprocess.run(cmd, check=True)
+        # PBM: 1 = black, 0 = white; each row is padded with 0 bits to a whole byte
+        f.write(np.packbits(edge_img != 255, axis=1).tobytes())
+
+
+def potrace_to_svg(pbm_path, svg_path, job=None):
+    # killed with its job on cancellation when run from the API (plain subprocess.run otherwise);
+    # tile threads pass the conversion's job explicitly
+    tracers.get("potrace-cli").trace(pbm_path, svg_path, {}, job)
 
 def safe_svg_path(output_dir, base_name):
     os.makedirs(output_dir, exist_ok=True)
@@ -70,7 +59,9 @@ def safe_svg_path(output_dir, base_name):
     return path
 
 
-def process_image(image_path, output_dir, low, high, preview=False, base_name_override=None):
+def process_image(image_path, output_dir, low, high, preview=False, base_name_override=None, timer=None,
+                  tracer=None):
+    timer = timer or StageTimer()
     base_name = base_name_override or os.path.splitext(os.path.basename(image_path))[0]
     temp_pbm = os.path.join(output_dir, f"{base_name}_temp_edges.pbm")
     final_svg = safe_svg_path(output_dir, base_name)
@@ -78,15 +69,39 @@ def process_image(image_path, output_dir, low, high, preview=False, base_name_ov
     print(f"🔍 Processing: {image_path}")
     print(f"✨ Detecting edges using Canny({low}, {high})...")
 
-    edges = detect_edges(image_path, low, high)
-    save_as_pbm(edges, temp_pbm)
-
-    if preview:
-        cv2.imwrite(os.path.join(output_dir, f"{base_name}_edge_preview.png"), edges)
-        print(f"👀 Preview saved: {base_name}_edge_preview.png")
-
-    print("✏️ Vectorizing with Potrace (outline mode)...")
-    potrace_to_svg(temp_pbm, final_svg)
+    if tiled_io.is_large(image_path):
+        # decoded to disk and Canny'd tile by tile; PBM rows are written as each band finishes
+        with timer.stage("edges"):
+            tiled_io.edges_to_pbm(image_path, temp_pbm, low, high)
+        if preview:
+            print("👀 No edge preview for tiled inputs; the PBM is kept instead")
+    else:
+        with timer.stage("edges"):
+            edges = detect_edges(image_path, low, high)
+        with timer.stage("encode"):
+            save_as_pbm(edges, temp_pbm)
+
+        if preview:
+            cv2.imwrite(os.path.join(output_dir, f"{base_name}_edge_preview.png"), edges)
+            print(f"👀 Preview saved: {base_name}_edge_preview.png")
+
+    # see tracers.py; None uses TRACER_OUTLINE
+    tracer = tracers.resolve("outline", tracer)
+    backend = tracers.get(tracer)
+
+    def trace(pbm_path, svg_path, job=None):
+        backend.trace(pbm_path, svg_path, {}, job)
+
+    width, height, _ = tiled_outline.pbm_header(temp_pbm)
+    if tiled_outline.use_tiles(width, height):
+        print(f"✏️ Vectorizing with {tracer} (outline mode, {tiled_outline.OUTLINE_TRACE_WORKERS} workers)...")
+        with timer.stage("trace"):
+            tiles = tiled_outline.trace(temp_pbm, final_svg, trace, job=jobs.current())
+        print(f"🧩 Merged {tiles} tiles")
+    else:
+        print(f"✏️ Vectorizing with {tracer} (outline mode)...")
+        with timer.stage("trace"):
+            trace(temp_pbm, final_svg)
 
     if not preview:
         os.remove(temp_pbm)
@@ -102,6 +117,8 @@ def main():
     parser.add_argument("--high", type=int, default=200, help="Canny high threshold")
     parser.add_argument("--preview", action="store_true", help="Keep PBM & save PNG edge preview")
     parser.add_argument("--base_name", default=None, help="Base name override for outputs")
+    parser.add_argument("--tracer", default=None, choices=["auto", *tracers.PREFERENCE["outline"]],
+                        help="Tracer backend (default: TRACER_OUTLINE, auto)")
     args = parser.parse_args()
 
     valid_exts = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
@@ -110,11 +127,12 @@ def main():
         for file in sorted(os.listdir(args.input)):
             full_path = os.path.join(args.input, file)
             if file.lower().endswith(valid_exts):
-                process_image(full_path, args.output, args.low, args.high, args.preview, args.base_name)
+                process_image(full_path, args.output, args.low, args.high, args.preview, args.base_name,
+                              tracer=args.tracer)
     else:
         if not args.input.lower().endswith(valid_exts):
             raise ValueError("Unsupported image format")
-        process_image(args.input, args.output, args.low, args.high, args.preview, args.base_name)
+        process_image(args.input, args.output, args.low, args.high, args.preview, args.base_name, tracer=args.tracer)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,268 @@
+"""
+Conversion pipelines used by the API. Each runner turns `input_path` into one output file inside
+`output_dir` (a per-request directory) and records per-stage timings on the given StageTimer.
+
+ESRGAN-backed modes run the CLI scripts as `python -m ...` child processes so model memory is
+released after every request; the scripts report their own stages back through --timings_out.
+
+The API runs pipelines on EXECUTOR (CONVERSION_WORKERS threads) so they never block the event
+loop; the DB pool in app.db is sized from the same setting. Child processes are started through
+jobs.run_process, so a conversion with a job id reports their progress and can be cancelled.
+
+PREVIEW_PIPELINES are the preview=true variants (see preview.py): vectorize/outline on a
+downscaled proxy, without ESRGAN, in a few hundred milliseconds.
+
+`params["upscale_tier"]` selects the upscaler of enhance and of the vectorize pre-pass (see
+upscalers.py). Enhance on the fast tier needs neither torch nor weights and runs in-process,
+handing back the encoded bytes instead of writing them out.
+Enhance output is encoded as `params["output_format"]` (png/webp/avif/jpeg, negotiated by the
+router) at `params["quality"]` / `params["png_level"]` when given (see encoding.py).
+`params["tracer"]` is the vectorize/outline tracer backend (tracers.py), already resolved.
+"""
+import json
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple, Union
+
+import cv2
+
+from app import metrics
+from app.db import CONVERSION_WORKERS
+from app.features.conversion import encoding, jobs, preview, svg_optimize, tiled_io, tracers, upscalers
+from app.features.helpers import profiling
+from app.features.helpers.timing import StageTimer
+
+EXECUTOR = ThreadPoolExecutor(max_workers=CONVERSION_WORKERS, thread_name_prefix="conversion")
+
+# (output file, mime type), or with the output bytes when the runner already holds them (the
+# file is then not written and only names the output)
+PipelineResult = Union[Tuple[Path, str], Tuple[Path, str, bytes]]
+# (output file name, mime type, output bytes, {content coding: body}, output_stats, upscale tier that ran)
+ExecutionResult = Tuple[Path, str, bytes, dict, Optional[dict], Optional[str]]
+OUTPUT_ROOT = Path("app/output")
+
+
+def _run_script(module: str, args: list, timer: StageTimer, model: Optional[str] = None,
+                profile_dir: Optional[str] = None):
+    """
+    Run `python -m <module> ...` and merge the stage timings it writes. Whatever wall time the
+    child does not account for (interpreter start, torch import) is recorded as "startup", and a
+    reported "load_model" stage is exported as the model's load time. With `profile_dir` the
+    child writes its CPU/torch profiles there.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+        timings_path = Path(tmp.name)
+    if profile_dir:
+        args = [*args, "--profile_dir", profile_dir]
+    start = time.perf_counter()
+    metrics.SUBPROCESS_SPAWNS.labels(tool="python").inc()
+    try:
+        jobs.run_process([sys.executable, "-m", module, *args, "--timings_out", str(timings_path)])
+    finally:
+        wall = time.perf_counter() - start
+        child = StageTimer()
+        if timings_path.exists() and timings_path.stat().st_size:
+            child.merge(json.loads(timings_path.read_text()))
+        timings_path.unlink(missing_ok=True)
+        timer.merge(child.stages)
+        timer.add("startup", wall - child.total())
+        if model and "load_model" in child.stages:
+            metrics.MODEL_LOAD_SECONDS.labels(model=model).observe(child.stages["load_model"])
+
+
+def _single_output(output_dir: Path, suffixes: set, what: str) -> Path:
+    files = [f for f in output_dir.iterdir() if f.suffix.lower() in suffixes]
+    if not files:
+        raise RuntimeError(f"No {what} output generated.")
+    return max(files, key=lambda f: f.stat().st_mtime)
+
+
+def _outline_processor():
+    try:
+        from app.features.conversion.outline import process_image as outline_process
+    except ImportError:
+        outline_process = None
+
+    if outline_process is None:
+        raise RuntimeError("Outline processor not available")
+    return outline_process
+
+
+def run_vectorize(input_path: Path, output_dir: Path, base_name: str, params: dict, timer: StageTimer,
+                  profile_dir: Optional[str] = None) -> PipelineResult:
+    tier = params.get("upscale_tier", upscalers.DEFAULT_TIER["vectorize"])
+    tracer = params.get("tracer") or tracers.resolve("vectorize")
+    args = [
+        "--input", str(input_path),
+        "--output", str(output_dir),
+        "--base_name", base_name,
+        "--hierarchical", params["hierarchical"],
+        "--filter_speckle", str(params["filter_speckle"]),
+        "--color_precision", str(params["color_precision"]),
+        "--gradient_step", str(params["gradient_step"]),
+        "--mode", params["mode"],
+        "--upscale_tier", tier,
+        "--tracer", tracer,
+    ]
+    if params.get("preset"):
+        args.extend(["--preset", params["preset"]])
+    if params["mode"] == "spline":
+        args.extend(
+            [
+                "--corner_threshold", str(params["corner_threshold"]),
+                "--segment_length", str(params["segment_length"]),
+                "--splice_threshold", str(params["splice_threshold"]),
+            ]
+        )
+    if tracers.get(tracer).tool:
+        # started by the child; its own metrics are not exported
+        metrics.SUBPROCESS_SPAWNS.labels(tool=tracers.get(tracer).tool).inc()
+    _run_script("app.features.conversion.vectorization", args, timer, model=upscalers.MODEL_NAMES[tier],
+                profile_dir=profile_dir)
+    return _single_output(output_dir, {".svg"}, "SVG"), "image/svg+xml"
+
+
+def prepare_vectorize_raster(input_path: Path, output_dir: Path, timer: StageTimer,
+                             profile_dir: Optional[str] = None) -> Path:
+    """The raster run_vectorize would hand to vtracer (ESRGAN-upscaled when blurry), without tracing it."""
+    raster = output_dir / "vectorize_raster.png"
+    args = ["--input", str(input_path), "--output", str(output_dir), "--raster_out", str(raster)]
+    _run_script("app.features.conversion.vectorization", args, timer, model="RealESRGAN_x4plus_anime_6B",
+                profile_dir=profile_dir)
+    return raster
+
+
+def run_outline(input_path: Path, output_dir: Path, base_name: str, params: dict, timer: StageTimer,
+                profile_dir: Optional[str] = None) -> PipelineResult:
+    # runs in-process, so the caller's CPU profile already covers it
+    outline_process = _outline_processor()
+    outline_process(
+        str(input_path), str(output_dir), params["low"], params["high"], base_name_override=base_name, timer=timer,
+        tracer=params.get("tracer"),
+    )
+    return _single_output(output_dir, {".svg"}, "outline SVG"), "image/svg+xml"
+
+
+def run_vectorize_preview(input_path: Path, output_dir: Path, base_name: str, params: dict, timer: StageTimer,
+                          profile_dir: Optional[str] = None) -> PipelineResult:
+    proxy, size = preview.make_proxy(input_path, output_dir, timer)
+    svg_path = output_dir / f"{base_name}_vectorized_preview.svg"
+    with timer.stage("trace"):
+        tracers.get(params.get("tracer") or tracers.resolve("vectorize")).trace(proxy, svg_path, params)
+    preview.fit_to(svg_path, size)
+    return svg_path, "image/svg+xml"
+
+
+def run_outline_preview(input_path: Path, output_dir: Path, base_name: str, params: dict, timer: StageTimer,
+                        profile_dir: Optional[str] = None) -> PipelineResult:
+    outline_process = _outline_processor()
+    proxy, size = preview.make_proxy(input_path, output_dir, timer)
+    outline_process(
+        str(proxy), str(output_dir), params["low"], params["high"], base_name_override=base_name, timer=timer,
+        tracer=params.get("tracer"),
+    )
+    svg_path = _single_output(output_dir, {".svg"}, "outline SVG")
+    preview.fit_to(svg_path, size)
+    return svg_path, "image/svg+xml"
+
+
+def _enhance_in_process(input_path: Path, output_dir: Path, base_name: str, params: dict,
+                        timer: StageTimer) -> PipelineResult:
+    """
+    The fast tier of enhance.upscale, without the child process (and its torch import). The
+    encoded output is returned in memory; only tiled (large) inputs write it to `output_dir`.
+    """
+    with timer.stage("load_model"):
+        upsampler = upscalers.load_upsampler("fast", "cpu", tile=0, tile_pad=0)
+    if tiled_io.is_large(input_path):
+        out_path = output_dir / f"{base_name}_real_upscaled.png"
+        tiled_io.upscale_file(input_path, out_path, upsampler, upsampler.scale, timer, upscalers.stage_name("fast"),
+                              png_level=params.get("png_level"))
+        return out_path, encoding.FORMATS["png"][0]
+    with timer.stage("decode"):
+        img = cv2.imread(str(input_path), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise RuntimeError(f"Failed to read image: {input_path.name}")
+    with timer.stage(upscalers.stage_name("fast")):
+        output, _ = upsampler.enhance(img)
+    with timer.stage("encode"):
+        data, fmt = encoding.encode(output, params.get("output_format", encoding.ENCODE_DEFAULT_FORMAT),
+                                    params.get("quality"), params.get("png_level"))
+    mime, extension = encoding.FORMATS[fmt]
+    return output_dir / f"{base_name}_real_upscaled{extension}", mime, data
+
+
+def run_enhance(input_path: Path, output_dir: Path, base_name: str, params: dict, timer: StageTimer,
+                profile_dir: Optional[str] = None) -> PipelineResult:
+    tier = params.get("upscale_tier", upscalers.DEFAULT_TIER["enhance"])
+    if tier == "fast":
+        return _enhance_in_process(input_path, output_dir, base_name, params, timer)
+    args = [
+        "--input", str(input_path),
+        "--output", str(output_dir),
+        "--tier", tier,
+        "--model_path", upscalers.WEIGHTS[tier],
+        "--base_name", base_name,
+        "--format", params.get("output_format", encoding.ENCODE_DEFAULT_FORMAT),
+    ]
+    for name in ("quality", "png_level"):
+        if params.get(name) is not None:
+            args += [f"--{name}", str(params[name])]
+    _run_script("app.features.conversion.enhance", args, timer, model=upscalers.MODEL_NAMES[tier],
+                profile_dir=profile_dir)
+    output_path = _single_output(output_dir, set(encoding.EXTENSIONS), "upscaled image")
+    return output_path, encoding.FORMATS[encoding.format_for(output_path.name)][0]
+
+
+PIPELINES: Dict[str, Callable[..., PipelineResult]] = {
+    "vectorize": run_vectorize,
+    "outline": run_outline,
+    "enhance": run_enhance,
+}
+
+PREVIEW_PIPELINES: Dict[str, Callable[..., PipelineResult]] = {
+    "vectorize": run_vectorize_preview,
+    "outline": run_outline_preview,
+}
+
+
+def execute(mode: str, use_preview: bool, source: bytes, base_name: str, params: dict, timer: StageTimer,
+            profile_dir: Optional[str] = None) -> ExecutionResult:
+    """
+    Run the mode's pipeline on the uploaded bytes `source` in a private output directory, then
+    minify/pre-compress SVGs (svg_optimize) or describe rasters (encoding). Blocking; the API
+    calls it on EXECUTOR (once per singleflight flight), queue workers on their own threads.
+    Temporary files are gone when it returns; the returned path only names the output.
+    """
+    run_pipeline = (PREVIEW_PIPELINES if use_preview else PIPELINES)[mode]
+    with timer.stage("upload"):
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
+            tmp.write(source)
+            tmp_path = Path(tmp.name)
+    OUTPUT_ROOT.mkdir(parents=True, exist_ok=True)
+    # one directory per run so concurrent conversions never pick up each other's files
+    output_dir = Path(tempfile.mkdtemp(dir=OUTPUT_ROOT))
+    try:
+        with metrics.CONVERSIONS_IN_FLIGHT.labels(mode=mode).track_inprogress(), \
+                profiling.cpu_profile(profile_dir, "convert"):
+            path, mime, *held = run_pipeline(tmp_path, output_dir, base_name, params, timer,
+                                             profile_dir=profile_dir)
+            # the vectorize gate may have skipped the upscale altogether
+            ran_tier = params.get("upscale_tier")
+            if ran_tier and upscalers.stage_name(ran_tier) not in timer.stages:
+                ran_tier = "none"
+            if held:
+                data = held[0]
+            else:
+                with timer.stage("read_output"):
+                    data = path.read_bytes()
+            if mime == svg_optimize.SVG_MIME:
+                return (path, mime, *svg_optimize.process(data, timer), ran_tier)
+            return (path, mime, *encoding.process(data, encoding.format_for(path.name), timer), ran_tier)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        tmp_path.unlink(missing_ok=True)
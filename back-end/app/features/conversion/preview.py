@@ -0,0 +1,78 @@
+"""
+Low-resolution previews for tuning conversion parameters.
+
+POST /conversion/convert with preview=true runs vectorize/outline on a proxy of the upload whose
+longest side is at most PREVIEW_MAX_SIDE (768) px and never takes the ESRGAN branch: the tracer
+runs directly instead of through the vectorization script, so there is no interpreter/torch
+start-up either. The SVG's viewBox stays in proxy coordinates while width/height are set to
+the original size, so the preview lays over the full image exactly like the final result.
+
+Parameters are scale dependent (filter_speckle counts pixels, Canny thresholds react to
+resampling), so a preview approximates the full-resolution output rather than reproducing it.
+Once the client settles on parameters it posts the same request without preview, passing the
+`image_id` returned with the preview (X-Image-Id) instead of uploading the file again.
+"""
+import os
+import re
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Tuple
+
+from PIL import Image
+
+from app.features.conversion import svg_optimize  # noqa: F401 - registers the SVG namespace for ET
+from app.features.conversion import tiled_io
+from app.features.helpers.timing import StageTimer
+
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "768"))
+
+Size = Tuple[int, int]
+
+_LENGTH = re.compile(r"^\s*([0-9.]+)\s*([a-z%]*)")
+
+
+def make_proxy(input_path: Path, output_dir: Path, timer: StageTimer, max_side: int = PREVIEW_MAX_SIDE) -> Tuple[Path, Size]:
+    """
+    Downscaled PNG copy of the input (the input itself when it is already small enough) and the
+    original (width, height). Inputs above TILED_MIN_MEGAPIXELS are reduced band by band from a
+    disk-backed decode (tiled_io.read_downscaled; alpha is dropped).
+    """
+    with timer.stage("downscale"):
+        if tiled_io.is_large(input_path):
+            reduced, _, size = tiled_io.read_downscaled(input_path, max_side)
+            proxy = output_dir / "preview_proxy.png"
+            Image.fromarray(reduced[..., ::-1]).save(proxy, format="PNG", compress_level=1)
+            return proxy, size
+        with Image.open(input_path) as img:
+            size = img.size
+            if max(size) <= max_side:
+                return input_path, size
+            img.draft("RGB", (max_side, max_side))  # JPEG: decode at reduced scale
+            if img.mode not in ("RGB", "RGBA", "L"):
+                img = img.convert("RGBA" if "A" in img.getbands() or img.mode == "P" else "RGB")
+            img.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+            proxy = output_dir / "preview_proxy.png"
+            img.save(proxy, format="PNG", compress_level=1)
+    return proxy, size
+
+
+def _length(value) -> Tuple[float, str]:
+    m = _LENGTH.match(value or "")
+    return (float(m.group(1)), m.group(2)) if m else (0.0, "")
+
+
+def fit_to(svg_path: Path, size: Size):
+    """
+    Set the SVG's display size to the original image's, keeping proxy coordinates in the viewBox.
+    The tracer's unit is kept (potrace writes pt), so the preview matches the full-size output.
+    """
+    tree = ET.parse(svg_path)
+    root = tree.getroot()
+    (width, unit), (height, _) = _length(root.get("width")), _length(root.get("height"))
+    if "viewBox" not in root.attrib:
+        if not (width and height):
+            return
+        root.set("viewBox", f"0 0 {width:g} {height:g}")
+    root.set("width", f"{size[0]}{unit}")
+    root.set("height", f"{size[1]}{unit}")
+    tree.write(svg_path, encoding="utf-8", xml_declaration=False)
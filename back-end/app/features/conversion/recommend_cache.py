@@ -0,0 +1,97 @@
+"""
+Recommendations reused by image content.
+
+Stored images carry the sha256 of their bytes (images.content_hash) and recommendations the
+versions of the code that produced them (recommend_settings.METADATA_VERSION and
+HEURISTICS_VERSION). /conversion/recommend answers a repeat upload of the same bytes from the
+newest recommendation of an image with that hash, without decoding the image or running CLIP,
+and GET /conversion/recommend/{image_id} answers from the image's own one. An entry with an
+older metadata version does not count; one whose heuristics are older gets its settings
+recomputed from the stored metadata (cheap) and updated in place.
+"""
+import hashlib
+from typing import Optional
+
+from sqlalchemy import exists
+from sqlalchemy.orm import Query, Session
+
+from app import metrics
+from app.db import models
+from app.features.helpers.recommend_settings import HEURISTICS_VERSION, METADATA_VERSION, recommend_conversion
+
+Recommendation = models.Recommendation
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _newest_current(q: Query) -> Optional[models.Recommendation]:
+    return (
+        q.filter(Recommendation.metadata_version == METADATA_VERSION, Recommendation.metadata_json.isnot(None))
+        .order_by(Recommendation.id.desc())
+        .first()
+    )
+
+
+def for_hash(db: Session, digest: str) -> Optional[models.Recommendation]:
+    """Newest reusable recommendation of any image with these bytes."""
+    rec = _newest_current(
+        db.query(Recommendation)
+        .join(models.Image, models.Image.id == Recommendation.image_id)
+        .filter(models.Image.content_hash == digest)
+    )
+    metrics.cache_lookup("recommendation", rec is not None)
+    return rec
+
+
+def for_image(db: Session, image_id: int) -> Optional[models.Recommendation]:
+    """Newest reusable recommendation of this image."""
+    rec = _newest_current(db.query(Recommendation).filter(Recommendation.image_id == image_id))
+    metrics.cache_lookup("recommendation", rec is not None)
+    return rec
+
+
+def has_original(db: Session, image_id: int) -> bool:
+    """Whether the image still has its upload (retention may have dropped it), i.e. can be converted by id."""
+    return db.query(
+        exists().where(models.Image.id == image_id, models.Image.original_blob.isnot(None))
+    ).scalar()
+
+
+def apply(rec: models.Recommendation, recommendation: dict):
+    """Store recommend_conversion output on the row, stamped with the current heuristics version."""
+    rec.recommended_mode = recommendation.get("conversion_mode")
+    rec.vector_params = recommendation.get("vector_settings")
+    rec.outline_params = recommendation.get("outline_settings")
+    rec.confidence_score = recommendation.get("confidence")
+    rec.heuristics_version = HEURISTICS_VERSION
+
+
+def build(image_id: int, metadata: dict, recommendation: dict) -> models.Recommendation:
+    """A new recommendations row, stamped with the current versions."""
+    rec = Recommendation(image_id=image_id, metadata_json=metadata, metadata_version=METADATA_VERSION)
+    apply(rec, recommendation)
+    return rec
+
+
+def refresh(rec: models.Recommendation) -> bool:
+    """Recompute stale settings from the stored metadata; True when the row changed (not committed)."""
+    if rec.heuristics_version == HEURISTICS_VERSION:
+        return False
+    apply(rec, recommend_conversion(rec.metadata_json))
+    return True
+
+
+def response(rec: models.Recommendation) -> dict:
+    """The /conversion/recommend body for a stored recommendation."""
+    return {
+        "image_id": rec.image_id,
+        "metadata": rec.metadata_json,
+        "recommendation": {
+            "conversion_mode": rec.recommended_mode,
+            "vector_settings": rec.vector_params,
+            "outline_settings": rec.outline_params,
+        },
+        "cached": True,
+    }
@@ -1,56 +1,87 @@
+import asyncio
 import io
+import mimetypes
 import os
+import shutil
 import tempfile
 import time
 from math import ceil
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 
-from fastapi import APIRouter, UploadFile, File, Form, Depends
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import APIRouter, BackgroundTasks, UploadFile, File, Form, Depends, Header, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import torch
-import subprocess
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
-from PIL import Image
+from sqlalchemy.orm import Session, defer
+from sqlalchemy import desc, exists, func
 
 from app.features.helpers.recommend_settings import extract_image_metadata, recommend_conversion
-from app.db import get_db
+from app.features.analytics import rollup
+from app.features.conversion import (
+    admission, encoding, job_store, jobs, recommend_cache, singleflight, svg_optimize, sweep, thumbnails, tracers,
+    upscalers,
+)
+from app.features.conversion.pipeline import EXECUTOR, PIPELINES, PREVIEW_PIPELINES, execute
+from app.features.helpers import profiling
+from app.features.helpers.timing import StageTimer
+from app.features.retention import policy as retention
+from app import metrics
+from app.db import DB_WRITE_BATCH, get_db, writer
 from app.db import models
 
 
 router = APIRouter(prefix="/conversion", tags=["Conversion"])
+
+# stored output body per content coding (None = identity)
+_OUTPUT_BLOBS = {
+    None: models.Conversion.output_blob,
+    "gzip": models.Conversion.output_gzip_blob,
+    "br": models.Conversion.output_br_blob,
+}
 
 
-def _ensure_image(db: Session, filename: str, blob: bytes, size_bytes: int):
+def _ensure_image(db: Session, filename: str, blob: bytes, size_bytes: int, content_hash: Optional[str] = None):
     """
-    Create an image row for the upload.
+    Create an image row for the upload, with its content hash (recommend_cache.py).
     """
     image = models.Image(
         original_filename=filename or "upload",
         size_bytes=size_bytes,
         original_blob=blob,
+        content_hash=content_hash or (recommend_cache.content_hash(blob) if blob else None),
     )
     db.add(image)
-    db.flush()
-    return image
-
-
-def _generate_thumbnail(output_bytes: Optional[bytes], max_size: int = 256) -> Optional[bytes]:
-    if not output_bytes:
-        return None
-    try:
-        with Image.open(io.BytesIO(output_bytes)) as img:
-            if img.mode in ("RGBA", "P"):
-                img = img.convert("RGB")
-            img.thumbnail((max_size, max_size))
-            buffer = io.BytesIO()
-            img.save(buffer, format="WEBP", quality=70, method=6)
-            return buffer.getvalue()
-    except Exception:
-        return None
+    db.flush()
+    return image
 
 
+def _count_original(blob: bytes):
+    """DB_BLOB_BYTES for a new upload; called once its image row is committed."""
+    metrics.DB_BLOB_BYTES.labels(kind="original").inc(len(blob or b""))
+
+
+def _store_profile(db: Session, profile: Optional[profiling.ProfileSession], endpoint: str,
+                   conversion_id: Optional[int] = None, image_id: Optional[int] = None):
+    """
+    Persist the artifacts of a profiled request (no-op when the request was not profiled).
+    """
+    if profile is None:
+        return
+    for name, content_type, data in profile.collect():
+        db.add(
+            models.ProfileArtifact(
+                conversion_id=conversion_id,
+                image_id=image_id,
+                endpoint=endpoint,
+                reason=profile.reason,
+                name=name,
+                content_type=content_type,
+                blob=data,
+            )
+        )
+
+
 @router.get("/")
 def get_conversion_info():
     return {"message": "This is the conversion feature endpoint."}
@@ -62,41 +93,114 @@ async def options_convert():
 
 
 @router.post("/recommend")
-async def recommend_settings(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def recommend_settings(
+    request: Request,
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    profile: Optional[profiling.ProfileSession] = Depends(profiling.request_profiling),
+):
     """
     Accepts an image file, extracts metadata, stores image + recommendation, and returns suggested settings.
+    Answers 429 with Retry-After when the client or the node is over its cost budget (admission.py).
+    A repeat upload of the same bytes is answered from the stored recommendation (`cached: true`)
+    without running CLIP; see recommend_cache.py.
     """
     upload_bytes = await file.read()
     if not upload_bytes:
         return JSONResponse(status_code=400, content={"error": "Empty file"})
+    digest = recommend_cache.content_hash(upload_bytes)
+    cached = recommend_cache.for_hash(db, digest)
+    if cached is not None and recommend_cache.has_original(db, cached.image_id):
+        return _cached_recommendation(db, cached)
+    return await _recommend(request, db, profile, upload_bytes, file.filename, digest, reuse=cached)
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-        tmp.write(upload_bytes)
-        tmp_path = Path(tmp.name)
 
+@router.get("/recommend/{image_id}")
+async def get_recommendation(
+    image_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    profile: Optional[profiling.ProfileSession] = Depends(profiling.request_profiling),
+):
+    """
+    Recommendation for a stored image (e.g. the X-Image-Id of a conversion): the stored one, or
+    else computed from the stored upload and stored, like POST /recommend.
+    """
+    rec = recommend_cache.for_image(db, image_id)
+    if rec is not None:
+        return _cached_recommendation(db, rec)
+    image = db.get(models.Image, image_id)
+    if image is None or not image.original_blob:
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    reuse = recommend_cache.for_hash(db, image.content_hash) if image.content_hash else None
+    return await _recommend(request, db, profile, image.original_blob, image.original_filename, image.content_hash,
+                            reuse=reuse, image=image)
+
+
+def _cached_recommendation(db: Session, rec: models.Recommendation):
+    """Answer from a stored recommendation, recomputing its settings first if the heuristics changed."""
     try:
-        metadata = extract_image_metadata(str(tmp_path))
-        recommendation = recommend_conversion(metadata)
-
-        image = _ensure_image(
-            db=db,
-            filename=file.filename,
-            blob=upload_bytes,
-            size_bytes=len(upload_bytes),
+        if recommend_cache.refresh(rec):
+            db.commit()
+    except Exception as e:
+        db.rollback()
+        return JSONResponse(
+            status_code=500,
+            content={"error": "Failed to compute recommendation", "details": str(e)},
         )
+    return recommend_cache.response(rec)
 
-        rec_entry = models.Recommendation(
-            image_id=image.id,
-            recommended_mode=recommendation.get("conversion_mode"),
-            vector_params=recommendation.get("vector_settings"),
-            outline_params=recommendation.get("outline_settings"),
-            metadata_json=metadata,
-            confidence_score=recommendation.get("confidence"),
-        )
+
+async def _recommend(request: Request, db: Session, profile: Optional[profiling.ProfileSession], upload_bytes: bytes,
+                     filename: Optional[str], digest: Optional[str], reuse: Optional[models.Recommendation] = None,
+                     image: Optional[models.Image] = None):
+    """
+    Compute and store a recommendation for `image` (a new image row for the upload when None).
+    `reuse` is a current recommendation of the same bytes whose image can no longer be converted
+    by id: its metadata is reused and only the settings are recomputed.
+    """
+    ticket = None
+    if reuse is None:
+        try:
+            ticket = admission.admit(request, "recommend", admission.COSTS.recommend())
+        except admission.AdmissionRejected as e:
+            return admission.too_many_requests(e)
+    start_perf = time.perf_counter()
+    tmp_path = None
+
+    try:
+        if reuse is not None:
+            metadata = reuse.metadata_json
+            recommendation = recommend_conversion(metadata)
+        else:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
+                tmp.write(upload_bytes)
+                tmp_path = Path(tmp.name)
+            profile_dir = profile.dir if profile else None
+            with profiling.cpu_profile(profile_dir, "recommend"):
+                metadata = extract_image_metadata(str(tmp_path), profile_dir=profile_dir)
+                recommendation = recommend_conversion(metadata)
+
+        new_image = image is None
+        if new_image:
+            image = _ensure_image(
+                db=db,
+                filename=filename,
+                blob=upload_bytes,
+                size_bytes=len(upload_bytes),
+                content_hash=digest,
+            )
+
+        rec_entry = recommend_cache.build(image.id, metadata, recommendation)
         db.add(rec_entry)
+        rollup.record_recommendation(db, rec_entry)
+        _store_profile(db, profile, "recommend", image_id=image.id)
         db.commit()
+        if new_image:
+            _count_original(upload_bytes)
 
-        return {"image_id": image.id, "metadata": metadata, "recommendation": recommendation}
+        return {"image_id": image.id, "metadata": metadata, "recommendation": recommendation,
+                "cached": reuse is not None}
     except Exception as e:
         db.rollback()
         return JSONResponse(
@@ -104,14 +208,45 @@ async def recommend_settings(file: UploadFile = File(...), db: Session = Depends
             content={"error": "Failed to compute recommendation", "details": str(e)},
         )
     finally:
-        if tmp_path.exists():
+        if tmp_path is not None and tmp_path.exists():
             tmp_path.unlink()
+        if ticket is not None:
+            seconds = time.perf_counter() - start_perf
+            admission.COSTS.observe_recommend(seconds)
+            ticket.release(seconds)
+
+
+async def _read_source(db: Session, file: Optional[UploadFile], image_id: Optional[int], timer: StageTimer):
+    """
+    (bytes, filename, content type, stored image id) of an upload or of a stored image (`image_id`),
+    or the JSONResponse to answer with.
+    """
+    if file is not None:
+        with timer.stage("upload"):
+            upload_bytes = await file.read()
+        source = (upload_bytes, file.filename, file.content_type, None)
+    elif image_id is not None:
+        with timer.stage("upload"):
+            image = await run_in_threadpool(db.get, models.Image, image_id)
+        if image is None or not image.original_blob:
+            return JSONResponse(status_code=404, content={"error": "Image not found"})
+        filename = image.original_filename
+        source = (image.original_blob, filename, mimetypes.guess_type(filename)[0], image.id)
+    else:
+        return JSONResponse(status_code=400, content={"error": "Either file or image_id is required"})
+    if not source[0]:
+        return JSONResponse(status_code=400, content={"error": "Empty file"})
+    return source
 
 
 @router.post("/convert")
 async def convert_image(
-    file: UploadFile = File(...),
+    request: Request,
+    background_tasks: BackgroundTasks,
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[int] = Form(None),  # instead of `file`: an image stored by /recommend or /convert
     outputType: str = Form("vectorize"),  # 'vectorize', 'outline', 'enhance'
+    preview: bool = Form(False),
     # outline fields
     low: int = Form(100),
     high: int = Form(200),
@@ -125,37 +260,67 @@ async def convert_image(
     corner_threshold: int = Form(40),
     segment_length: int = Form(10),
     splice_threshold: int = Form(80),
+    latency_budget: Optional[float] = Form(None),  # seconds; picks a cheaper upscaler tier to fit
+    tracer: Optional[str] = Form(None),  # vectorize/outline backend, see tracers.py (default: auto)
+    # enhance output, see encoding.py (default: negotiated from Accept)
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None),
+    png_level: Optional[int] = Form(None),
+    job_id: Optional[str] = Form(None),
+    accept: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    prefer: Optional[str] = Header(None),
     db: Session = Depends(get_db),
+    queue: metrics.QueueSlot = Depends(metrics.queue_slot),
+    profile: Optional[profiling.ProfileSession] = Depends(profiling.request_profiling),
 ):
     """
     Receives image + conversion settings, runs pipeline, stores original/output blobs + metadata, returns output bytes.
+    The pipeline runs on the conversion executor and the rows are written in one short transaction
+    afterwards. See admission.py (429 pricing), singleflight.py (identical concurrent requests),
+    jobs.py (`job_id` progress and cancel), preview.py, upscalers.py (`latency_budget`), tracers.py,
+    encoding.py / svg_optimize.py (output formats), profiling.py and job_store.py (CONVERSION_QUEUE=1).
     """
-    upload_bytes = await file.read()
-    if not upload_bytes:
-        return JSONResponse(status_code=400, content={"error": "Empty file"})
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-        tmp.write(upload_bytes)
-        tmp_path = Path(tmp.name)
-
-    output_dir = Path("app/output")
-    output_dir.mkdir(parents=True, exist_ok=True)
+    if job_id is not None and not jobs.JOB_ID.match(job_id):
+        return JSONResponse(status_code=400, content={"error": "job_id must be 1-64 characters of [A-Za-z0-9_-]"})
+    timer = StageTimer()
+    source = await _read_source(db, file, image_id, timer)
+    if isinstance(source, JSONResponse):
+        return source
+    upload_bytes, filename, content_type, stored_image_id = source
+
+    run_pipeline = (PREVIEW_PIPELINES if preview else PIPELINES).get(outputType.lower())
+    if run_pipeline is None:
+        if preview and outputType.lower() in PIPELINES:
+            return JSONResponse(status_code=400, content={"error": f"Preview is not available for {outputType}"})
+        return JSONResponse(status_code=400, content={"error": f"Unsupported outputType: {outputType}"})
+    chosen_tracer = None
+    if outputType.lower() in tracers.PREFERENCE:
+        try:
+            chosen_tracer = tracers.resolve(outputType.lower(), tracer)
+        except tracers.TracerError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+    chosen_format = None
+    if outputType.lower() == "enhance":
+        try:
+            chosen_format = encoding.negotiate(accept, output_format)
+        except encoding.EncodingError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+        if quality is not None and not 1 <= quality <= 100:
+            return JSONResponse(status_code=400, content={"error": "quality must be 1-100"})
+        if png_level is not None and not 0 <= png_level <= 9:
+            return JSONResponse(status_code=400, content={"error": "png_level must be 0-9"})
 
-    start_perf = time.perf_counter()
-    output_path = None
-    output_bytes = None
-    output_mime = None
-    thumb_bytes = None
     device = "gpu" if torch.cuda.is_available() else "cpu"
-    failure_reason = None
-
-    # Store original in images table
-    image = _ensure_image(
-        db=db,
-        filename=file.filename,
-        blob=upload_bytes,
-        size_bytes=len(upload_bytes),
-    )
+    megapixels = upscalers.image_megapixels(upload_bytes)
+    upscale_tier = None
+    if not preview and outputType.lower() in upscalers.DEFAULT_TIER:
+        upscale_tier = upscalers.choose_tier(outputType.lower(), megapixels, latency_budget, device)
+    try:
+        cost = admission.COSTS.convert(outputType.lower(), megapixels, upscale_tier, preview, device)
+        ticket = admission.admit(request, "convert", cost)
+    except admission.AdmissionRejected as e:
+        return admission.too_many_requests(e)
 
     chosen_params = {
         "outputType": outputType,
@@ -171,164 +336,452 @@ async def convert_image(
         "low": low,
         "high": high,
     }
+    if preview:
+        chosen_params["preview"] = True
+    if chosen_tracer:
+        chosen_params["tracer"] = chosen_tracer
+    if chosen_format:
+        chosen_params["output_format"] = chosen_format
+        if quality is not None:
+            chosen_params["quality"] = quality
+        if png_level is not None:
+            chosen_params["png_level"] = png_level
+    if megapixels:
+        chosen_params["megapixels"] = round(megapixels, 3)
+    if upscale_tier:
+        chosen_params["upscale_tier"] = upscale_tier
+        if latency_budget is not None:
+            chosen_params["latency_budget"] = latency_budget
+
+    if job_store.CONVERSION_QUEUE:
+        queue.release()
+        headers = {}
+        if chosen_format and not output_format:
+            headers["Vary"] = "Accept"
+        return await _convert_queued(
+            db, ticket, timer, upload_bytes, filename, content_type, stored_image_id, outputType.lower(), preview,
+            chosen_params, job_id, prefer, accept_encoding, headers,
+        )
+
+    job = None
+    if job_id is not None:
+        job = jobs.start(job_id, outputType.lower())
+        if job is None:
+            ticket.release()
+            return JSONResponse(status_code=409, content={"error": f"Job {job_id} is already in use"})
+        if job.cancelled:
+            ticket.release()
+            return JSONResponse(status_code=409, content={"error": "Conversion cancelled"})
+
+    start_perf = time.perf_counter()
+    output_path = None
+    output_bytes = None
+    output_mime = None
+    encoded = {}
+    output_stats = None
+    failure_reason = None
+    conversion_id = None
+    cancelled = False
+    if job is not None:
+        timer.listener = job.on_stage
 
     try:
-        original_name = Path(file.filename).stem if file.filename else "upload"
-
-        if outputType.lower() == "vectorize":
-            cmd = [
-                "python",
-                "app/features/conversion/vectorization.py",
-                "--input",
-                str(tmp_path),
-                "--output",
-                str(output_dir),
-                "--base_name",
-                original_name,
-                "--hierarchical",
-                hierarchical,
-                "--filter_speckle",
-                str(filter_speckle),
-                "--color_precision",
-                str(color_precision),
-                "--gradient_step",
-                str(gradient_step),
-                "--mode",
-                mode,
-            ]
-            if preset:
-                cmd.extend(["--preset", preset])
-            if mode == "spline":
-                cmd.extend(
-                    [
-                        "--corner_threshold",
-                        str(corner_threshold),
-                        "--segment_length",
-                        str(segment_length),
-                        "--splice_threshold",
-                        str(splice_threshold),
-                    ]
-                )
+        original_name = Path(filename).stem if filename else "upload"
+        profile_dir = profile.dir if profile else None
+
+        def run(pipeline_job: jobs.Job, pipeline_timer: StageTimer):
+            # runs once per flight (see singleflight.py), possibly for several identical requests
+            with jobs.activate(pipeline_job):
+                return execute(outputType.lower(), preview, upload_bytes, original_name, chosen_params,
+                               pipeline_timer, profile_dir=profile_dir)
+
+        queue.release()
+        key = singleflight.request_key(upload_bytes, outputType.lower(), chosen_params)
+        output_path, output_mime, output_bytes, encoded, output_stats, ran_tier = \
+            await singleflight.run(key, outputType.lower(), run, job, timer, attach=profile is None)
+        if upscale_tier:
+            chosen_params["upscale_tier"] = ran_tier
+        if chosen_format and output_stats:
+            chosen_params["output_format"] = output_stats["format"]  # tiled outputs are always PNG
+
+    except jobs.JobCancelled:
+        cancelled = True
+        output_bytes = None
+    except Exception as e:
+        failure_reason = str(e)
+    finally:
+        duration = time.perf_counter() - start_perf
+        ticket.release(duration)
 
-            subprocess.run(cmd, check=True)
+        output_size = len(output_bytes) if output_bytes else None
 
-            svg_files = sorted(
-                [f for f in output_dir.iterdir() if f.suffix == ".svg"],
-                key=lambda f: f.stat().st_mtime,
-                reverse=True,
+        def save(session: Session) -> Tuple[int, int]:
+            """Image + conversion + stage/rollup/profile rows; returns the conversion and image ids."""
+            # the blob INSERTs happen at flush; the final commit is not part of the stage breakdown.
+            # A batch that failed is replayed unit by unit (writer.py): only the last attempt counts
+            timer.stages.pop("db_write", None)
+            with timer.stage("db_write"):
+                row_image_id = stored_image_id or _ensure_image(
+                    db=session,
+                    filename=filename,
+                    blob=upload_bytes,
+                    size_bytes=len(upload_bytes),
+                ).id
+                conv_entry = models.Conversion(
+                    image_id=row_image_id,
+                    image_name=filename or "upload",
+                    image_type=content_type,
+                    mode=outputType.lower(),
+                    time_taken=duration,
+                    device=device,
+                    chosen_params=chosen_params,
+                    output_mime=output_mime,
+                    output_size_bytes=output_size,
+                    output_blob=output_bytes,
+                    output_gzip_blob=encoded.get("gzip"),
+                    output_br_blob=encoded.get("br"),
+                    output_stats=output_stats,
+                    preview=preview,
+                )
+                session.add(conv_entry)
+                session.flush()
+            stages = timer.as_dict()
+            session.add_all(
+                models.ConversionStage(conversion_id=conv_entry.id, stage=stage, seconds=seconds)
+                for stage, seconds in stages.items()
             )
-            if not svg_files:
-                raise RuntimeError("No SVG output generated.")
-            output_path = svg_files[0]
-            output_mime = "image/svg+xml"
+            rollup.record_conversion(session, conv_entry, stages)
+            _store_profile(session, profile, "convert", conversion_id=conv_entry.id, image_id=row_image_id)
+            return conv_entry.id, row_image_id
 
-        elif outputType.lower() == "outline":
+        def save_and_commit() -> Tuple[int, int]:
             try:
-                from app.features.conversion.outline import process_image as outline_process
-            except ImportError:
-                outline_process = None
-
-            if outline_process is None:
-                raise RuntimeError("Outline processor not available")
-
-            outline_process(str(tmp_path), str(output_dir), low, high, base_name_override=original_name)
-
-            svg_files = sorted(
-                [
-                    f
-                    for f in output_dir.iterdir()
-                    if f.suffix == ".svg" and ("_outline_" in f.name or f.name.endswith("_outline.svg"))
-                ],
-                key=lambda f: f.stat().st_mtime,
-                reverse=True,
-            )
-            if not svg_files:
-                raise RuntimeError("No outline SVG output generated.")
-            output_path = svg_files[0]
-            output_mime = "image/svg+xml"
-
-        elif outputType.lower() == "enhance":
-            args = [
-                "python",
-                "app/features/conversion/enhance.py",
-                "--input",
-                str(tmp_path),
-                "--output",
-                str(output_dir),
-                "--model_path",
-                "app/weights/RealESRGAN_x4plus.pth",
-                "--base_name",
-                original_name,
-            ]
-            subprocess.run(args, check=True)
-
-            upscaled_files = sorted(
-                [f for f in output_dir.iterdir() if f.suffix in {".png", ".webp"} and "_real_upscaled" in f.name],
-                key=lambda f: f.stat().st_mtime,
-                reverse=True,
-            )
-            if not upscaled_files:
-                raise RuntimeError("No upscaled image found.")
-            output_path = upscaled_files[0]
-            output_mime = "image/webp" if output_path.suffix == ".webp" else "image/png"
+                new_ids = save(db)
+                db.commit()
+                return new_ids
+            except Exception:
+                db.rollback()
+                raise
+
+        new_image = stored_image_id is None
+        try:
+            if cancelled:
+                pass  # nothing was produced; the request is not part of the history
+            elif DB_WRITE_BATCH:
+                conversion_id, stored_image_id = await asyncio.wrap_future(writer.get_writer().submit(save))
+            else:
+                conversion_id, stored_image_id = await run_in_threadpool(save_and_commit)
+            if not cancelled:
+                if new_image:
+                    _count_original(upload_bytes)
+                metrics.DB_BLOB_BYTES.labels(kind="output").inc((output_size or 0) + sum(map(len, encoded.values())))
+        except Exception:
+            conversion_id = None
 
+    if job is not None:
+        if cancelled:
+            job.set_state("cancelled")
+        elif output_bytes:
+            job.set_state("done", conversion_id=conversion_id)
         else:
-            return JSONResponse(status_code=400, content={"error": f"Unsupported outputType: {outputType}"})
-
-        # Read output into memory
-        if output_path:
-            output_bytes = output_path.read_bytes()
-        if output_bytes:
-            if outputType.lower() in {"vectorize", "outline"}:
-                thumb_bytes = output_bytes
-            else:
-                thumb_bytes = _generate_thumbnail(output_bytes)
-        else:
-            thumb_bytes = None
+            job.set_state("failed", error=failure_reason or "Conversion failed")
+    if cancelled:
+        return JSONResponse(status_code=409, content={"error": "Conversion cancelled"})
+    if not output_bytes:
+        return JSONResponse(status_code=500, content={"error": failure_reason or "Conversion failed"})
+
+    download_name = f"{Path(filename or 'converted').stem}_output{Path(output_path).suffix if output_path else ''}"
+    headers = {"Content-Disposition": f'attachment; filename="{download_name}"'}
+    if preview:
+        headers["X-Preview"] = "1"
+    if stored_image_id is not None:
+        headers["X-Image-Id"] = str(stored_image_id)
+    if upscale_tier:
+        headers["X-Upscale-Tier"] = chosen_params["upscale_tier"]
+    if chosen_tracer:
+        headers["X-Tracer"] = chosen_tracer
+    if chosen_format and not output_format:
+        headers["Vary"] = "Accept"
+    body = _encoded_body(output_bytes, encoded, accept_encoding, headers)
+    if conversion_id is not None:
+        headers["X-Conversion-Id"] = str(conversion_id)
+        if thumbnails.THUMBNAIL_PREWARM and not preview:
+            background_tasks.add_task(thumbnails.prewarm, conversion_id)
+    return StreamingResponse(io.BytesIO(body), media_type=output_mime or "application/octet-stream", headers=headers)
+
+
+async def _convert_queued(
+    db: Session,
+    ticket: admission.Ticket,
+    timer: StageTimer,
+    upload_bytes: bytes,
+    filename: Optional[str],
+    content_type: Optional[str],
+    stored_image_id: Optional[int],
+    mode: str,
+    preview: bool,
+    chosen_params: dict,
+    job_id: Optional[str],
+    prefer: Optional[str],
+    accept_encoding: Optional[str],
+    headers: dict,
+):
+    """
+    /convert with CONVERSION_QUEUE=1: store the image and a conversion_jobs row, then wait for a
+    worker to store the conversion (job_store.wait) and answer like an inline conversion. Answers
+    202 with the job (Location: /conversion/queue/{id}) for `Prefer: respond-async` or when
+    QUEUE_WAIT_SECONDS pass first.
+    """
+    start_perf = time.perf_counter()
+
+    def store() -> Tuple[Optional[int], Optional[int]]:
+        """Image + queued job; (None, None) when job_id belongs to a conversion still in the queue."""
+        try:
+            if job_id is not None:
+                previous = job_store.latest_for_job_id(db, job_id)
+                if previous is not None and previous.status not in job_store.FINAL_STATES:
+                    return None, None
+            with timer.stage("db_write"):
+                row_image_id = stored_image_id or _ensure_image(
+                    db=db,
+                    filename=filename,
+                    blob=upload_bytes,
+                    size_bytes=len(upload_bytes),
+                ).id
+                queued = job_store.enqueue(db, row_image_id, filename or "upload", content_type, mode, chosen_params,
+                                           preview, job_id)
+            db.commit()
+            if not stored_image_id:
+                _count_original(upload_bytes)
+            return queued.id, row_image_id
+        except Exception:
+            db.rollback()
+            raise
 
+    try:
+        queue_id, image_id = await run_in_threadpool(store)
     except Exception as e:
-        failure_reason = str(e)
-    finally:
-        duration = time.perf_counter() - start_perf
+        ticket.release()
+        return JSONResponse(status_code=500, content={"error": "Could not queue the conversion", "details": str(e)})
+    if queue_id is None:
+        ticket.release()
+        return JSONResponse(status_code=409, content={"error": f"Job {job_id} is already in use"})
+
+    headers.update({"X-Queue-Id": str(queue_id), "X-Image-Id": str(image_id)})
+    if preview:
+        headers["X-Preview"] = "1"
+    accepted = {"queue_id": queue_id, "status": "queued", "image_id": image_id,
+                "status_url": f"/conversion/queue/{queue_id}"}
+    if prefer and "respond-async" in prefer.lower():
+        ticket.release()
+        return JSONResponse(status_code=202, content=accepted, headers={**headers, "Location": accepted["status_url"]})
 
-        output_size = len(output_bytes) if output_bytes else None
-        conv_entry = models.Conversion(
-            image_id=image.id,
-            image_name=file.filename or "upload",
-            image_type=file.content_type,
-            mode=outputType.lower(),
-            time_taken=duration,
-            device=device,
-            chosen_params=chosen_params,
-            output_mime=output_mime,
-            output_size_bytes=output_size,
-            output_blob=output_bytes,
-            output_thumb_blob=thumb_bytes,
-        )
+    try:
+        status, conversion_id = await job_store.wait(queue_id)
+    finally:
+        ticket.release(time.perf_counter() - start_perf)
+    if status not in job_store.FINAL_STATES:
+        accepted["status"] = status
+        return JSONResponse(status_code=202, content=accepted, headers={**headers, "Location": accepted["status_url"]})
+    if status == "cancelled":
+        return JSONResponse(status_code=409, content={"error": "Conversion cancelled"}, headers=headers)
+
+    def load() -> Tuple[models.ConversionJob, Optional[models.Conversion]]:
+        db.expire_all()
+        queued = job_store.get(db, queue_id)
+        return queued, db.get(models.Conversion, conversion_id) if conversion_id else None
+
+    queued, conv = await run_in_threadpool(load)
+    if conv is not None:
+        headers["X-Conversion-Id"] = str(conv.id)
+    if status == "failed" or conv is None or not conv.output_blob:
+        return JSONResponse(status_code=500, content={"error": queued.error or "Conversion failed"}, headers=headers)
+
+    extension = mimetypes.guess_extension(conv.output_mime or "") or ""
+    headers["Content-Disposition"] = f'attachment; filename="{Path(filename or "converted").stem}_output{extension}"'
+    ran_params = conv.chosen_params or {}
+    if ran_params.get("upscale_tier"):
+        headers["X-Upscale-Tier"] = ran_params["upscale_tier"]
+    if ran_params.get("tracer"):
+        headers["X-Tracer"] = ran_params["tracer"]
+    encoded = {name: blob for name, blob in (("gzip", conv.output_gzip_blob), ("br", conv.output_br_blob)) if blob}
+    body = _encoded_body(conv.output_blob, encoded, accept_encoding, headers)
+    return StreamingResponse(io.BytesIO(body), media_type=conv.output_mime or "application/octet-stream",
+                             headers=headers)
+
+
+@router.post("/sweep")
+async def sweep_parameters(
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[int] = Form(None),
+    outputType: str = Form("outline"),  # 'outline' or 'vectorize'
+    variants: str = Form(...),  # JSON list of parameter overrides, e.g. [{"low": 50, "high": 150}, ...]
+    preview: bool = Form(False),
+    tracer: Optional[str] = Form(None),  # backend for every variant, see tracers.py
+    db: Session = Depends(get_db),
+    queue: metrics.QueueSlot = Depends(metrics.queue_slot),
+):
+    """
+    Traces one image with up to SWEEP_MAX_VARIANTS parameter sets, decoding/blurring (outline) or
+    upscaling (vectorize) it only once, and returns every variant's SVG with its timing and size
+    (see sweep.py). The image is stored so the chosen settings can be converted with `image_id`.
+    Priced and admitted like /convert (admission.py), with a trace per extra variant.
+    """
+    timer = StageTimer()
+    source = await _read_source(db, file, image_id, timer)
+    if isinstance(source, JSONResponse):
+        return source
+    upload_bytes, filename, content_type, stored_image_id = source
+    mode = outputType.lower()
+    try:
+        parameter_sets = sweep.parse_variants(mode, variants)
+        tracer = tracers.resolve(mode, tracer)
+    except (sweep.SweepError, tracers.TracerError) as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    device = "gpu" if torch.cuda.is_available() else "cpu"
+    try:
+        cost = admission.COSTS.sweep(mode, upscalers.image_megapixels(upload_bytes), len(parameter_sets), preview,
+                                     device)
+        ticket = admission.admit(request, "sweep", cost)
+    except admission.AdmissionRejected as e:
+        return admission.too_many_requests(e)
+
+    def run():
+        output_root = Path("app/output")
+        output_root.mkdir(parents=True, exist_ok=True)
+        work_dir = Path(tempfile.mkdtemp(dir=output_root))
         try:
-            db.add(conv_entry)
+            input_path = work_dir / "input.png"
+            with timer.stage("upload"):
+                input_path.write_bytes(upload_bytes)
+            with metrics.CONVERSIONS_IN_FLIGHT.labels(mode=f"{mode}_sweep").track_inprogress():
+                return sweep.run(mode, input_path, work_dir, parameter_sets, preview, timer, tracer)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def store_image() -> int:
+        try:
+            image = _ensure_image(db=db, filename=filename, blob=upload_bytes, size_bytes=len(upload_bytes))
             db.commit()
+            _count_original(upload_bytes)
+            return image.id
         except Exception:
             db.rollback()
+            raise
 
-        # Cleanup temp + output file
-        if output_path and output_path.exists():
-            try:
-                output_path.unlink()
-            except OSError:
-                pass
-        if tmp_path.exists():
-            try:
-                tmp_path.unlink()
-            except OSError:
-                pass
+    queue.release()
+    start_perf = time.perf_counter()
+    try:
+        results = await asyncio.get_running_loop().run_in_executor(EXECUTOR, run)
+        if stored_image_id is None:
+            stored_image_id = await run_in_threadpool(store_image)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": "Sweep failed", "details": str(e)})
+    finally:
+        ticket.release(time.perf_counter() - start_perf)
 
-    if not output_bytes:
-        return JSONResponse(status_code=500, content={"error": failure_reason or "Conversion failed"})
+    return {
+        "image_id": stored_image_id,
+        "mode": mode,
+        "preview": preview,
+        "tracer": tracer,
+        "seconds": round(time.perf_counter() - start_perf, 4),
+        "shared_stages": timer.as_dict(),
+        "variants": results,
+    }
 
-    filename = f"{Path(file.filename or 'converted').stem}_output{Path(output_path).suffix if output_path else ''}"
-    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
-    return StreamingResponse(io.BytesIO(output_bytes), media_type=output_mime or "application/octet-stream", headers=headers)
+
+def _encoded_body(data: bytes, encoded: dict, accept_encoding: Optional[str], headers: dict) -> bytes:
+    """Pick the stored encoding the client accepts (setting Content-Encoding/Vary) or the raw bytes."""
+    if not encoded:
+        return data
+    headers["Vary"] = "Accept-Encoding"
+    encoding = svg_optimize.choose_encoding(accept_encoding, encoded)
+    if encoding is None:
+        return data
+    headers["Content-Encoding"] = encoding
+    return encoded[encoding]
+
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str, db: Session = Depends(get_db)):
+    """In-process job state, or (CONVERSION_QUEUE=1) the latest queued conversion posted with this job_id."""
+    if job_store.CONVERSION_QUEUE:
+        queued = job_store.latest_for_job_id(db, job_id)
+        if queued is not None:
+            return job_store.describe(queued)
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    return job.snapshot()
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, last_event_id: Optional[str] = Header(None)):
+    """
+    Server-Sent Events for a conversion started with this job_id (may be opened before the
+    conversion is posted). The stream ends after the `done` event; reconnecting after that
+    answers 204 so EventSource stops retrying. Only conversions run by this process stream events:
+    with CONVERSION_QUEUE=1 workers run them, so this answers 204 and progress is polled from
+    GET /conversion/jobs/{job_id} or /conversion/queue/{id}.
+    """
+    if not jobs.JOB_ID.match(job_id):
+        return JSONResponse(status_code=400, content={"error": "Invalid job id"})
+    if job_store.CONVERSION_QUEUE:
+        return Response(status_code=204)
+    job = jobs.get_or_create(job_id)
+    after = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+    if job.finished and after >= len(job.events):
+        return Response(status_code=204)
+    return StreamingResponse(
+        jobs.stream(job, after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str, db: Session = Depends(get_db)):
+    """Cancel a queued/running conversion (or one that has only been subscribed to so far)."""
+    if job_store.CONVERSION_QUEUE:
+        queued = job_store.latest_for_job_id(db, job_id)
+        if queued is not None:
+            if not job_store.cancel(db, queued):
+                return JSONResponse(status_code=409, content={"error": f"Job already {queued.status}"})
+            return {"job_id": job_id, "queue_id": queued.id, "cancelled": True}
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    if not job.cancel():
+        return JSONResponse(status_code=409, content={"error": f"Job already {job.state}"})
+    return {"job_id": job_id, "cancelled": True}
+
+
+@router.get("/queue")
+def queue_summary(db: Session = Depends(get_db)):
+    """Queued conversions by status (CONVERSION_QUEUE=1, see job_store.py)."""
+    return job_store.summary(db)
+
+
+@router.get("/queue/{queue_id}")
+def get_queued(queue_id: int, db: Session = Depends(get_db)):
+    """State, attempts, worker and progress of a queued conversion; output_url once it is done."""
+    queued = job_store.get(db, queue_id)
+    if queued is None:
+        return JSONResponse(status_code=404, content={"error": "Queued conversion not found"})
+    return job_store.describe(queued)
+
+
+@router.post("/queue/{queue_id}/cancel")
+def cancel_queued(queue_id: int, db: Session = Depends(get_db)):
+    """Cancel a queued conversion, or stop a running one at its worker's next heartbeat."""
+    queued = job_store.get(db, queue_id)
+    if queued is None:
+        return JSONResponse(status_code=404, content={"error": "Queued conversion not found"})
+    if not job_store.cancel(db, queued):
+        return JSONResponse(status_code=409, content={"error": f"Job already {queued.status}"})
+    return job_store.describe(queued)
 
 
 @router.get("/list")
@@ -349,7 +802,15 @@ def list_conversions(
     max_page_size = min(limit if limit > 0 else 200, 200)
     page_size = max(1, min(page_size or 10, max_page_size))
 
-    q = db.query(models.Conversion)
+    # blobs are never needed here; whether a preview can be served is answered by the database
+    has_thumb = (
+        models.Conversion.output_blob.isnot(None)
+        | models.Conversion.output_thumb_blob.isnot(None)
+        | exists().where(models.ConversionThumbnail.conversion_id == models.Conversion.id)
+    ).label("has_thumb")
+    q = db.query(models.Conversion, has_thumb).options(
+        defer(models.Conversion.output_blob), defer(models.Conversion.output_thumb_blob)
+    ).filter(models.Conversion.preview.is_(False))
     if mode:
         q = q.filter(func.lower(models.Conversion.mode) == mode.lower())
 
@@ -369,9 +830,9 @@ def list_conversions(
             "chosen_params": r.chosen_params,
             "output_size_bytes": r.output_size_bytes,
             "output_mime": r.output_mime,
-            "has_thumb": bool(r.output_thumb_blob),
+            "has_thumb": bool(thumb),
         }
-        for r in rows
+        for r, thumb in rows
     ]
     total_pages = ceil(total / page_size) if page_size else 0
     return {"items": items, "meta": {"total": total, "page": page, "page_size": page_size, "total_pages": total_pages}}
@@ -382,7 +843,12 @@ def conversion_detail(conversion_id: int, db: Session = Depends(get_db)):
     """
     Returns metadata plus URLs for original/output to hydrate gallery/preview.
     """
-    conv = db.query(models.Conversion).filter(models.Conversion.id == conversion_id).first()
+    conv = (
+        db.query(models.Conversion)
+        .options(*(defer(column) for column in _OUTPUT_BLOBS.values()), defer(models.Conversion.output_thumb_blob))
+        .filter(models.Conversion.id == conversion_id)
+        .first()
+    )
     if not conv:
         return JSONResponse(status_code=404, content={"error": "Conversion not found"})
 
@@ -395,34 +861,79 @@ def conversion_detail(conversion_id: int, db: Session = Depends(get_db)):
         "device": conv.device,
         "output_size_bytes": conv.output_size_bytes,
         "output_mime": conv.output_mime,
+        "output_stats": conv.output_stats,
         "output_url": f"/conversion/output/{conv.id}",
         "original_url": f"/conversion/original/{conv.image_id}" if conv.image_id else None,
     }
 
 
-@router.get("/output/{conversion_id}")
-def get_conversion_output(conversion_id: int, db: Session = Depends(get_db)):
-    conv = db.query(models.Conversion).filter(models.Conversion.id == conversion_id).first()
-    if not conv or not conv.output_blob:
-        return JSONResponse(status_code=404, content={"error": "Output not found"})
+@router.get("/output/{conversion_id}")
+def get_conversion_output(
+    conversion_id: int,
+    accept_encoding: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """Output bytes; SVGs come gzip/brotli-encoded when the client accepts a stored variant."""
+    # only the variant that is actually sent gets loaded
+    row = (
+        db.query(
+            models.Conversion,
+            models.Conversion.output_blob.isnot(None).label("has_output"),
+            models.Conversion.output_gzip_blob.isnot(None).label("gzip"),
+            models.Conversion.output_br_blob.isnot(None).label("br"),
+        )
+        .options(*(defer(column) for column in _OUTPUT_BLOBS.values()), defer(models.Conversion.output_thumb_blob))
+        .filter(models.Conversion.id == conversion_id)
+        .first()
+    )
+    conv = row[0] if row else None
+    if conv and not row.has_output and conv.output_size_bytes:
+        return JSONResponse(status_code=410, content={"error": "Output expired by retention policy; only the thumbnail is kept"})
+    if not conv or not row.has_output:
+        return JSONResponse(status_code=404, content={"error": "Output not found"})
     mime = conv.output_mime or ("image/svg+xml" if conv.mode in {"vectorize", "outline"} else "image/png")
     ext = mime.split("/")[-1] if "/" in mime else "bin"
     safe_name = conv.image_name or "output"
     headers = {"Content-Disposition": f'inline; filename="{safe_name}.{ext}"'}
-    return StreamingResponse(io.BytesIO(conv.output_blob), media_type=mime, headers=headers)
+    available = [encoding for encoding in svg_optimize.ENCODINGS if getattr(row, encoding)]
+    encoding = svg_optimize.choose_encoding(accept_encoding, available)
+    if available:
+        headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    body = getattr(conv, _OUTPUT_BLOBS[encoding].key)
+    return StreamingResponse(io.BytesIO(body), media_type=mime, headers=headers)
 
 
 @router.get("/thumb/{conversion_id}")
-def get_conversion_thumb(conversion_id: int, db: Session = Depends(get_db)):
-    conv = db.query(models.Conversion).filter(models.Conversion.id == conversion_id).first()
+def get_conversion_thumb(conversion_id: int, size: int = thumbnails.DEFAULT_SIZE, db: Session = Depends(get_db)):
+    """
+    WebP preview whose longest side fits `size` (snapped up to one of THUMBNAIL_SIZES), rendered and
+    cached on first request. Stored previews never change, so clients may cache them indefinitely;
+    the unrendered source sent when rendering fails must be revalidated.
+    """
+    size = thumbnails.snap_size(size)
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+    row = thumbnails.cached(db, conversion_id, size)
+    metrics.cache_lookup("thumbnail", row is not None)
+    if row is not None:
+        return StreamingResponse(io.BytesIO(row.blob), media_type=row.mime, headers=headers)
+
+    conv = (
+        db.query(models.Conversion)
+        .options(defer(models.Conversion.output_gzip_blob), defer(models.Conversion.output_br_blob))
+        .filter(models.Conversion.id == conversion_id)
+        .first()
+    )
     if not conv:
         return JSONResponse(status_code=404, content={"error": "Conversion not found"})
-    if conv.output_thumb_blob:
-        return StreamingResponse(io.BytesIO(conv.output_thumb_blob), media_type="image/webp")
-    if conv.output_blob:
-        mime = conv.output_mime or ("image/svg+xml" if conv.mode in {"vectorize", "outline"} else "image/png")
-        return StreamingResponse(io.BytesIO(conv.output_blob), media_type=mime)
-    return JSONResponse(status_code=404, content={"error": "Thumbnail not available"})
+    thumb = thumbnails.render_and_store(db, conv, size)
+    if thumb is None:
+        return JSONResponse(status_code=404, content={"error": "Thumbnail not available"})
+    data, mime, stored = thumb
+    if not stored:
+        headers = {"Cache-Control": "no-cache"}
+    return StreamingResponse(io.BytesIO(data), media_type=mime, headers=headers)
 
 
 @router.get("/original/{image_id}")
@@ -434,12 +945,62 @@ def get_original_image(image_id: int, db: Session = Depends(get_db)):
     return StreamingResponse(io.BytesIO(img.original_blob), media_type="application/octet-stream", headers=headers)
 
 
+@router.get("/profiles", dependencies=[Depends(profiling.require_admin)])
+def list_profiles(conversion_id: Optional[int] = None, image_id: Optional[int] = None, db: Session = Depends(get_db)):
+    """
+    Lists stored profile artifacts for a conversion (convert) or an image (recommend). Admin only.
+    """
+    if conversion_id is None and image_id is None:
+        return JSONResponse(status_code=400, content={"error": "conversion_id or image_id is required"})
+    q = db.query(models.ProfileArtifact)
+    if conversion_id is not None:
+        q = q.filter(models.ProfileArtifact.conversion_id == conversion_id)
+    if image_id is not None:
+        q = q.filter(models.ProfileArtifact.image_id == image_id)
+    return [
+        {
+            "id": a.id,
+            "conversion_id": a.conversion_id,
+            "image_id": a.image_id,
+            "endpoint": a.endpoint,
+            "reason": a.reason,
+            "name": a.name,
+            "content_type": a.content_type,
+            "size_bytes": len(a.blob or b""),
+            "url": f"/conversion/profiles/{a.id}",
+        }
+        for a in q.order_by(models.ProfileArtifact.id).all()
+    ]
+
+
+@router.get("/profiles/{artifact_id}", dependencies=[Depends(profiling.require_admin)])
+def get_profile(artifact_id: int, db: Session = Depends(get_db)):
+    artifact = db.query(models.ProfileArtifact).filter(models.ProfileArtifact.id == artifact_id).first()
+    if not artifact:
+        return JSONResponse(status_code=404, content={"error": "Profile not found"})
+    headers = {"Content-Disposition": f'inline; filename="{artifact.name}"'}
+    return StreamingResponse(
+        io.BytesIO(artifact.blob), media_type=artifact.content_type or "application/octet-stream", headers=headers
+    )
+
+
 @router.delete("/{conversion_id}")
 def delete_conversion(conversion_id: int, db: Session = Depends(get_db)):
     conv = db.query(models.Conversion).filter(models.Conversion.id == conversion_id).first()
     if not conv:
         return JSONResponse(status_code=404, content={"error": "Conversion not found"})
+    stages = {
+        s.stage: s.seconds
+        for s in db.query(models.ConversionStage).filter(models.ConversionStage.conversion_id == conversion_id)
+    }
+    rollup.record_conversion(db, conv, stages, sign=-1)
+    db.query(models.ConversionStage).filter(models.ConversionStage.conversion_id == conversion_id).delete()
+    db.query(models.ProfileArtifact).filter(models.ProfileArtifact.conversion_id == conversion_id).delete()
+    db.query(models.ConversionThumbnail).filter(models.ConversionThumbnail.conversion_id == conversion_id).delete()
+    db.query(models.ConversionJob).filter(models.ConversionJob.conversion_id == conversion_id).delete()
     db.delete(conv)
+    # the upload goes too unless another conversion or a recommendation still uses it
+    retention.delete_image_if_orphaned(db, conv.image_id)
     db.commit()
 
     return {"deleted": True, "id": conversion_id}
@@ -0,0 +1,136 @@
+"""
+Single-flight coalescing of identical in-flight conversions.
+
+Requests whose upload bytes (sha256) and canonical parameters match a conversion that is still
+running attach to it instead of starting their own pipeline; every attached request receives
+the same output. Nothing is kept once the flight finishes: this only saves the duplicate work
+of double-clicks and bursts of the same sample image, it is not a result cache.
+
+A flight runs the pipeline under its own internal Job, whose stage/progress events are mirrored
+to the jobs of all attached requests. Cancelling one request only detaches it; the pipeline is
+cancelled (children killed) when the last request waiting for it has gone.
+
+Profiled requests (see profiling.py) always run their own pipeline, so the profiler sees it; other
+requests may still attach to theirs. Set SINGLEFLIGHT=0 to run every request separately.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app import metrics
+from app.features.conversion import jobs
+from app.features.conversion.pipeline import EXECUTOR
+from app.features.helpers.timing import StageTimer
+
+SINGLEFLIGHT = os.getenv("SINGLEFLIGHT", "1").lower() in {"1", "true", "yes"}
+
+# parameters that influence each mode's output; everything else is ignored for the key
+MODE_PARAMS = {
+    "vectorize": ("hierarchical", "filter_speckle", "color_precision", "gradient_step", "preset", "mode",
+                  "upscale_tier", "tracer"),
+    "vectorize:spline": ("corner_threshold", "segment_length", "splice_threshold"),
+    "outline": ("low", "high", "tracer"),
+    "enhance": ("upscale_tier", "output_format", "quality", "png_level"),
+}
+
+# run(pipeline_job, pipeline_timer) -> result; executed on the conversion executor
+FlightFn = Callable[[jobs.Job, StageTimer], Any]
+
+
+def request_key(data: bytes, mode: str, params: dict) -> str:
+    """sha256 of the input plus the mode's parameters in canonical (sorted JSON) form."""
+    names = list(MODE_PARAMS.get(mode, sorted(params)))
+    if mode == "vectorize" and params.get("mode") == "spline":
+        names += MODE_PARAMS["vectorize:spline"]
+    fields = {"mode": mode, "preview": bool(params.get("preview")), **{n: params.get(n) for n in names}}
+    canonical = json.dumps(fields, sort_keys=True)
+    return hashlib.sha256(data).hexdigest() + ":" + hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+class Flight:
+    """One running pipeline and the requests waiting for it (event-loop side only)."""
+
+    def __init__(self, key: str, mode: str):
+        self.key = key
+        self.job = jobs.Job(f"flight-{key[:12]}")
+        self.job.mode = mode
+        self.job.set_state("queued")
+        self.timer = StageTimer(listener=self.job.on_stage)
+        self.waiters = 0
+        self.future: Optional[asyncio.Future] = None
+
+    def _finished(self, future: asyncio.Future):
+        if _flights.get(self.key) is self:
+            del _flights[self.key]
+        if not future.cancelled():
+            future.exception()  # retrieved here in case every waiter has left
+
+    async def wait(self, job: Optional[jobs.Job]) -> Any:
+        """
+        The pipeline's result. With a job, its cancellation detaches this request (JobCancelled)
+        and stops the pipeline once no other request is waiting.
+        """
+        if job is None:
+            return await asyncio.shield(self.future)
+        loop = asyncio.get_running_loop()
+        cancel_requested = asyncio.Event()
+        job.on_cancel(lambda: loop.call_soon_threadsafe(cancel_requested.set))
+        cancel_wait = asyncio.ensure_future(cancel_requested.wait())
+        try:
+            await asyncio.wait({self.future, cancel_wait}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            cancel_wait.cancel()
+        if self.future.done():
+            return self.future.result()
+        self._leave()
+        raise jobs.JobCancelled(f"Job {job.id} cancelled")
+
+    def _leave(self):
+        self.waiters -= 1
+        if self.waiters <= 0 and not self.future.done():
+            _flights.pop(self.key, None)  # a cancelled pipeline must not pick up new requests
+            self.job.cancel()
+
+
+_flights: Dict[str, Flight] = {}
+
+
+def join(key: str, mode: str, run: FlightFn, job: Optional[jobs.Job], attach: bool = True) -> Tuple[Flight, bool]:
+    """
+    The in-flight conversion for `key`, started with `run` if there is none (or `attach` is
+    False). Returns the flight and whether this request started it. Must be called on the event loop.
+    """
+    flight = _flights.get(key) if SINGLEFLIGHT and attach else None
+    created = flight is None
+    metrics.cache_lookup("inflight_conversion", not created)
+    if created:
+        flight = Flight(key, mode)
+        flight.future = asyncio.get_running_loop().run_in_executor(EXECUTOR, run, flight.job, flight.timer)
+        flight.future.add_done_callback(flight._finished)
+        if SINGLEFLIGHT:
+            _flights[key] = flight
+    else:
+        metrics.CONVERSIONS_COALESCED.labels(mode=mode).inc()
+    flight.waiters += 1
+    if job is not None:
+        flight.job.mirror_to(job)
+    return flight, created
+
+
+async def run(key: str, mode: str, fn: FlightFn, job: Optional[jobs.Job], timer: StageTimer,
+              attach: bool = True) -> Any:
+    """
+    Join (unless not `attach`) or start the flight for `key` and wait for it. The request that started it gets the
+    pipeline's stage timings merged into `timer`; attached ones record their wait as "coalesced".
+    """
+    start = time.perf_counter()
+    flight, created = join(key, mode, fn, job, attach)
+    result = await flight.wait(job)
+    if created:
+        timer.merge(flight.timer.stages)
+    else:
+        timer.add("coalesced", time.perf_counter() - start)
+    return result
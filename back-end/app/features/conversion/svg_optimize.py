@@ -0,0 +1,448 @@
+"""
+Minification and pre-compression of traced SVG outputs (vtracer / potrace).
+
+`process` runs on every SVG a pipeline produces, before it is stored:
+
+- path data is re-serialized with coordinates rounded to SVG_PRECISION decimals. Rounding is
+  done on absolute positions and each command is then written in whichever of its absolute or
+  relative forms is shorter, so relative commands do not accumulate rounding drift
+- vtracer's per-path `translate(...)` transforms are folded into the path data
+- runs of consecutive sibling paths with identical attributes are merged into one path when
+  their bounding boxes do not overlap (disjoint subpaths fill the same pixels under either fill
+  rule, and nothing is painted between them, so the rendering is unchanged)
+- comments, <metadata>, XML prolog, insignificant whitespace and attributes that restate a
+  default or an inherited value are dropped; colors are lower-cased and shortened
+
+The result is stored as the output, together with gzip and (if the `brotli` package is
+installed) brotli encodings listed in SVG_PRECOMPRESS, which /conversion/output and
+/conversion/convert serve to clients whose Accept-Encoding allows it. Sizes before/after go into
+conversions.output_stats and the time spent into the svg_optimize / compress stages.
+
+Anything this module cannot handle safely (arcs, non-translate transforms) is left as-is, and
+if optimization fails the raw SVG is stored unchanged.
+"""
+import gzip
+import os
+import re
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from app import metrics
+from app.features.helpers.timing import StageTimer
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+SVG_OPTIMIZE = os.getenv("SVG_OPTIMIZE", "1").lower() in {"1", "true", "yes"}
+SVG_PRECISION = int(os.getenv("SVG_PRECISION", "2"))
+SVG_PRECOMPRESS = [e.strip() for e in os.getenv("SVG_PRECOMPRESS", "br,gzip").split(",") if e.strip()]
+SVG_GZIP_LEVEL = int(os.getenv("SVG_GZIP_LEVEL", "9"))
+# quality 11 is several times slower than 9 for ~5% smaller files; traced photos can be tens of MB
+SVG_BROTLI_QUALITY = int(os.getenv("SVG_BROTLI_QUALITY", "9"))
+# paths merged into one at most; bounds the pairwise overlap checks
+SVG_MERGE_MAX_PATHS = int(os.getenv("SVG_MERGE_MAX_PATHS", "64"))
+
+SVG_MIME = "image/svg+xml"
+SVG_NS = "http://www.w3.org/2000/svg"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+ET.register_namespace("", SVG_NS)
+ET.register_namespace("xlink", XLINK_NS)
+
+# server-side preference when the client accepts several
+ENCODINGS = ("br", "gzip")
+
+_PATH = f"{{{SVG_NS}}}path"
+_GROUP = f"{{{SVG_NS}}}g"
+_DROP_ELEMENTS = {f"{{{SVG_NS}}}metadata"}
+_TEXT_ELEMENTS = {f"{{{SVG_NS}}}{name}" for name in ("text", "tspan", "title", "desc", "style", "textPath")}
+
+_ARITY = {"M": 2, "L": 2, "H": 1, "V": 1, "C": 6, "S": 4, "Q": 4, "T": 2, "A": 7, "Z": 0}
+_PATH_TOKEN = re.compile(r"[MmLlHhVvCcSsQqTtAaZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_TRANSLATE = re.compile(r"^\s*translate\(\s*([^,\s)]+)(?:[\s,]+([^,\s)]+))?\s*\)\s*$")
+_HEX_COLOR = re.compile(r"^#([0-9a-fA-F]{6})$")
+
+# presentation attributes that inherit, with their initial values
+_INHERITED_DEFAULTS = {
+    "fill": "#000",
+    "fill-rule": "nonzero",
+    "fill-opacity": "1",
+    "stroke": "none",
+    "stroke-width": "1",
+    "stroke-opacity": "1",
+    "stroke-linecap": "butt",
+    "stroke-linejoin": "miter",
+}
+# attributes that are always redundant when they carry this value
+_REDUNDANT = {
+    "version": None,  # any value; ignored by renderers
+    "opacity": "1",
+    "preserveAspectRatio": "xMidYMid meet",
+    "enable-background": None,
+    "{http://www.w3.org/XML/1998/namespace}space": None,
+}
+
+Segment = Tuple[str, List[float]]  # (absolute command letter, absolute coordinates)
+BBox = Tuple[float, float, float, float]
+Encoded = Dict[str, bytes]  # encoding -> body
+
+
+def fmt(value: float, precision: int) -> str:
+    """Shortest decimal text for `value` rounded to `precision` places ("0.50" -> ".5", "-0" -> "0")."""
+    text = f"{round(value, precision):.{max(precision, 0)}f}"
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    if text in ("-0", ""):
+        return "0"
+    if text.startswith("0."):
+        return text[1:]
+    if text.startswith("-0."):
+        return "-" + text[2:]
+    return text
+
+
+def _join(numbers: List[str]) -> str:
+    """Numbers with separators only where the grammar needs them."""
+    out = []
+    previous = None
+    for n in numbers:
+        if previous is not None and not (n[0] == "-" or (n[0] == "." and "." in previous)):
+            out.append(" ")
+        out.append(n)
+        previous = n
+    return "".join(out)
+
+
+def _shorten_number_text(value: str, precision: int = 6) -> str:
+    """Rewrite each number inside an attribute (viewBox, width, transform...) without padding zeros."""
+    return _NUMBER.sub(lambda m: fmt(float(m.group()), precision), value)
+
+
+def _shorten_color(value: str) -> str:
+    m = _HEX_COLOR.match(value)
+    if not m:
+        return value
+    h = m.group(1).lower()
+    if h[0] == h[1] and h[2] == h[3] and h[4] == h[5]:
+        return "#" + h[0] + h[2] + h[4]
+    return "#" + h
+
+
+# -----------------------
+# Path data
+# -----------------------
+
+def parse_path(d: str, dx: float = 0.0, dy: float = 0.0) -> Optional[List[Segment]]:
+    """
+    Path data as absolute segments, shifted by (dx, dy). Returns None for data this module does
+    not rewrite (arcs, whose compact flag syntax the tokenizer does not handle, or malformed data).
+    """
+    tokens = _PATH_TOKEN.findall(d)
+    segments: List[Segment] = []
+    cx, cy = dx, dy  # current point (a leading relative moveto starts from the shifted origin)
+    sx, sy = dx, dy  # start of the current subpath
+    i = 0
+    command = None
+    while i < len(tokens):
+        token = tokens[i]
+        if token.isalpha():
+            command = token
+            i += 1
+        elif command is None:
+            return None
+        upper = command.upper()
+        if upper == "A":
+            return None
+        relative = command.islower()
+        if upper == "Z":
+            segments.append(("Z", []))
+            cx, cy = sx, sy
+            command = None
+            continue
+        arity = _ARITY[upper]
+        args = tokens[i:i + arity]
+        if len(args) < arity or any(a.isalpha() for a in args):
+            return None
+        values = [float(a) for a in args]
+        i += arity
+
+        if upper == "H":
+            x = values[0] + (cx if relative else dx)
+            segments.append(("L", [x, cy]))
+            cx = x
+        elif upper == "V":
+            y = values[0] + (cy if relative else dy)
+            segments.append(("L", [cx, y]))
+            cy = y
+        else:
+            ox, oy = (cx, cy) if relative else (dx, dy)
+            coords = [v + (ox if k % 2 == 0 else oy) for k, v in enumerate(values)]
+            segments.append((upper, coords))
+            cx, cy = coords[-2], coords[-1]
+            if upper == "M":
+                sx, sy = cx, cy
+                # further pairs after a moveto are implicit linetos
+                command = "l" if relative else "L"
+    return segments
+
+
+def bbox(segments: List[Segment]) -> Optional[BBox]:
+    """Bounds of all end and control points (a superset of the painted area)."""
+    xs = [c for _, coords in segments for c in coords[0::2]]
+    ys = [c for _, coords in segments for c in coords[1::2]]
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _overlaps(a: BBox, b: BBox) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _units_text(n: int, precision: int, scale: int) -> str:
+    """Text of n / 10**precision without padding zeros (integer arithmetic, no float formatting)."""
+    sign = "-" if n < 0 else ""
+    whole, frac = divmod(abs(n), scale)
+    if not frac:
+        return sign + str(whole) if whole else "0"
+    return f"{sign}{whole or ''}.{str(frac).rjust(precision, '0').rstrip('0')}"
+
+
+def serialize_path(segments: List[Segment], precision: int) -> str:
+    """
+    Absolute segments as compact path data. Positions are rounded absolutely (to integer units of
+    10**-precision, so relative offsets are exact); every command is written in the shorter of
+    its absolute and relative forms. The first moveto is always absolute, so serialized paths can
+    be concatenated.
+    """
+    precision = max(precision, 0)
+    scale = 10 ** precision
+    out: List[str] = []
+    last_letter = None
+    cx = cy = 0  # current point in rounded units
+    sx = sy = 0
+    for index, (letter, coords) in enumerate(segments):
+        if letter == "Z":
+            out.append("z")
+            last_letter = "z"
+            cx, cy = sx, sy
+            continue
+        rounded = [round(c * scale) for c in coords]
+        x, y = rounded[-2], rounded[-1]
+
+        if letter == "L" and y == cy and x != cx:
+            forms = [("H", [x]), ("h", [x - cx])]
+        elif letter == "L" and x == cx:
+            forms = [("V", [y]), ("v", [y - cy])]
+        else:
+            relative = [v - (cx if k % 2 == 0 else cy) for k, v in enumerate(rounded)]
+            forms = [(letter, rounded), (letter.lower(), relative)]
+        if index == 0:
+            forms = forms[:1]
+
+        best = None
+        for form_letter, values in forms:
+            body = _join([_units_text(v, precision, scale) for v in values])
+            # a repeated command may omit its letter (but a repeated moveto would become a lineto)
+            implicit = form_letter == last_letter and form_letter not in "Mm"
+            text = (body if body[0] == "-" else " " + body) if implicit else form_letter + body
+            if best is None or len(text) < len(best[1]):
+                best = (form_letter, text)
+        out.append(best[1])
+        last_letter = best[0]
+        cx, cy = x, y
+        if letter == "M":
+            sx, sy = x, y
+    return "".join(out)
+
+
+# -----------------------
+# Tree
+# -----------------------
+
+def _clean_attributes(elem: ET.Element, inherited: Dict[str, str]):
+    for name in list(elem.attrib):
+        value = elem.attrib[name].strip()
+        if name in ("fill", "stroke", "stop-color", "color"):
+            value = _shorten_color(value)
+        elif name in ("viewBox", "width", "height", "transform", "x", "y", "stroke-width"):
+            value = _shorten_number_text(value)
+        if value == "" or (name in _REDUNDANT and _REDUNDANT[name] in (None, value)):
+            del elem.attrib[name]
+        elif name in _INHERITED_DEFAULTS and inherited.get(name, _INHERITED_DEFAULTS[name]) == value:
+            del elem.attrib[name]
+        else:
+            elem.attrib[name] = value
+
+
+def _rewrite_path(elem: ET.Element, precision: int) -> Optional[BBox]:
+    """Fold a translate transform into the data and re-serialize it; returns its bbox if mergeable."""
+    d = elem.get("d")
+    if not d:
+        return None
+    dx = dy = 0.0
+    transform = elem.get("transform")
+    if transform:
+        m = _TRANSLATE.match(transform)
+        if not m:
+            return None
+        dx, dy = float(m.group(1)), float(m.group(2) or 0)
+    segments = parse_path(d, dx, dy)
+    if not segments:
+        return None
+    elem.set("d", serialize_path(segments, precision))
+    elem.attrib.pop("transform", None)
+    return bbox(segments)
+
+
+def _merge_paths(parent: ET.Element, boxes: Dict[int, BBox]):
+    """Merge runs of same-attribute sibling paths with disjoint bboxes into the run's first path."""
+    kept: List[ET.Element] = []
+    run: List[ET.Element] = []
+    run_boxes: List[BBox] = []
+
+    def flush():
+        if len(run) > 1:
+            run[0].set("d", "".join(p.get("d") for p in run))
+        if run:
+            kept.append(run[0])
+        run.clear()
+        run_boxes.clear()
+
+    for child in parent:
+        box = boxes.get(id(child))
+        if child.tag != _PATH or box is None or len(child):
+            flush()
+            kept.append(child)
+            continue
+        if run:
+            attrs = {k: v for k, v in child.attrib.items() if k != "d"}
+            same = attrs == {k: v for k, v in run[0].attrib.items() if k != "d"}
+            if not same or len(run) >= SVG_MERGE_MAX_PATHS or any(_overlaps(box, b) for b in run_boxes):
+                flush()
+        run.append(child)
+        run_boxes.append(box)
+    flush()
+    # one slice assignment instead of per-child remove(), which is linear in the sibling count
+    parent[:] = kept
+
+
+def _walk(elem: ET.Element, inherited: Dict[str, str], precision: int, stats: dict):
+    elem[:] = [child for child in elem if isinstance(child.tag, str) and child.tag not in _DROP_ELEMENTS]
+    if elem.tag not in _TEXT_ELEMENTS:
+        if elem.text is not None and not elem.text.strip():
+            elem.text = None
+        for child in elem:
+            if child.tail is not None and not child.tail.strip():
+                child.tail = None
+
+    boxes: Dict[int, BBox] = {}
+    for child in elem:
+        _clean_attributes(child, inherited)
+        if child.tag == _PATH:
+            stats["paths_in"] += 1
+            box = _rewrite_path(child, precision)
+            if box is not None:
+                boxes[id(child)] = box
+        else:
+            scope = dict(inherited)
+            scope.update({k: v for k, v in child.attrib.items() if k in _INHERITED_DEFAULTS})
+            _walk(child, scope, precision, stats)
+    _merge_paths(elem, boxes)
+
+    # attribute-less groups only add nesting; empty ones nothing at all
+    flattened: List[ET.Element] = []
+    for child in elem:
+        if child.tag == _GROUP and not child.attrib and child.tail is None:
+            flattened.extend(child)
+        else:
+            flattened.append(child)
+    elem[:] = flattened
+
+
+def optimize(svg: bytes, precision: int = SVG_PRECISION) -> Tuple[bytes, dict]:
+    """Minified SVG and {paths_in, paths_out}. Raises on input that is not parseable SVG."""
+    root = ET.fromstring(svg)
+    stats = {"paths_in": 0}
+    _clean_attributes(root, {})
+    _walk(root, {k: v for k, v in root.attrib.items() if k in _INHERITED_DEFAULTS}, precision, stats)
+    stats["paths_out"] = sum(1 for _ in root.iter(_PATH))
+    data = ET.tostring(root, encoding="utf-8", xml_declaration=False, short_empty_elements=True)
+    # ElementTree writes empty elements as "<path ... />"; ">" never appears unescaped in text
+    return data.replace(b" />", b"/>"), stats
+
+
+# -----------------------
+# Encodings
+# -----------------------
+
+def compress(data: bytes) -> Encoded:
+    """Pre-compressed variants per SVG_PRECOMPRESS; ones that would not be smaller are skipped."""
+    encoded: Encoded = {}
+    for encoding in SVG_PRECOMPRESS:
+        if encoding == "gzip":
+            body = gzip.compress(data, compresslevel=SVG_GZIP_LEVEL, mtime=0)
+        elif encoding == "br" and brotli is not None:
+            body = brotli.compress(data, quality=SVG_BROTLI_QUALITY)
+        else:
+            continue
+        if len(body) < len(data):
+            encoded[encoding] = body
+    return encoded
+
+
+def accepted_encodings(header: Optional[str]) -> set:
+    """Content codings an Accept-Encoding header allows (q > 0; `*` counts as every coding)."""
+    accepted, refused = set(), set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        (accepted if q > 0 else refused).add(name)
+    if "*" in accepted:
+        accepted.update(e for e in ENCODINGS if e not in refused)
+    return accepted - refused
+
+
+def choose_encoding(header: Optional[str], available) -> Optional[str]:
+    """Preferred stored encoding the client accepts, or None for the identity body."""
+    accepted = accepted_encodings(header)
+    return next((e for e in ENCODINGS if e in available and e in accepted), None)
+
+
+def process(svg: bytes, timer: StageTimer) -> Tuple[bytes, Encoded, dict]:
+    """
+    Optimize and pre-compress a pipeline's SVG output. Returns (svg, {encoding: body}, stats);
+    on failure the raw SVG is kept.
+    """
+    stats = {"raw_bytes": len(svg), "precision": SVG_PRECISION}
+    if SVG_OPTIMIZE:
+        with timer.stage("svg_optimize"):
+            try:
+                svg, tree_stats = optimize(svg, SVG_PRECISION)
+                stats.update(tree_stats)
+            except Exception as e:
+                logger.warning(f"SVG optimization failed, storing raw output: {e}")
+    with timer.stage("compress"):
+        encoded = compress(svg)
+    stats["bytes"] = len(svg)
+    stats.update({f"{encoding}_bytes": len(body) for encoding, body in encoded.items()})
+
+    metrics.SVG_BYTES.labels(stage="raw").inc(stats["raw_bytes"])
+    metrics.SVG_BYTES.labels(stage="optimized").inc(stats["bytes"])
+    for encoding, body in encoded.items():
+        metrics.SVG_BYTES.labels(stage=encoding).inc(len(body))
+    return svg, encoded, stats
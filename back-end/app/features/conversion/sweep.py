@@ -0,0 +1,148 @@
+"""
+Parameter sweeps: one image, many outline/vectorize settings.
+
+POST /conversion/sweep prepares the image once and traces every parameter set from that shared
+state in parallel on SWEEP_WORKERS threads (each variant waits on its own potrace/vtracer child):
+
+- outline:   decode + Gaussian blur once (outline.blur_image), then Canny/PBM/trace per (low, high)
+- vectorize: the raster vtracer would trace once (ESRGAN-upscaled when the image is blurry, see
+             pipeline.prepare_vectorize_raster), then one trace per settings
+
+With preview=true the image is first reduced to a PREVIEW_MAX_SIDE proxy and ESRGAN is skipped,
+as for /convert previews. All variants use the same tracer backend (`tracer`, see tracers.py).
+Each variant's SVG is minified (svg_optimize.optimize) and returned
+inline with its own stage timings and size; a variant that fails (including an SVG the optimizer
+cannot parse) reports its error without failing the others. Sweeps are not stored as conversions.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.features.conversion import outline, preview, svg_optimize, tracers
+from app.features.conversion.pipeline import prepare_vectorize_raster
+from app.features.helpers.timing import StageTimer
+
+SWEEP_MAX_VARIANTS = int(os.getenv("SWEEP_MAX_VARIANTS", "16"))
+SWEEP_WORKERS = int(os.getenv("SWEEP_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# separate from the conversion executor: sweeps run on it and fan out from there
+SWEEP_EXECUTOR = ThreadPoolExecutor(max_workers=SWEEP_WORKERS, thread_name_prefix="sweep")
+
+# the /convert defaults; a variant overrides any of them
+DEFAULTS: Dict[str, dict] = {
+    "outline": {"low": 100, "high": 200},
+    "vectorize": {
+        "hierarchical": "stacked",
+        "filter_speckle": 8,
+        "color_precision": 6,
+        "gradient_step": 60,
+        "mode": "spline",
+        "corner_threshold": 40,
+        "segment_length": 10,
+        "splice_threshold": 80,
+    },
+}
+
+
+class SweepError(ValueError):
+    pass
+
+
+def parse_variants(mode: str, raw: str) -> List[dict]:
+    """Validate the `variants` form field (a JSON list of parameter overrides) into full parameter sets."""
+    defaults = DEFAULTS.get(mode)
+    if defaults is None:
+        raise SweepError(f"Sweeps support {', '.join(DEFAULTS)}, not {mode}")
+    try:
+        overrides = json.loads(raw)
+    except ValueError:
+        raise SweepError("variants must be a JSON list of objects")
+    if not isinstance(overrides, list) or not all(isinstance(v, dict) for v in overrides):
+        raise SweepError("variants must be a JSON list of objects")
+    if not 1 <= len(overrides) <= SWEEP_MAX_VARIANTS:
+        raise SweepError(f"variants must contain 1-{SWEEP_MAX_VARIANTS} parameter sets")
+
+    variants = []
+    for override in overrides:
+        unknown = set(override) - set(defaults)
+        if unknown:
+            raise SweepError(f"Unknown {mode} parameters: {', '.join(sorted(unknown))}")
+        params = dict(defaults)
+        for name, value in override.items():
+            try:
+                params[name] = type(defaults[name])(value)
+            except (TypeError, ValueError):
+                raise SweepError(f"Invalid value for {name}: {value!r}")
+        variants.append(params)
+    return variants
+
+
+def _outline_variant(blurred, params: dict, work_dir: Path, index: int, tracer: str, timer: StageTimer) -> Path:
+    pbm_path = work_dir / f"variant_{index}.pbm"
+    svg_path = work_dir / f"variant_{index}.svg"
+    with timer.stage("edges"):
+        edges = outline.edges_from_blurred(blurred, params["low"], params["high"])
+    with timer.stage("encode"):
+        outline.save_as_pbm(edges, pbm_path)
+    with timer.stage("trace"):
+        tracers.get(tracer).trace(str(pbm_path), str(svg_path), {})
+    return svg_path
+
+
+def _vectorize_variant(raster: Path, params: dict, work_dir: Path, index: int, tracer: str,
+                       timer: StageTimer) -> Path:
+    svg_path = work_dir / f"variant_{index}.svg"
+    with timer.stage("trace"):
+        tracers.get(tracer).trace(str(raster), str(svg_path), params)
+    return svg_path
+
+
+def run(mode: str, input_path: Path, work_dir: Path, variants: List[dict], use_preview: bool,
+        timer: StageTimer, tracer: Optional[str] = None) -> List[dict]:
+    """
+    Prepare once (stages recorded on `timer`), then trace every variant in parallel with `tracer`
+    (the mode's default when None). Returns one result per variant, in order. Blocking; call it
+    from a worker thread.
+    """
+    tracer = tracers.resolve(mode, tracer)
+    source, size = input_path, None
+    if use_preview:
+        source, size = preview.make_proxy(input_path, work_dir, timer)
+
+    if mode == "outline":
+        with timer.stage("blur"):
+            shared = outline.blur_image(str(source))
+        trace = _outline_variant
+    elif use_preview:
+        shared = source  # previews never upscale
+        trace = _vectorize_variant
+    else:
+        shared = prepare_vectorize_raster(source, work_dir, timer)
+        trace = _vectorize_variant
+
+    def evaluate(index: int, params: dict) -> dict:
+        variant_timer = StageTimer()
+        try:
+            svg_path = trace(shared, params, work_dir, index, tracer, variant_timer)
+            if size is not None:
+                preview.fit_to(svg_path, size)
+            svg = svg_path.read_bytes()
+            if svg_optimize.SVG_OPTIMIZE:
+                with variant_timer.stage("svg_optimize"):
+                    svg, _ = svg_optimize.optimize(svg)
+        except Exception as e:
+            return {"params": params, "error": str(e), "seconds": round(variant_timer.total(), 4),
+                    "stages": variant_timer.as_dict()}
+        return {
+            "params": params,
+            "seconds": round(variant_timer.total(), 4),
+            "stages": variant_timer.as_dict(),
+            "size_bytes": len(svg),
+            "svg": svg.decode("utf-8"),
+        }
+
+    futures = [SWEEP_EXECUTOR.submit(evaluate, i, params) for i, params in enumerate(variants)]
+    with timer.stage("variants"):
+        return [f.result() for f in futures]
@@ -0,0 +1,115 @@
+"""
+Lazily rendered, size-bucketed thumbnails for conversion outputs.
+
+Nothing is rendered during /conversion/convert. GET /conversion/thumb/{id}?size=N snaps N up
+to the nearest of THUMBNAIL_SIZES, serves the cached conversion_thumbnails row if there is one,
+and otherwise renders it from the output (SVGs are rasterized with cairosvg), stores it and
+serves it. Stored previews are sent as immutable; the source served when rendering fails is
+sent with no-cache. With THUMBNAIL_PREWARM=1 (default) the default size is also rendered in a
+background task right after a conversion's response has been sent.
+
+Previews are WebP at THUMBNAIL_QUALITY with a mid encoder effort (method=4); method=6 costs
+several times more CPU for a few percent smaller files, which does not pay off at 256 px.
+"""
+import io
+import os
+from typing import Optional, Tuple
+
+from loguru import logger
+from PIL import Image
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import metrics
+from app.db import SessionLocal
+from app.db import models
+
+try:
+    import cairosvg
+except (ImportError, OSError):  # pragma: no cover - optional dependency (needs the cairo library)
+    cairosvg = None
+
+THUMBNAIL_SIZES = sorted(int(s) for s in os.getenv("THUMBNAIL_SIZES", "128,256,512").split(",") if s)
+DEFAULT_SIZE = 256
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "70"))
+THUMBNAIL_PREWARM = os.getenv("THUMBNAIL_PREWARM", "1").lower() in {"1", "true", "yes"}
+
+SVG_MIME = "image/svg+xml"
+Thumbnail = Tuple[bytes, str, bool]  # (data, mime, stored)
+
+
+def snap_size(size: Optional[int]) -> int:
+    """Smallest cached size that covers `size` (the largest one beyond that)."""
+    size = size or DEFAULT_SIZE
+    return next((s for s in THUMBNAIL_SIZES if s >= size), THUMBNAIL_SIZES[-1])
+
+
+def _is_svg(data: bytes, mime: Optional[str]) -> bool:
+    return mime == SVG_MIME or data.lstrip()[:5] in (b"<svg ", b"<?xml")
+
+
+def render(data: bytes, mime: Optional[str], size: int) -> Optional[bytes]:
+    """WebP preview with the longest side <= size; None when the source cannot be decoded."""
+    try:
+        if _is_svg(data, mime):
+            if cairosvg is None:
+                return None
+            # rasterize near the target size rather than at the SVG's (possibly huge) native size
+            data = cairosvg.svg2png(bytestring=data, output_width=size)
+        with Image.open(io.BytesIO(data)) as img:
+            img.draft("RGB", (size, size))  # JPEG: decode at reduced scale
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.getbands() or img.mode == "P" else "RGB")
+            img.thumbnail((size, size))
+            buffer = io.BytesIO()
+            img.save(buffer, format="WEBP", quality=THUMBNAIL_QUALITY, method=4)
+            return buffer.getvalue()
+    except Exception as e:
+        logger.warning(f"Thumbnail render failed: {e}")
+        return None
+
+
+def _source(conv: models.Conversion) -> Optional[Tuple[bytes, Optional[str]]]:
+    if conv.output_blob:
+        return conv.output_blob, conv.output_mime
+    if conv.output_thumb_blob:
+        # rows from before lazy thumbnails: WebP preview, or an SVG copy for vector modes
+        return conv.output_thumb_blob, SVG_MIME if _is_svg(conv.output_thumb_blob, None) else "image/webp"
+    return None
+
+
+def cached(db: Session, conversion_id: int, size: int) -> Optional[models.ConversionThumbnail]:
+    return (
+        db.query(models.ConversionThumbnail)
+        .filter(models.ConversionThumbnail.conversion_id == conversion_id, models.ConversionThumbnail.size == size)
+        .first()
+    )
+
+
+def render_and_store(db: Session, conv: models.Conversion, size: int) -> Optional[Thumbnail]:
+    """
+    Render and cache the (conversion, size) thumbnail. When nothing can be rendered (e.g. an SVG
+    without cairosvg installed) the source itself is returned, uncached (stored False).
+    """
+    source = _source(conv)
+    if source is None:
+        return None
+    data = render(source[0], source[1], size)
+    if data is None:
+        return source[0], source[1] or "application/octet-stream", False
+
+    db.add(models.ConversionThumbnail(conversion_id=conv.id, size=size, mime="image/webp", blob=data))
+    try:
+        db.commit()
+        metrics.DB_BLOB_BYTES.labels(kind="thumbnail").inc(len(data))
+    except IntegrityError:
+        db.rollback()  # rendered concurrently by another request; theirs is equivalent
+    return data, "image/webp", True
+
+
+def prewarm(conversion_id: int, size: int = DEFAULT_SIZE):
+    """Background task: render the gallery-size thumbnail of a new conversion."""
+    with SessionLocal() as db:
+        conv = db.query(models.Conversion).filter(models.Conversion.id == conversion_id).first()
+        if conv is not None and cached(db, conversion_id, size) is None:
+            render_and_store(db, conv, size)
@@ -0,0 +1,316 @@
+"""
+Bounded-memory I/O for very large inputs (gigapixel scans, posters).
+
+cv2.imread/PIL decode the whole image into RAM, and enhance then holds a 16x larger output on
+top, so a big enough upload takes down the worker. Inputs above TILED_MIN_MEGAPIXELS (40) take
+the paths below instead; smaller ones keep the in-memory code unchanged.
+
+- decode:   open_image() has PIL decode straight into a file-backed np.memmap in
+            TILED_SCRATCH_DIR (L/P/RGB/RGBA images, i.e. nearly every PNG/JPEG/TIFF/WebP/BMP),
+            so the pixels live in the page cache and are written back under memory pressure
+            instead of counting against the worker. Other modes (16-bit, CMYK) still decode in
+            RAM. /recommend analyses a copy reduced to TILED_ANALYSIS_SIDE px (read_downscaled),
+            for which JPEGs use PIL `draft` to decode at 1/2-1/8 scale in the first place.
+- process:  tiles of at most TILED_TILE px plus TILED_OVERLAP px of context on each side, so
+            GaussianBlur/Canny and ESRGAN see the same neighbourhood as on the full frame (gray
+            comes from cvtColor, which can be one level off imread's grayscale decode). Canny's
+            hysteresis only follows weak edges within that context, so a faint edge that is only
+            connected to a strong one further away than the overlap can differ at a seam.
+- write:    results go out as each band of tiles finishes: the outline PBM row by row, the
+            enhance output through PngWriter (encoding.PngStream: PNG Up filter, deflate in
+            parallel chunks), so the upscaled image never exists in memory; it is a PNG whatever
+            output format the request asked for. Bands are sized so a band's output buffer stays
+            under TILED_BUFFER_MB.
+
+Peak memory is therefore a function of the tile and buffer settings, not of the image size.
+The scratch file needs width * height * 4 bytes of disk for the duration of the conversion.
+"""
+import math
+import os
+import tempfile
+import threading
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.features.conversion import encoding, jobs
+from app.features.helpers.timing import StageTimer
+
+TILED_MIN_MEGAPIXELS = float(os.getenv("TILED_MIN_MEGAPIXELS", "40"))
+TILED_TILE = int(os.getenv("TILED_TILE", "1024"))
+TILED_OVERLAP = int(os.getenv("TILED_OVERLAP", "32"))
+TILED_BUFFER_MB = int(os.getenv("TILED_BUFFER_MB", "64"))
+TILED_SCRATCH_DIR = os.getenv("TILED_SCRATCH_DIR") or None  # default: the system temp dir
+TILED_ANALYSIS_SIDE = int(os.getenv("TILED_ANALYSIS_SIDE", "4096"))  # /recommend metadata of large inputs
+TILED_PNG_LEVEL = int(os.getenv("TILED_PNG_LEVEL", "1"))  # as cv2.imwrite
+# replaces PIL's decompression-bomb limit (MAX_IMAGE_PIXELS) on this path only; large scans are legitimate
+TILED_MAX_PIXELS = int(float(os.getenv("TILED_MAX_PIXELS", "4e9")))
+
+_MAPPABLE = {"L": 1, "P": 1, "RGB": 4, "RGBA": 4}  # PIL's in-memory bytes per pixel
+_LIMIT_LOCK = threading.Lock()
+
+
+def _open(path) -> Image.Image:
+    """
+    Image.open checked against TILED_MAX_PIXELS instead of Image.MAX_IMAGE_PIXELS. PIL checks
+    the limit while reading the header, so the global is lifted for that call only.
+    """
+    with _LIMIT_LOCK:
+        default = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            img = Image.open(path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = default
+    width, height = img.size
+    if width * height > TILED_MAX_PIXELS:
+        img.close()
+        raise Image.DecompressionBombError(
+            f"Image size ({width * height} pixels) exceeds the limit of {TILED_MAX_PIXELS} pixels (TILED_MAX_PIXELS)"
+        )
+    return img
+
+
+def image_size(path) -> Tuple[int, int]:
+    """(width, height) from the header of a path or file object, without decoding."""
+    with _open(path) as img:
+        return img.size
+
+
+def is_large(path) -> bool:
+    try:
+        width, height = image_size(path)
+    except Exception:
+        return False  # let the regular path report unreadable files
+    return width * height / 1e6 > TILED_MIN_MEGAPIXELS
+
+
+def _buffer_rows(row_bytes: int, limit: int) -> int:
+    """Rows of `row_bytes` that fit in TILED_BUFFER_MB, between 8 and `limit`."""
+    return max(8, min(limit, TILED_BUFFER_MB * 2 ** 20 // max(row_bytes, 1)))
+
+
+class MappedImage:
+    """
+    A decoded image on disk. `read` returns regions the way cv2.imread(IMREAD_UNCHANGED) would
+    (gray, BGR or BGRA uint8); only the requested region is materialised in memory.
+    """
+
+    def __init__(self, array: np.ndarray, mode: str, palette: Optional[np.ndarray] = None):
+        self._array = array
+        self.mode = mode
+        self._palette = palette  # P mode: 256 x 3 BGR lookup table
+        self.height, self.width = array.shape[:2]
+        self.channels = {"L": 1, "P": 3, "RGB": 3, "RGBA": 4}[mode]
+
+    def read(self, y0: int, y1: int, x0: int = 0, x1: Optional[int] = None) -> np.ndarray:
+        block = self._array[y0:y1, x0:x1]
+        if self.mode == "L":
+            return np.array(block)
+        if self.mode == "P":
+            return self._palette[block]
+        if self.mode == "RGB":
+            return np.ascontiguousarray(block[..., 2::-1])  # RGB(X) -> BGR
+        return np.ascontiguousarray(block[..., [2, 1, 0, 3]])
+
+    def read_gray(self, y0: int, y1: int, x0: int = 0, x1: Optional[int] = None) -> np.ndarray:
+        """Like cv2.imread(IMREAD_GRAYSCALE) for the region."""
+        block = self.read(y0, y1, x0, x1)
+        if block.ndim == 2:
+            return block
+        return cv2.cvtColor(block, cv2.COLOR_BGRA2GRAY if block.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+
+    def downscale(self, factor: int) -> np.ndarray:
+        """BGR copy reduced by an integer factor (block average), read band by band."""
+        out_w, out_h = max(self.width // factor, 1), max(self.height // factor, 1)
+        out = np.empty((out_h, out_w, 3), np.uint8)
+        band = _buffer_rows(self.width * 4, self.height) // factor * factor or factor
+        for y0 in range(0, out_h * factor, band):
+            y1 = min(y0 + band, out_h * factor)
+            block = self.read(y0, y1, 0, out_w * factor)
+            if block.ndim == 2:
+                block = cv2.cvtColor(block, cv2.COLOR_GRAY2BGR)
+            elif block.shape[2] == 4:
+                block = cv2.cvtColor(block, cv2.COLOR_BGRA2BGR)
+            out[y0 // factor:y1 // factor] = cv2.resize(
+                block, (out_w, (y1 - y0) // factor), interpolation=cv2.INTER_AREA
+            )
+        return out
+
+
+def _decode_mapped(img: Image.Image, scratch: Path) -> np.ndarray:
+    """Let PIL decode into a memmap of its own in-memory layout (stride-4 RGB, 1 byte L/P)."""
+    width, height = img.size
+    bpp = _MAPPABLE[img.mode]
+    shape = (height, width, bpp) if bpp > 1 else (height, width)
+    array = np.memmap(scratch, dtype=np.uint8, mode="w+", shape=shape)
+    img.im = Image.core.map_buffer(array, (width, height), "raw", 0, (img.mode, width * bpp, 1))
+    img.load()
+    return array
+
+
+@contextmanager
+def open_image(path, draft: Optional[Tuple[int, int]] = None) -> Iterator[MappedImage]:
+    """
+    Decode `path` into a scratch memmap (removed on exit). `draft` lets JPEGs decode at a reduced
+    scale of at least that size.
+    """
+    fd, scratch = tempfile.mkstemp(prefix="tiled-", suffix=".raw", dir=TILED_SCRATCH_DIR)
+    os.close(fd)
+    scratch = Path(scratch)
+    try:
+        with _open(path) as img:
+            if draft:
+                img.draft("RGB", draft)
+            palette = None
+            if img.mode in _MAPPABLE and "transparency" not in img.info:
+                mode = img.mode
+                array = _decode_mapped(img, scratch)
+                if mode == "P":  # getpalette() loads the image, so only after decoding
+                    rgb = np.array(img.getpalette("RGB") or [], np.uint8).reshape(-1, 3)[:, ::-1]
+                    palette = np.zeros((256, 3), np.uint8)
+                    palette[:len(rgb)] = rgb[:256]
+            else:
+                # 16-bit, CMYK, palette/gray with a transparent color, ...: converted in memory
+                mode = "RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB"
+                array = np.asarray(img.convert(mode))
+        yield MappedImage(array, mode, palette)
+    finally:
+        # unlinking a mapped file is fine on POSIX: the space is freed once the last view is gone
+        scratch.unlink(missing_ok=True)
+
+
+def read_downscaled(path, max_side: int) -> Tuple[np.ndarray, int, Tuple[int, int]]:
+    """
+    BGR copy whose longest side is at most about `max_side`, the integer reduction factor used,
+    and the original (width, height).
+    """
+    width, height = image_size(path)
+    factor = max(1, math.ceil(max(width, height) / max_side))
+    with open_image(path, draft=(width // factor, height // factor)) as image:
+        # a JPEG draft has already done part (or all) of the reduction
+        drafted = max(1, round(width / image.width))
+        return image.downscale(max(1, factor // drafted)), factor, (width, height)
+
+
+# -----------------------
+# Writers
+# -----------------------
+
+class PngWriter:
+    """Streaming PNG file: rows (gray/BGR/BGRA, as cv2) go through encoding.PngStream as they arrive."""
+
+    def __init__(self, path, width: int, height: int, channels: int, level: int = TILED_PNG_LEVEL):
+        self._file = open(path, "wb")
+        try:
+            self._stream = encoding.PngStream(self._file, width, height, channels, level)
+        except BaseException:
+            self._file.close()
+            raise
+
+    def write(self, rows: np.ndarray):
+        self._stream.write(rows)
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self._stream.finish()
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+def _check_cancelled():
+    job = jobs.current()
+    if job is not None:
+        job.check()
+
+
+def _report_tile(done: int, total: int):
+    job = jobs.current()
+    if job is not None:
+        job.on_tile(done, total)
+    else:
+        print(f"Tile {done}/{total}", flush=True)  # a parent process relays these (jobs._TILE_LINE)
+
+
+# -----------------------
+# Tiled operations
+# -----------------------
+
+def edges_to_pbm(image_path, pbm_path, low: int, high: int, tile: int = TILED_TILE, overlap: int = TILED_OVERLAP):
+    """outline.detect_edges + save_as_pbm, tile by tile: Gaussian blur and Canny per tile, PBM rows per band."""
+    with open_image(image_path) as image:
+        width, height = image.width, image.height
+        band = _buffer_rows(width, tile)
+        with open(pbm_path, "wb") as f:
+            f.write(f"P4\n{width} {height}\n".encode())
+            for y0 in range(0, height, band):
+                _check_cancelled()
+                y1 = min(y0 + band, height)
+                edges = np.empty((y1 - y0, width), np.uint8)
+                for x0 in range(0, width, tile):
+                    x1 = min(x0 + tile, width)
+                    py0, px0 = max(y0 - overlap, 0), max(x0 - overlap, 0)
+                    gray = image.read_gray(py0, min(y1 + overlap, height), px0, min(x1 + overlap, width))
+                    tile_edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), low, high)
+                    edges[:, x0:x1] = tile_edges[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+                # PBM: 1 = black = edge (what save_as_pbm writes for the inverted edge map)
+                f.write(np.packbits(edges != 0, axis=1).tobytes())
+
+
+def upscale_to_png(image: MappedImage, upsampler, scale: int, out_path, tile: int = TILED_TILE,
+                   pad: int = TILED_OVERLAP, png_level: Optional[int] = None):
+    """
+    Upscale `image` with `upsampler` (RealESRGANer-style `enhance(img, outscale)`) tile by tile,
+    each tile with `pad` px of context, streaming the result into a PNG at `out_path`.
+    """
+    # the outer tiles replace RealESRGANer's own tiling (and its "Tile i/n" lines)
+    if getattr(upsampler, "tile_size", 0):
+        tile = min(tile, upsampler.tile_size)
+        upsampler.tile_size = 0
+    width, height, channels = image.width, image.height, image.channels
+    band = _buffer_rows(width * scale * scale * channels, tile)
+    columns = math.ceil(width / tile)
+    total, done = math.ceil(height / band) * columns, 0
+    level = TILED_PNG_LEVEL if png_level is None else png_level
+    with PngWriter(out_path, width * scale, height * scale, channels, level) as writer:
+        for y0 in range(0, height, band):
+            _check_cancelled()
+            y1 = min(y0 + band, height)
+            out = None
+            for x0 in range(0, width, tile):
+                x1 = min(x0 + tile, width)
+                py0, px0 = max(y0 - pad, 0), max(x0 - pad, 0)
+                region = image.read(py0, min(y1 + pad, height), px0, min(x1 + pad, width))
+                up, _ = upsampler.enhance(region, outscale=scale)
+                if out is None:
+                    out = np.empty(((y1 - y0) * scale, width * scale, *up.shape[2:]), up.dtype)
+                oy, ox = (y0 - py0) * scale, (x0 - px0) * scale
+                out[:, x0 * scale:x1 * scale] = up[oy:oy + (y1 - y0) * scale, ox:ox + (x1 - x0) * scale]
+                done += 1
+                _report_tile(done, total)
+            writer.write(out)
+
+
+def upscale_file(input_path, out_path, upsampler, scale: int, timer: StageTimer, stage: str,
+                 tile: int = TILED_TILE, pad: int = TILED_OVERLAP, png_level: Optional[int] = None):
+    """Decode `input_path` to disk and upscale it into a PNG at `out_path`; encoding is part of `stage`."""
+    with ExitStack() as stack:
+        with timer.stage("decode"):
+            image = stack.enter_context(open_image(input_path))
+        with timer.stage(stage):
+            upscale_to_png(image, upsampler, scale, out_path, tile, pad, png_level)
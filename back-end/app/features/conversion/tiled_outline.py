@@ -0,0 +1,183 @@
+"""
+Tiled, parallel potrace for large outline inputs.
+
+potrace traces one bitmap on one core. Above OUTLINE_TILED_MIN_MEGAPIXELS (4) the edge bitmap
+outline.py writes is cut into OUTLINE_TILE (2048) px tiles instead. Each tile is cropped from
+the PBM (memory-mapped, so this also works for tiled_io's huge inputs) together with
+OUTLINE_TILE_MARGIN (64) px of its neighbours, traced by its own potrace process (or the
+selected tracer backend, see tracers.py) on TRACE_EXECUTOR (OUTLINE_TRACE_WORKERS threads, shared
+by all conversions), and the tile SVGs are merged into one:
+
+- each tile's path group is moved to its offset and clipped to the tile's core rectangle. The
+  cores tile the image exactly, and the margins never show: that is where potrace closed the
+  contours the crop cut through
+- subpaths whose bounds miss the core entirely are dropped. They are duplicates of what the
+  neighbour owning them traced (and would be clipped away anyway)
+- a contour crossing a seam is kept on both sides and each side shows its half. Both tiles saw
+  the same pixels within the margin, so the halves meet; potrace's curve fitting can still
+  place them a fraction of a pixel apart
+
+See benchmarks/outline_scaling.py for the speed-up per worker count.
+"""
+import os
+import re
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from app.features.conversion import jobs, svg_optimize
+
+OUTLINE_TILED_MIN_MEGAPIXELS = float(os.getenv("OUTLINE_TILED_MIN_MEGAPIXELS", "4"))
+OUTLINE_TILE = int(os.getenv("OUTLINE_TILE", "2048"))
+OUTLINE_TILE_MARGIN = int(os.getenv("OUTLINE_TILE_MARGIN", "64"))
+OUTLINE_TRACE_WORKERS = int(os.getenv("OUTLINE_TRACE_WORKERS", str(os.cpu_count() or 1)))
+
+TRACE_EXECUTOR = ThreadPoolExecutor(max_workers=max(OUTLINE_TRACE_WORKERS, 1), thread_name_prefix="trace")
+
+Rect = Tuple[int, int, int, int]  # x0, y0, x1, y1 (pixels, exclusive end)
+# trace(pbm_path, svg_path, job): a bitmap tracer backend, see outline.process_image and tracers.py
+TraceFn = Callable[[str, str, Optional[jobs.Job]], None]
+
+_TRANSFORM = re.compile(
+    r"translate\(\s*([-+\d.eE]+)[\s,]+([-+\d.eE]+)\s*\)\s*scale\(\s*([-+\d.eE]+)(?:[\s,]+([-+\d.eE]+))?\s*\)"
+)
+_GROUP = f"{{{svg_optimize.SVG_NS}}}g"
+_PATH = f"{{{svg_optimize.SVG_NS}}}path"
+_PATH_PRECISION = 1  # potrace writes integer coordinates in 1/10 px
+
+
+def pbm_header(pbm_path) -> Tuple[int, int, int]:
+    """(width, height, offset of the bit data) of a binary PBM."""
+    with open(pbm_path, "rb") as f:
+        head = f.read(64)
+    fields = []
+    pos = 0
+    while len(fields) < 3:
+        while head[pos:pos + 1].isspace():
+            pos += 1
+        end = pos
+        while not head[end:end + 1].isspace():
+            end += 1
+        fields.append(head[pos:end])
+        pos = end
+    if fields[0] != b"P4":
+        raise ValueError(f"Not a binary PBM: {pbm_path}")
+    return int(fields[1]), int(fields[2]), pos + 1  # one whitespace byte ends the header
+
+
+def use_tiles(width: int, height: int) -> bool:
+    return OUTLINE_TRACE_WORKERS > 1 and width * height / 1e6 > OUTLINE_TILED_MIN_MEGAPIXELS
+
+
+def plan(width: int, height: int, tile: int = OUTLINE_TILE, margin: int = OUTLINE_TILE_MARGIN) -> List[Tuple[Rect, Rect]]:
+    """(core, crop) per tile, row by row; crops are the cores grown by `margin` within the image."""
+    tiles = []
+    for y0 in range(0, height, tile):
+        for x0 in range(0, width, tile):
+            core = (x0, y0, min(x0 + tile, width), min(y0 + tile, height))
+            crop = (max(x0 - margin, 0), max(y0 - margin, 0),
+                    min(core[2] + margin, width), min(core[3] + margin, height))
+            tiles.append((core, crop))
+    return tiles
+
+
+def _crop_pbm(bits: np.ndarray, crop: Rect, out_path: Path):
+    x0, y0, x1, y1 = crop
+    first = x0 // 8
+    rows = np.unpackbits(bits[y0:y1, first:(x1 + 7) // 8], axis=1)[:, x0 - first * 8:x1 - first * 8]
+    with open(out_path, "wb") as f:
+        f.write(f"P4\n{x1 - x0} {y1 - y0}\n".encode())
+        f.write(np.packbits(rows, axis=1).tobytes())
+
+
+def _subpaths(segments):
+    current = []
+    for segment in segments:
+        if segment[0] == "M" and current:
+            yield current
+            current = []
+        current.append(segment)
+    if current:
+        yield current
+
+
+def _tile_group(svg_path: Path, core: Rect, crop: Rect, index: int) -> Tuple[str, str, dict]:
+    """
+    (clipPath, clipped group, potrace's group attributes) for one traced tile, without the
+    subpaths that lie outside its core. Empty strings when nothing is left.
+    """
+    root = ET.parse(svg_path).getroot()
+    kept: List[str] = []
+    group_attrs: dict = {}
+    transform = (0.0, 0.0, 1.0, 1.0)
+    for group in root.iter(_GROUP):
+        m = _TRANSFORM.search(group.get("transform", ""))
+        if m:
+            transform = (float(m.group(1)), float(m.group(2)), float(m.group(3)), float(m.group(4) or m.group(3)))
+        group_attrs = {k: v for k, v in group.attrib.items() if k != "transform"}
+    tx, ty, sx, sy = transform
+    for path in root.iter(_PATH):
+        segments = svg_optimize.parse_path(path.get("d", ""))
+        if segments is None:
+            raise ValueError(f"Unsupported path data in {svg_path.name}")
+        for subpath in _subpaths(segments):
+            box = svg_optimize.bbox(subpath)
+            if box is None:
+                continue
+            # potrace units -> image pixels
+            xs = sorted((crop[0] + tx + sx * box[0], crop[0] + tx + sx * box[2]))
+            ys = sorted((crop[1] + ty + sy * box[1], crop[1] + ty + sy * box[3]))
+            if xs[1] < core[0] or xs[0] > core[2] or ys[1] < core[1] or ys[0] > core[3]:
+                continue  # a neighbour's contour, traced here only as context
+            kept.append(svg_optimize.serialize_path(subpath, _PATH_PRECISION))
+    if not kept:
+        return "", "", group_attrs
+    x0, y0, x1, y1 = core
+    clip = f'<clipPath id="tile{index}"><rect x="{x0}" y="{y0}" width="{x1 - x0}" height="{y1 - y0}"/></clipPath>'
+    body = (
+        f'<g clip-path="url(#tile{index})"><g transform="translate({crop[0] + tx:g},{crop[1] + ty:g}) '
+        f'scale({sx:g},{sy:g})"><path d="{"".join(kept)}"/></g></g>'
+    )
+    return clip, body, group_attrs
+
+
+def trace(pbm_path, svg_path, potrace: TraceFn, job: Optional[jobs.Job] = None, tile: int = OUTLINE_TILE,
+          margin: int = OUTLINE_TILE_MARGIN) -> int:
+    """Trace `pbm_path` into `svg_path` tile by tile in parallel; returns the number of tiles."""
+    width, height, offset = pbm_header(pbm_path)
+    bits = np.memmap(pbm_path, dtype=np.uint8, mode="r", offset=offset, shape=(height, (width + 7) // 8))
+    tiles = plan(width, height, tile, margin)
+    work_dir = Path(tempfile.mkdtemp(prefix="tiles-", dir=os.path.dirname(os.path.abspath(svg_path))))
+
+    def run(index: int, core: Rect, crop: Rect):
+        tile_pbm, tile_svg = work_dir / f"tile_{index}.pbm", work_dir / f"tile_{index}.svg"
+        _crop_pbm(bits, crop, tile_pbm)
+        potrace(str(tile_pbm), str(tile_svg), job)
+        return _tile_group(tile_svg, core, crop, index)
+
+    try:
+        futures = [TRACE_EXECUTOR.submit(run, i, core, crop) for i, (core, crop) in enumerate(tiles)]
+        try:
+            groups = [f.result() for f in futures]
+        finally:
+            for f in futures:
+                f.cancel()  # after a failure, do not start the tiles still queued
+            wait(futures)  # and let the running ones finish before their files are removed
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    attrs = next((a for _, _, a in groups if a), {"fill": "#000000", "stroke": "none"})
+    attr_text = "".join(f' {k}="{v}"' for k, v in attrs.items())
+    with open(svg_path, "w", encoding="utf-8") as f:
+        f.write(
+            f'<svg version="1.0" xmlns="{svg_optimize.SVG_NS}" width="{width}pt" height="{height}pt" '
+            f'viewBox="0 0 {width} {height}" preserveAspectRatio="xMidYMid meet">'
+        )
+        f.write("<defs>" + "".join(clip for clip, _, _ in groups) + "</defs>")
+        f.write(f"<g{attr_text}>" + "".join(body for _, body, _ in groups) + "</g></svg>\n")
+    return len(tiles)
@@ -0,0 +1,433 @@
+"""
+Tracer backends: a raster (vectorize) or a 1-bit PBM (outline) in, an SVG file out.
+
+vectorize, in order of preference:
+- vtracer-py:   the vtracer Python binding (`pip install vtracer`), in-process
+- vtracer-cli:  the `vtracer` binary on PATH, one child process per trace (the original backend)
+- contours:     the built-in OpenCV tracer below
+outline:
+- potrace-py:   the pypotrace binding (or potracer, which has the same API), in-process
+- potrace-cli:  the `potrace` binary on PATH (the original backend)
+- contours
+
+TRACER_VECTORIZE / TRACER_OUTLINE pick the default backend per mode; "auto" takes the first one
+available on this host, and contours (OpenCV only) always is. /convert and /sweep accept `tracer`
+to choose one per request. In-process backends cannot be killed mid-trace: a cancelled job stops
+at the next stage instead.
+
+The contours tracer quantizes colors to `color_precision` bits per channel, clusters them into
+at most TRACER_MAX_COLORS with k-means and merges clusters closer than `gradient_step` (vtracer's
+layer difference, as a BGR distance), then traces one layer per color, largest first, with
+cv2.findContours. Outlines are simplified with approxPolyDP
+(TRACER_CONTOUR_EPSILON px); in spline mode they are smoothed into cubic Beziers (Catmull-Rom)
+except at corners sharper than `corner_threshold` degrees, pixel mode keeps every step.
+`hierarchical=stacked` traces each layer together with the smaller layers painted over it, so
+only holes showing a larger layer are cut; `cutout` traces the exact pixels of each color.
+Regions smaller than `filter_speckle`² px are merged into the nearest larger region first.
+findContours follows pixel centres, so every path is also stroked 1 px wide in its own color to
+cover the outer half pixel; that also keeps 1 px edge lines visible in outline mode.
+`segment_length` and `splice_threshold` only apply to vtracer.
+"""
+import importlib.util
+import os
+from shutil import which
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from app import metrics
+from app.features.conversion import jobs, svg_optimize
+from app.features.conversion.tiled_outline import pbm_header
+
+TRACER_VECTORIZE = os.getenv("TRACER_VECTORIZE", "auto")
+TRACER_OUTLINE = os.getenv("TRACER_OUTLINE", "auto")
+TRACER_CONTOUR_EPSILON = float(os.getenv("TRACER_CONTOUR_EPSILON", "0.8"))
+TRACER_MAX_COLORS = int(os.getenv("TRACER_MAX_COLORS", "64"))
+
+PREFERENCE = {
+    "vectorize": ("vtracer-py", "vtracer-cli", "contours"),
+    "outline": ("potrace-py", "potrace-cli", "contours"),
+}
+DEFAULT_TRACER = {"vectorize": TRACER_VECTORIZE, "outline": TRACER_OUTLINE}
+
+# the /convert vectorize defaults, for callers that pass fewer parameters (e.g. outline)
+_VTRACER_DEFAULTS = {
+    "hierarchical": "stacked",
+    "filter_speckle": 8,
+    "color_precision": 6,
+    "gradient_step": 60,
+    "mode": "spline",
+    "corner_threshold": 40,
+    "segment_length": 10,
+    "splice_threshold": 80,
+    "path_precision": 1,
+}
+_PATH_PRECISION = 1
+_OUTLINE_CORNER_THRESHOLD = 60  # degrees; outline requests have no corner_threshold
+
+
+class TracerError(ValueError):
+    pass
+
+
+class Tracer:
+    """One backend. `trace` writes `svg_path` from `input_path` (a raster or a binary PBM)."""
+
+    name = ""
+    modes: Tuple[str, ...] = ()
+    tool: Optional[str] = None  # child process started per trace (SUBPROCESS_SPAWNS label)
+
+    def available(self) -> bool:
+        raise NotImplementedError
+
+    def trace(self, input_path: str, svg_path: str, params: dict, job: Optional[jobs.Job] = None):
+        raise NotImplementedError
+
+
+def _check(job: Optional[jobs.Job]):
+    job = job or jobs.current()
+    if job is not None:
+        job.check()
+
+
+def _vtracer_params(params: dict) -> dict:
+    return {**_VTRACER_DEFAULTS, **{k: v for k, v in params.items() if k in _VTRACER_DEFAULTS and v is not None}}
+
+
+# -----------------------
+# vtracer / potrace
+# -----------------------
+
+class VtracerCli(Tracer):
+    name = "vtracer-cli"
+    modes = ("vectorize",)
+    tool = "vtracer"
+
+    def available(self) -> bool:
+        return which("vtracer") is not None
+
+    @staticmethod
+    def command(raster_path: str, svg_path: str, params: dict) -> list:
+        p = _vtracer_params(params)
+        return [
+            "vtracer",
+            "--input", str(raster_path),
+            "--output", str(svg_path),
+            "--mode", p["mode"],
+            "--color_precision", str(p["color_precision"]),
+            "--filter_speckle", str(p["filter_speckle"]),
+            "--hierarchical", p["hierarchical"],
+            "--corner_threshold", str(p["corner_threshold"]),
+            "--gradient_step", str(p["gradient_step"]),
+            "--segment_length", str(p["segment_length"]),
+            "--splice_threshold", str(p["splice_threshold"]),
+            "--path_precision", str(p["path_precision"]),
+        ]
+
+    def trace(self, input_path, svg_path, params, job=None):
+        metrics.SUBPROCESS_SPAWNS.labels(tool=self.tool).inc()
+        jobs.run_process(self.command(input_path, svg_path, params), job)
+
+
+class VtracerBinding(Tracer):
+    name = "vtracer-py"
+    modes = ("vectorize",)
+
+    def available(self) -> bool:
+        return importlib.util.find_spec("vtracer") is not None
+
+    def trace(self, input_path, svg_path, params, job=None):
+        import vtracer
+
+        p = _vtracer_params(params)
+        vtracer.convert_image_to_svg_py(
+            str(input_path),
+            str(svg_path),
+            colormode="color",
+            hierarchical=p["hierarchical"],
+            mode=p["mode"],
+            filter_speckle=int(p["filter_speckle"]),
+            color_precision=int(p["color_precision"]),
+            layer_difference=int(p["gradient_step"]),
+            corner_threshold=int(p["corner_threshold"]),
+            length_threshold=float(p["segment_length"]),
+            splice_threshold=int(p["splice_threshold"]),
+            path_precision=int(p["path_precision"]),
+        )
+        _check(job)
+
+
+class PotraceCli(Tracer):
+    name = "potrace-cli"
+    modes = ("outline",)
+    tool = "potrace"
+
+    def available(self) -> bool:
+        return which("potrace") is not None
+
+    def trace(self, input_path, svg_path, params, job=None):
+        cmd = [
+            "potrace",
+            str(input_path),
+            "--svg",
+            "--flat",
+            "--longcoding",
+            "--opttolerance", "0.2",
+            "-o", str(svg_path),
+        ]
+        metrics.SUBPROCESS_SPAWNS.labels(tool=self.tool).inc()
+        jobs.run_process(cmd, job)
+
+
+def _xy(point) -> Tuple[float, float]:
+    # pypotrace returns tuples, potracer point objects
+    return (point.x, point.y) if hasattr(point, "x") else (point[0], point[1])
+
+
+class PotraceBinding(Tracer):
+    name = "potrace-py"
+    modes = ("outline",)
+
+    def available(self) -> bool:
+        return importlib.util.find_spec("potrace") is not None
+
+    def trace(self, input_path, svg_path, params, job=None):
+        import potrace
+
+        bits = read_pbm(input_path)
+        # the CLI's settings (turdsize 2, alphamax 1, opttolerance 0.2)
+        traced = potrace.Bitmap(bits).trace(turdsize=2, alphamax=1.0, opticurve=True, opttolerance=0.2)
+        segments = []
+        for curve in traced.curves:
+            segments.append(("M", list(_xy(curve.start_point))))
+            for segment in curve.segments:
+                if segment.is_corner:
+                    segments.append(("L", list(_xy(segment.c))))
+                    segments.append(("L", list(_xy(segment.end_point))))
+                else:
+                    segments.append(("C", [*_xy(segment.c1), *_xy(segment.c2), *_xy(segment.end_point)]))
+            segments.append(("Z", []))
+        height, width = bits.shape
+        _write_svg(svg_path, width, height, [({"fill": "#000000", "stroke": "none"}, segments)], unit="pt")
+        _check(job)
+
+
+# -----------------------
+# Built-in contour tracer
+# -----------------------
+
+def read_pbm(pbm_path) -> np.ndarray:
+    """A binary PBM as a bool array, True = black."""
+    width, height, offset = pbm_header(pbm_path)
+    packed = np.fromfile(pbm_path, dtype=np.uint8, offset=offset, count=height * ((width + 7) // 8))
+    return np.unpackbits(packed.reshape(height, -1), axis=1)[:, :width].astype(bool)
+
+
+def _read_raster(path: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """8-bit BGR pixels and the opaque mask (None without alpha)."""
+    img = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError(f"Failed to read image: {path}")
+    if img.dtype != np.uint8:
+        img = (img / 257).astype(np.uint8)
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR), None
+    if img.shape[2] == 4:
+        return img[..., :3], img[..., 3] >= 128
+    return img, None
+
+
+def _nearest(colors: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    """Index of the nearest palette entry per color (in chunks; photos have 100k+ distinct colors)."""
+    return np.concatenate([
+        np.argmin(((colors[i:i + 8192, None, :] - palette[None, :, :]) ** 2).sum(axis=2), axis=1)
+        for i in range(0, len(colors), 8192)
+    ])
+
+
+def _quantize(img: np.ndarray, precision: int, merge_distance: float,
+              opaque: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (label per pixel, -1 where transparent; BGR color per label), labels sorted by area, largest
+    first. Colors are reduced to `precision` bits per channel, clustered into at most
+    TRACER_MAX_COLORS (k-means) and clusters closer than `merge_distance` are merged.
+    """
+    shift = 8 - min(max(precision, 1), 8)
+    binned = (cv2.medianBlur(img, 3) >> shift).astype(np.int32)
+    codes = (binned[..., 0] << 16) | (binned[..., 1] << 8) | binned[..., 2]
+    if opaque is not None:
+        codes = np.where(opaque, codes, -1)
+    values, inverse = np.unique(codes.ravel(), return_inverse=True)
+    transparent = values < 0
+    # bin centres as colors
+    colors = (np.stack([(values >> 16) & 255, (values >> 8) & 255, values & 255], axis=1) << shift)
+    colors = (colors + ((1 << shift) >> 1)).astype(np.float32)
+    visible = inverse[~transparent[inverse]]
+    if visible.size == 0:
+        return np.full(codes.shape, -1, dtype=np.int64), np.zeros((0, 3), dtype=np.uint8)
+
+    # palette: k-means on a fixed sample of the visible pixels
+    sample = colors[visible[np.random.default_rng(0).integers(0, visible.size, min(visible.size, 20000))]]
+    k = min(TRACER_MAX_COLORS, int((~transparent).sum()))
+    cv2.setRNGSeed(0)
+    _, assigned, centers = cv2.kmeans(sample, k, None, (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0),
+                                      1, cv2.KMEANS_PP_CENTERS)
+    order = np.argsort(-np.bincount(assigned.ravel(), minlength=k), kind="stable")
+    palette: List[np.ndarray] = []
+    for center in centers[order]:
+        if all(np.linalg.norm(center - kept) >= merge_distance for kept in palette):
+            palette.append(center)
+
+    nearest = _nearest(colors, np.array(palette))
+    nearest[transparent] = -1
+    labels = nearest[inverse].reshape(codes.shape)
+    # largest first, colored with the mean of their original pixels
+    flat = labels.ravel()
+    mask = flat >= 0
+    area = np.bincount(flat[mask], minlength=len(palette))
+    mean = np.stack(
+        [np.bincount(flat[mask], weights=img[..., c].ravel()[mask], minlength=len(palette)) for c in range(3)], axis=1
+    ) / np.maximum(area, 1)[:, None]
+    by_area = np.argsort(-area, kind="stable")
+    rank = np.empty_like(by_area)
+    rank[by_area] = np.arange(len(by_area))
+    labels = np.where(labels >= 0, rank[np.maximum(labels, 0)], -1)
+    return labels, np.round(mean[by_area]).astype(np.uint8)
+
+
+def _despeckle(labels: np.ndarray, n_labels: int, min_area: float) -> np.ndarray:
+    """Relabel connected regions smaller than `min_area` px with the nearest remaining label."""
+    small = np.zeros(labels.shape, dtype=np.uint8)
+    for label in range(n_labels):
+        count, components, stats, _ = cv2.connectedComponentsWithStats((labels == label).astype(np.uint8), connectivity=4)
+        tiny = np.flatnonzero(stats[1:count, cv2.CC_STAT_AREA] < min_area) + 1
+        if tiny.size:
+            small[np.isin(components, tiny)] = 1
+    if not small.any() or small.all():
+        return labels
+    # DIST_LABEL_PIXEL numbers the kept pixels 1..n in raster order
+    _, nearest = cv2.distanceTransformWithLabels(small, cv2.DIST_L2, 3, labelType=cv2.DIST_LABEL_PIXEL)
+    filled = labels.copy()
+    filled[small == 1] = labels[small == 0][nearest[small == 1] - 1]
+    return filled
+
+
+def _corners(points: np.ndarray, threshold: float) -> np.ndarray:
+    incoming = points - np.roll(points, 1, axis=0)
+    outgoing = np.roll(points, -1, axis=0) - points
+    turn = np.degrees(np.abs(np.arctan2(
+        incoming[:, 0] * outgoing[:, 1] - incoming[:, 1] * outgoing[:, 0], (incoming * outgoing).sum(axis=1)
+    )))
+    return turn > threshold
+
+
+def _contour_segments(points: np.ndarray, mode: str, corner_threshold: float) -> list:
+    """One closed contour ((n, 2) float points) as absolute path segments."""
+    segments = [("M", [float(points[0, 0]), float(points[0, 1])])]
+    if mode != "spline" or len(points) < 3:
+        segments.extend(("L", [float(x), float(y)]) for x, y in points[1:])
+        segments.append(("Z", []))
+        return segments
+    corner = _corners(points, corner_threshold)
+    prev, nxt, nxt2 = np.roll(points, 1, axis=0), np.roll(points, -1, axis=0), np.roll(points, -2, axis=0)
+    # Catmull-Rom tangents, zero at corners
+    c1 = np.where(corner[:, None], points, points + (nxt - prev) / 6)
+    c2 = np.where(np.roll(corner, -1)[:, None], nxt, nxt - (nxt2 - points) / 6)
+    end_corner = np.roll(corner, -1)
+    for i in range(len(points)):
+        if corner[i] and end_corner[i]:
+            segments.append(("L", [float(nxt[i, 0]), float(nxt[i, 1])]))
+        else:
+            segments.append(("C", [*map(float, c1[i]), *map(float, c2[i]), *map(float, nxt[i])]))
+    segments.append(("Z", []))
+    return segments
+
+
+def _mask_segments(mask: np.ndarray, mode: str, corner_threshold: float) -> list:
+    """Outer contours and holes of a boolean mask (even-odd) as path segments."""
+    approx = cv2.CHAIN_APPROX_NONE if mode == "pixel" else cv2.CHAIN_APPROX_SIMPLE
+    contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_CCOMP, approx)
+    segments = []
+    for contour in contours:
+        if mode != "pixel":
+            contour = cv2.approxPolyDP(contour, TRACER_CONTOUR_EPSILON, True)
+        segments.extend(_contour_segments(contour[:, 0, :].astype(np.float64), mode, corner_threshold))
+    return segments
+
+
+def _write_svg(svg_path: str, width: int, height: int, layers: List[Tuple[dict, list]], unit: str = ""):
+    """One group per layer (attributes, segments); `unit` and a viewBox as potrace writes them, or vtracer's plain size."""
+    size = f'width="{width}{unit}" height="{height}{unit}"' + (f' viewBox="0 0 {width} {height}"' if unit else "")
+    with open(svg_path, "w", encoding="utf-8") as f:
+        f.write(f'<svg version="1.1" xmlns="{svg_optimize.SVG_NS}" {size}>')
+        for attrs, segments in layers:
+            if not segments:
+                continue
+            attr_text = "".join(f' {k}="{v}"' for k, v in attrs.items())
+            f.write(f'<g{attr_text}><path d="{svg_optimize.serialize_path(segments, _PATH_PRECISION)}"/></g>')
+        f.write("</svg>\n")
+
+
+def _layer_attrs(color: str) -> dict:
+    return {"fill": color, "fill-rule": "evenodd", "stroke": color, "stroke-width": "1", "stroke-linejoin": "round"}
+
+
+class ContourTracer(Tracer):
+    name = "contours"
+    modes = ("vectorize", "outline")
+
+    def available(self) -> bool:
+        return True
+
+    def trace(self, input_path, svg_path, params, job=None):
+        if str(input_path).lower().endswith(".pbm"):
+            bits = read_pbm(input_path)
+            segments = _mask_segments(bits, "spline", params.get("corner_threshold", _OUTLINE_CORNER_THRESHOLD))
+            height, width = bits.shape
+            _write_svg(svg_path, width, height, [(_layer_attrs("#000000"), segments)], unit="pt")
+            return
+
+        p = _vtracer_params(params)
+        img, opaque = _read_raster(input_path)
+        labels, colors = _quantize(img, int(p["color_precision"]), float(p["gradient_step"]), opaque)
+        if p["filter_speckle"]:
+            labels = _despeckle(labels, len(colors), float(p["filter_speckle"]) ** 2)
+        stacked = p["hierarchical"] == "stacked"
+        layers = []
+        covered = np.zeros(labels.shape, dtype=bool)  # stacked: this layer plus the smaller ones on top
+        for label in range(len(colors) - 1, -1, -1):
+            _check(job)
+            mask = labels == label
+            if not mask.any():
+                continue  # every region of this color was merged into its neighbours
+            if stacked:
+                covered |= mask
+                mask = covered
+            b, g, r = colors[label]
+            segments = _mask_segments(mask, p["mode"], float(p["corner_threshold"]))
+            layers.append((_layer_attrs(f"#{r:02x}{g:02x}{b:02x}"), segments))
+        height, width = labels.shape
+        _write_svg(svg_path, width, height, layers[::-1])
+
+
+TRACERS: Dict[str, Tracer] = {
+    t.name: t for t in (VtracerBinding(), VtracerCli(), PotraceBinding(), PotraceCli(), ContourTracer())
+}
+
+
+def resolve(mode: str, name: Optional[str] = None) -> str:
+    """The backend name to use for `mode`: `name`, or the mode's default, with "auto" resolved."""
+    name = (name or DEFAULT_TRACER[mode]).lower()
+    if name == "auto":
+        return next(n for n in PREFERENCE[mode] if TRACERS[n].available())
+    tracer = TRACERS.get(name)
+    if tracer is None or mode not in tracer.modes:
+        raise TracerError(f"Unknown {mode} tracer {name!r} (choose from auto, {', '.join(PREFERENCE[mode])})")
+    if not tracer.available():
+        raise TracerError(f"Tracer {name} is not available on this host")
+    return name
+
+
+def get(name: str) -> Tracer:
+    return TRACERS[name]
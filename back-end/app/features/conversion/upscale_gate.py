@@ -0,0 +1,238 @@
+"""
+Upscale gating for the vectorize pipeline: whether (and how) to run ESRGAN before vtracer.
+
+The original rule upscaled x4 whenever the global Laplacian variance was below
+`--quality_threshold` (5500), which sends many images vtracer traces fine through minutes of
+CPU ESRGAN. The gated policy looks at cheap features instead (all from one decode):
+
+- resolution:     a short side >= GATE_MIN_SIDE already gives vtracer enough pixels, one below
+                  GATE_SMALL_SIDE is always upscaled (too few pixels to trace smooth curves)
+- color count:    <= GATE_FLAT_COLORS distinct (quantized) colors means crisp flat artwork;
+                  blur would have created intermediate colors along every edge
+- edge density:   share of Canny edge pixels, logged for tuning
+- sharpness map:  Laplacian variance per GATE_TILE px tile; a tile with content (intensity std
+                  > GATE_FLAT_STD) but variance < GATE_TILE_SHARPNESS is blurry
+
+and decides between
+- skip:     trace the original
+- upscale:  ESRGAN on the whole image
+- regions:  ESRGAN only on the blurry tiles (merged into boxes), bicubic elsewhere, when at most
+            GATE_REGION_FRACTION of the tiles are blurry
+
+with the smallest output scale (2 or 4) that brings the short side to GATE_TARGET_SIDE. The
+x4 network runs either way; a smaller outscale saves tracing time and memory.
+
+Every decision is logged. With UPSCALE_DECISION_LOG=<path> it is also appended to that file
+(JSON lines, not rotated) with the policy that made it, its features, the decision the legacy
+rule would have made and the estimated seconds saved against it (ESRGAN and vtracer cost per
+megapixel, see ESRGAN_SECONDS_PER_MP / TRACE_SECONDS_PER_MP), for tuning the policy.
+UPSCALE_POLICY=legacy restores the old rule; never/always force the branch.
+"""
+import datetime as dt
+import json
+import os
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+from loguru import logger
+
+UPSCALE_POLICY = os.getenv("UPSCALE_POLICY", "gated")  # gated | legacy | never | always
+GATE_TILE = int(os.getenv("GATE_TILE", "64"))
+GATE_TILE_SHARPNESS = float(os.getenv("GATE_TILE_SHARPNESS", "150"))
+GATE_FLAT_STD = float(os.getenv("GATE_FLAT_STD", "6"))
+GATE_MIN_SIDE = int(os.getenv("GATE_MIN_SIDE", "1600"))
+GATE_SMALL_SIDE = int(os.getenv("GATE_SMALL_SIDE", "256"))
+GATE_FLAT_COLORS = int(os.getenv("GATE_FLAT_COLORS", "32"))
+GATE_BLURRY_MIN = float(os.getenv("GATE_BLURRY_MIN", "0.05"))
+GATE_REGION_FRACTION = float(os.getenv("GATE_REGION_FRACTION", "0.4"))
+GATE_TARGET_SIDE = int(os.getenv("GATE_TARGET_SIDE", "1024"))
+
+# rough CPU costs; the GPU factor divides the ESRGAN part only
+ESRGAN_SECONDS_PER_MP = float(os.getenv("ESRGAN_SECONDS_PER_MP", "45"))
+ESRGAN_GPU_SPEEDUP = float(os.getenv("ESRGAN_GPU_SPEEDUP", "30"))
+TRACE_SECONDS_PER_MP = float(os.getenv("TRACE_SECONDS_PER_MP", "2"))
+
+# opt-in; resolved here so the API and its child processes append to the same file
+UPSCALE_DECISION_LOG = os.path.abspath(os.getenv("UPSCALE_DECISION_LOG")) if os.getenv("UPSCALE_DECISION_LOG") else None
+
+Box = Tuple[int, int, int, int]  # x0, y0, x1, y1 (pixels, exclusive end)
+
+
+class Decision:
+    """What to do with one image, and why."""
+
+    def __init__(self, action: str, scale: int, reason: str, regions: Optional[List[Box]] = None):
+        self.action = action  # skip | upscale | regions
+        self.scale = scale if action != "skip" else 1
+        self.reason = reason
+        self.regions = regions or []
+        self.features: dict = {}
+        self.est_seconds = 0.0
+        self.legacy: Optional["Decision"] = None
+
+    @property
+    def upscales(self) -> bool:
+        return self.action != "skip"
+
+    def as_dict(self) -> dict:
+        return {
+            "action": self.action,
+            "scale": self.scale,
+            "reason": self.reason,
+            "regions": len(self.regions),
+            "est_seconds": round(self.est_seconds, 2),
+        }
+
+
+# -----------------------
+# Features
+# -----------------------
+
+def _tile_stats(gray: np.ndarray, tile: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Per-tile Laplacian variance and intensity std (edge tiles that do not fill a whole tile are dropped)."""
+    rows, cols = gray.shape[0] // tile, gray.shape[1] // tile
+    if not rows or not cols:
+        lap = cv2.Laplacian(gray, cv2.CV_32F)
+        return np.array([[lap.var()]]), np.array([[gray.std()]])
+    crop = gray[:rows * tile, :cols * tile]
+    lap = cv2.Laplacian(crop, cv2.CV_32F)
+    as_tiles = lambda a: a.reshape(rows, tile, cols, tile).astype(np.float32)  # noqa: E731
+    return as_tiles(lap).var(axis=(1, 3)), as_tiles(crop).std(axis=(1, 3))
+
+
+def _color_count(img: np.ndarray) -> int:
+    """Distinct colors at 5 bits per channel on a <= 256 px thumbnail."""
+    scale = 256 / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+    if img.ndim == 2:
+        return int(np.unique(img >> 3).size)
+    q = (img[..., :3] >> 3).astype(np.uint32)
+    return int(np.unique((q[..., 0] << 10) | (q[..., 1] << 5) | q[..., 2]).size)
+
+
+def measure(image_path: str) -> Tuple[dict, np.ndarray]:
+    """Gating features plus the boolean blurry-tile map."""
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise FileNotFoundError(f"Image not found: {image_path}")
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    sharpness, std = _tile_stats(gray, GATE_TILE)
+    content = std > GATE_FLAT_STD
+    blurry = content & (sharpness < GATE_TILE_SHARPNESS)
+    features = {
+        "width": w,
+        "height": h,
+        "megapixels": round(w * h / 1e6, 3),
+        "laplacian_var": round(float(cv2.Laplacian(gray, cv2.CV_64F).var()), 1),
+        "edge_density": round(float(np.count_nonzero(cv2.Canny(gray, 100, 200))) / (w * h), 4),
+        "colors": _color_count(img),
+        "tiles": int(sharpness.size),
+        "content_tiles": int(content.sum()),
+        "blurry_tiles": int(blurry.sum()),
+        "tile_sharpness_p10": round(float(np.percentile(sharpness[content], 10)), 1) if content.any() else None,
+    }
+    features["blurry_fraction"] = round(features["blurry_tiles"] / max(features["content_tiles"], 1), 4)
+    return features, blurry
+
+
+def _regions(blurry: np.ndarray, tile: int, width: int, height: int) -> List[Box]:
+    """Bounding boxes (pixels) of connected groups of blurry tiles."""
+    count, _, stats, _ = cv2.connectedComponentsWithStats(blurry.astype(np.uint8), connectivity=8)
+    rows, cols = blurry.shape
+    boxes = []
+    for x, y, w, h, _ in stats[1:count]:
+        # tiles in the last row/column also cover the remainder that did not fill a whole tile
+        x1 = width if x + w == cols else int((x + w) * tile)
+        y1 = height if y + h == rows else int((y + h) * tile)
+        boxes.append((int(x * tile), int(y * tile), x1, y1))
+    return boxes
+
+
+# -----------------------
+# Policy
+# -----------------------
+
+def estimate_seconds(decision: Decision, features: dict, device: str = "cpu") -> float:
+    """ESRGAN time for the upscaled area plus vtracer time for the traced raster."""
+    mp = features["megapixels"]
+    esrgan_per_mp = ESRGAN_SECONDS_PER_MP / (ESRGAN_GPU_SPEEDUP if device == "cuda" else 1)
+    if decision.action == "regions":
+        area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in decision.regions) / 1e6
+    else:
+        area = mp if decision.upscales else 0.0
+    return area * esrgan_per_mp + mp * decision.scale ** 2 * TRACE_SECONDS_PER_MP
+
+
+def legacy_decision(features: dict, quality_threshold: float, scale: int = 4) -> Decision:
+    if features["laplacian_var"] < quality_threshold:
+        return Decision("upscale", scale, f"laplacian_var < {quality_threshold:g}")
+    return Decision("skip", 1, f"laplacian_var >= {quality_threshold:g}")
+
+
+def _output_scale(features: dict, max_scale: int) -> int:
+    short_side = min(features["width"], features["height"])
+    return next((s for s in (2, 4) if s <= max_scale and short_side * s >= GATE_TARGET_SIDE), max_scale)
+
+
+def decide(features: dict, blurry: np.ndarray, quality_threshold: float, max_scale: int = 4,
+           policy: str = UPSCALE_POLICY) -> Decision:
+    if policy == "legacy":
+        return legacy_decision(features, quality_threshold, max_scale)
+    if policy == "never":
+        return Decision("skip", 1, "policy=never")
+    if policy == "always":
+        return Decision("upscale", max_scale, "policy=always")
+
+    if min(features["width"], features["height"]) >= GATE_MIN_SIDE:
+        return Decision("skip", 1, f"short side >= {GATE_MIN_SIDE}px")
+    if min(features["width"], features["height"]) < GATE_SMALL_SIDE:
+        return Decision("upscale", _output_scale(features, max_scale), f"short side < {GATE_SMALL_SIDE}px")
+    if features["colors"] <= GATE_FLAT_COLORS:
+        return Decision("skip", 1, f"flat artwork ({features['colors']} colors)")
+    if features["blurry_fraction"] < GATE_BLURRY_MIN:
+        return Decision("skip", 1, f"{features['blurry_fraction']:.0%} blurry tiles")
+
+    scale = _output_scale(features, max_scale)
+    if features["blurry_fraction"] <= GATE_REGION_FRACTION:
+        regions = _regions(blurry, GATE_TILE, features["width"], features["height"])
+        return Decision("regions", scale, f"{features['blurry_fraction']:.0%} blurry tiles", regions)
+    return Decision("upscale", scale, f"{features['blurry_fraction']:.0%} blurry tiles")
+
+
+def log_decision(image_path: str, decision: Decision, policy: str = UPSCALE_POLICY):
+    legacy = decision.legacy
+    record = {
+        "ts": dt.datetime.utcnow().isoformat(timespec="seconds"),
+        "image": os.path.basename(image_path),
+        "policy": policy,
+        "features": decision.features,
+        "decision": decision.as_dict(),
+        "legacy": legacy.as_dict() if legacy else None,
+        "est_saved_seconds": round(legacy.est_seconds - decision.est_seconds, 2) if legacy else None,
+    }
+    logger.info(f"Upscale gate: {record['decision']} (saves ~{record['est_saved_seconds']}s vs legacy)")
+    if not UPSCALE_DECISION_LOG:
+        return
+    try:
+        os.makedirs(os.path.dirname(UPSCALE_DECISION_LOG) or ".", exist_ok=True)
+        with open(UPSCALE_DECISION_LOG, "a") as f:
+            f.write(json.dumps(record) + "\n")  # one write per line; safe for concurrent appenders
+    except OSError as e:
+        logger.warning(f"Could not write upscale decision log: {e}")
+
+
+def evaluate(image_path: str, quality_threshold: float, max_scale: int = 4, device: str = "cpu",
+             policy: Optional[str] = None) -> Decision:
+    """Measure, decide (UPSCALE_POLICY unless `policy`), estimate costs (also of the legacy rule) and log."""
+    features, blurry = measure(image_path)
+    policy = policy or UPSCALE_POLICY
+    decision = decide(features, blurry, quality_threshold, max_scale, policy)
+    decision.features = features
+    decision.est_seconds = estimate_seconds(decision, features, device)
+    decision.legacy = legacy_decision(features, quality_threshold, max_scale)
+    decision.legacy.est_seconds = estimate_seconds(decision.legacy, features, device)
+    log_decision(image_path, decision, policy)
+    return decision
@@ -0,0 +1,156 @@
+"""
+Upscaling tiers shared by enhance and the vectorize pre-pass, fastest first:
+
+- fast:     classic interpolation. OpenCV dnn_superres (FSRCNN/ESPCN/EDSR/LapSRN, picked from the
+            SUPERRES_MODEL_PATH file name) when opencv-contrib and the model file are present,
+            Lanczos otherwise. No torch; enhance runs it in the API process.
+- anime6b:  Real-ESRGAN RRDBNet with 6 blocks (RealESRGAN_x4plus_anime_6B), ~4x cheaper
+- x4plus:   Real-ESRGAN RRDBNet with 23 blocks (RealESRGAN_x4plus), best quality
+
+`choose_tier` picks the best tier whose estimated time fits a latency budget for the image's
+size, starting from the mode's default tier; without a budget the default runs as before. With a
+budget, a tier whose weights are missing is skipped in favour of a cheaper one; without one the
+default is kept (and a warning logged), so a missing model fails the conversion instead of
+silently lowering its quality.
+Costs (seconds per input megapixel, plus child-process start-up for the ESRGAN tiers) are
+rough figures meant to be tuned with UPSCALE_COST_<TIER>_<DEVICE> from measured stage times.
+"""
+import io
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+import cv2
+from loguru import logger
+
+from app.features.conversion import tiled_io
+
+TIERS = ("fast", "anime6b", "x4plus")  # increasing quality and cost
+
+WEIGHTS: Dict[str, str] = {
+    "anime6b": "app/weights/RealESRGAN_x4plus_anime_6B.pth",
+    "x4plus": "app/weights/RealESRGAN_x4plus.pth",
+}
+BLOCKS = {"anime6b": 6, "x4plus": 23}
+MODEL_NAMES = {"fast": "interpolation", "anime6b": "RealESRGAN_x4plus_anime_6B", "x4plus": "RealESRGAN_x4plus"}
+DEFAULT_TIER = {"enhance": "x4plus", "vectorize": "anime6b"}
+
+SUPERRES_MODEL_PATH = os.getenv("SUPERRES_MODEL_PATH", "app/weights/FSRCNN_x4.pb")
+_SUPERRES_ALGOS = ("fsrcnn", "espcn", "edsr", "lapsrn")
+
+_DEFAULT_COSTS = {
+    ("fast", "cpu"): 0.1,
+    ("anime6b", "cpu"): 15.0,
+    ("x4plus", "cpu"): 60.0,
+    ("fast", "cuda"): 0.1,
+    ("anime6b", "cuda"): 0.5,
+    ("x4plus", "cuda"): 2.0,
+}
+STARTUP_SECONDS = float(os.getenv("UPSCALE_STARTUP_SECONDS", "4"))  # interpreter + torch import + weights
+
+
+def cost_per_mp(tier: str, device: str) -> float:
+    device = "cuda" if device in ("cuda", "gpu") else "cpu"
+    return float(os.getenv(f"UPSCALE_COST_{tier.upper()}_{device.upper()}", _DEFAULT_COSTS[(tier, device)]))
+
+
+def estimate_seconds(tier: str, megapixels: float, device: str, in_process: bool = False) -> float:
+    startup = 0.0 if tier == "fast" and in_process else STARTUP_SECONDS
+    return startup + megapixels * cost_per_mp(tier, device)
+
+
+def image_megapixels(data: bytes) -> float:
+    """Input size from the image header; 0 when PIL cannot read it (the pipeline reports that)."""
+    try:
+        width, height = tiled_io.image_size(io.BytesIO(data))  # large scans count at their full size
+    except Exception:
+        return 0.0
+    return width * height / 1e6
+
+
+def available(tier: str) -> bool:
+    return tier == "fast" or Path(WEIGHTS[tier]).is_file()
+
+
+def choose_tier(mode: str, megapixels: float, budget_seconds: Optional[float], device: str) -> str:
+    """
+    The best available tier up to the mode's default whose estimate fits the budget, or "fast"
+    when none does. Without a budget, the mode's default even if its weights are missing.
+    """
+    default = DEFAULT_TIER[mode]
+    if budget_seconds is None:
+        if not available(default):
+            logger.warning(f"Weights for the {default} upscaler are missing ({WEIGHTS[default]}); "
+                           f"pass latency_budget to allow a cheaper tier")
+        return default
+    for tier in reversed(TIERS[:TIERS.index(default) + 1]):
+        if not available(tier):
+            continue
+        if estimate_seconds(tier, megapixels, device, in_process=mode == "enhance") <= budget_seconds:
+            return tier
+    return "fast"
+
+
+# -----------------------
+# Upsamplers
+# -----------------------
+
+def fast_method() -> str:
+    """dnn_superres algorithm the fast tier will use, or "lanczos"."""
+    name = Path(SUPERRES_MODEL_PATH).name.lower()
+    algo = next((a for a in _SUPERRES_ALGOS if name.startswith(a)), None)
+    if algo and hasattr(cv2, "dnn_superres") and Path(SUPERRES_MODEL_PATH).is_file():
+        return algo
+    return "lanczos"
+
+
+class InterpolationUpsampler:
+    """RealESRGANer-compatible `enhance` for the fast tier."""
+
+    def __init__(self, scale: int = 4):
+        self.scale = scale
+        self.method = fast_method()
+        self._sr = None
+        if self.method != "lanczos":
+            self._sr = cv2.dnn_superres.DnnSuperResImpl_create()
+            self._sr.readModel(SUPERRES_MODEL_PATH)
+            self._sr.setModel(self.method, scale)
+
+    def enhance(self, img, outscale: Optional[float] = None):
+        outscale = outscale or self.scale
+        h, w = img.shape[:2]
+        size = (int(round(w * outscale)), int(round(h * outscale)))
+        if self._sr is not None and img.ndim == 3 and img.shape[2] == 3 and img.dtype == "uint8":
+            out = self._sr.upsample(img)
+            if out.shape[1::-1] != size:
+                out = cv2.resize(out, size, interpolation=cv2.INTER_AREA)
+            return out, "RGB"
+        # Lanczos keeps alpha, grayscale and 16-bit images as they are
+        return cv2.resize(img, size, interpolation=cv2.INTER_LANCZOS4), None
+
+
+def load_upsampler(tier: str, device: str, tile: int, tile_pad: int, scale: int = 4,
+                   model_path: Optional[str] = None):
+    """Upsampler with RealESRGANer's `enhance(img, outscale) -> (img, mode)` for `tier`."""
+    if tier == "fast":
+        return InterpolationUpsampler(scale)
+    # torch and the Real-ESRGAN packages are only needed (and only imported) for the ESRGAN tiers
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+    from realesrgan import RealESRGANer
+
+    model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=BLOCKS[tier], num_grow_ch=32, scale=scale)
+    return RealESRGANer(
+        scale=scale,
+        model_path=model_path or WEIGHTS[tier],
+        model=model,
+        tile=tile,
+        tile_pad=tile_pad,
+        pre_pad=0,
+        half=device == "cuda",
+        gpu_id=None if device == "cpu" else 0,
+    )
+
+
+def stage_name(tier: str) -> str:
+    """Timing stage of the upscale itself; ESRGAN tiers keep the historical "esrgan" stage."""
+    return "interpolate" if tier == "fast" else "esrgan"
@@ -1,25 +1,16 @@
 import argparse
 import os
 import cv2
-import subprocess
+import shutil
 import tempfile
 import torch
 from datetime import datetime
-from shutil import which
-from basicsr.archs.rrdbnet_arch import RRDBNet
-from realesrgan import RealESRGANer
 
-# ---------- helpers ----------
-def ensure_vtracer():
-    if which("vtracer") is None:
-        raise RuntimeError("vtracer not found in PATH. Install it (e.g., `cargo install vtracer`).")
-
-def measure_image_quality(image_path: str) -> float:
-    img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise FileNotFoundError(f"Image not found: {image_path}")
-    return cv2.Laplacian(img, cv2.CV_64F).var()
+from app.features.conversion import tracers, upscale_gate, upscalers
+from app.features.helpers.profiling import cpu_profile, torch_profile
+from app.features.helpers.timing import StageTimer
 
+# ---------- helpers ----------
 def safe_svg_path(output_dir: str, base_name: str) -> str:
     """Return a unique SVG path with timestamp to avoid collisions."""
     os.makedirs(output_dir, exist_ok=True)
@@ -32,87 +23,129 @@ def safe_svg_path(output_dir: str, base_name: str) -> str:
     return candidate
 
 # ---------- ESRGAN upscaling ----------
-def upscale_image(input_path: str, model_path: str, scale: int, device: str, args):
-    model = RRDBNet(
-        num_in_ch=3, num_out_ch=3, num_feat=64,
-        num_block=6, num_grow_ch=32, scale=scale
-    )
-
-    upsampler = RealESRGANer(
-        scale=scale,
-        model_path=model_path,
-        model=model,
-        tile=args.tile,         # <<< tiling enabled
-        tile_pad=args.tile_pad, # <<< padding
-        pre_pad=0,
-        half=(device == "cuda"),
-        gpu_id=None if device == "cpu" else 0
-    )
-
-    img = cv2.imread(input_path, cv2.IMREAD_UNCHANGED)
+def load_upsampler(model_path: str, scale: int, device: str, args, timer):
+    with timer.stage("load_model"):
+        # tiled RealESRGANer for the ESRGAN tiers, interpolation for --upscale_tier fast
+        upsampler = upscalers.load_upsampler(args.upscale_tier, device, args.tile, args.tile_pad, scale,
+                                             model_path)
+    return upsampler
+
+
+def _read_image(input_path: str, timer):
+    with timer.stage("decode"):
+        img = cv2.imread(input_path, cv2.IMREAD_UNCHANGED)
     if img is None:
         raise ValueError(f"Failed to read image: {input_path}")
+    return img
+
 
-    out, _ = upsampler.enhance(img, outscale=scale)
+def upscale_image(input_path: str, model_path: str, scale: int, device: str, args, timer=None, outscale=None):
+    timer = timer or StageTimer()
+    upsampler = load_upsampler(model_path, scale, device, args, timer)
+    img = _read_image(input_path, timer)
+
+    with timer.stage(upscalers.stage_name(args.upscale_tier)), torch_profile(getattr(args, "profile_dir", None), "esrgan"):
+        out, _ = upsampler.enhance(img, outscale=outscale or scale)
     return out
 
-# ---------- VTracer wrapper ----------
+
+def upscale_regions(input_path: str, regions, model_path: str, scale: int, device: str, args, timer=None,
+                    outscale=None):
+    """ESRGAN on the given (x0, y0, x1, y1) boxes only; the rest of the image is resized bicubically."""
+    timer = timer or StageTimer()
+    outscale = outscale or scale
+    upsampler = load_upsampler(model_path, scale, device, args, timer)
+    img = _read_image(input_path, timer)
+    h, w = img.shape[:2]
+
+    with timer.stage("resize"):
+        out = cv2.resize(img, (w * outscale, h * outscale), interpolation=cv2.INTER_CUBIC)
+    pad = args.tile_pad
+    with timer.stage(upscalers.stage_name(args.upscale_tier)), torch_profile(getattr(args, "profile_dir", None), "esrgan"):
+        for x0, y0, x1, y1 in regions:
+            # upscale with some context around the box so its border matches the neighbours
+            px0, py0, px1, py1 = max(x0 - pad, 0), max(y0 - pad, 0), min(x1 + pad, w), min(y1 + pad, h)
+            up, _ = upsampler.enhance(img[py0:py1, px0:px1], outscale=outscale)
+            ox, oy = (x0 - px0) * outscale, (y0 - py0) * outscale
+            bw, bh = (x1 - x0) * outscale, (y1 - y0) * outscale
+            out[y0 * outscale:y0 * outscale + bh, x0 * outscale:x0 * outscale + bw] = up[oy:oy + bh, ox:ox + bw]
+    return out
+
+# ---------- Tracer ----------
 def vectorize_to_svg(raster_path: str, svg_path: str, args):
-    cmd = [
-        "vtracer",
-        "--input", raster_path,
-        "--output", svg_path,
-        "--mode", args.mode,
-        "--color_precision", str(args.color_precision),
-        "--filter_speckle", str(args.filter_speckle),
-        "--hierarchical", args.hierarchical,
-        "--corner_threshold", str(args.corner_threshold),
-        "--gradient_step", str(args.gradient_step),
-        "--segment_length", str(args.segment_length),
-        "--splice_threshold", str(args.splice_threshold),
-        "--path_precision", str(args.path_precision),
-    ]
-    subprocess.run(cmd, check=True)
+    # vtracer (binding or CLI) or the built-in contour tracer, see tracers.py
+    tracers.get(tracers.resolve("vectorize", args.tracer)).trace(raster_path, svg_path, vars(args))
 
 # ---------- per-image pipeline ----------
-def process_image(image_path: str, args, device: str):
+def process_image(image_path: str, args, device: str, timer=None):
+    timer = timer or StageTimer()
     base = args.base_name or os.path.splitext(os.path.basename(image_path))[0]
     target_svg = safe_svg_path(args.output, base)
 
-    score = measure_image_quality(image_path)
-    print(f"• {os.path.basename(image_path)} | sharpness={score:.2f}", end=" ")
-
-    if score < args.quality_threshold:
-        print(f"→ upscale (thr {args.quality_threshold}) → vectorize")
-
-        upscaled = upscale_image(image_path, args.model_path, args.scale, device, args)
+    with timer.stage("quality_check"):
+        decision = upscale_gate.evaluate(image_path, args.quality_threshold, args.scale, device,
+                                         policy=args.upscale_policy)
+    features = decision.features
+    print(f"• {os.path.basename(image_path)} | sharpness={features['laplacian_var']:.2f} "
+          f"blurry={features['blurry_fraction']:.0%} colors={features['colors']}", end=" ")
+
+    if decision.upscales:
+        print(f"→ {decision.action} x{decision.scale} ({decision.reason}) → vectorize")
+
+        if decision.action == "regions":
+            upscaled = upscale_regions(image_path, decision.regions, args.model_path, args.scale, device, args,
+                                       timer, outscale=decision.scale)
+        else:
+            upscaled = upscale_image(image_path, args.model_path, args.scale, device, args, timer,
+                                     outscale=decision.scale)
+
+        if args.raster_out:
+            with timer.stage("encode"):
+                cv2.imwrite(args.raster_out, upscaled)
+            return
 
         tmp = tempfile.NamedTemporaryFile(suffix=".png", delete=False, dir=args.output)
         tmp_path = tmp.name
         tmp.close()
         try:
-            cv2.imwrite(tmp_path, upscaled)
-            vectorize_to_svg(tmp_path, target_svg, args)
+            with timer.stage("encode"):
+                cv2.imwrite(tmp_path, upscaled)
+            with timer.stage("trace"):
+                vectorize_to_svg(tmp_path, target_svg, args)
         finally:
             if os.path.exists(tmp_path):
                 os.remove(tmp_path)
+    elif args.raster_out:
+        print(f"→ no upscale ({decision.reason})")
+        shutil.copyfile(image_path, args.raster_out)
     else:
-        print("→ vectorize (no upscale)")
-        vectorize_to_svg(image_path, target_svg, args)
+        print(f"→ vectorize (no upscale: {decision.reason})")
+        with timer.stage("trace"):
+            vectorize_to_svg(image_path, target_svg, args)
 
 # ---------- main ----------
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(description="Bitmap → (optional ESRGAN) → VTracer (SVG)")
 
     parser.add_argument("--input", required=True, help="Image file or folder")
-    parser.add_argument("--model_path", required=False,
-                        default="app/weights/RealESRGAN_x4plus_anime_6B.pth",
-                        help="Path to Real-ESRGAN .pth model")
+    parser.add_argument("--upscale_tier", choices=upscalers.TIERS, default="anime6b",
+                        help="Upscaler for blurry images: fast (interpolation), anime6b or x4plus (default: anime6b)")
+    parser.add_argument("--model_path", required=False, default=None,
+                        help="Path to Real-ESRGAN .pth model (default: the tier's file in app/weights)")
     parser.add_argument("--output", default="output", help="Output directory for SVGs")
+    parser.add_argument("--tracer", default=None, choices=["auto", *tracers.PREFERENCE["vectorize"]],
+                        help="Tracer backend (default: TRACER_VECTORIZE, auto)")
     parser.add_argument("--scale", type=int, default=4, help="Upscale factor (default: 4)")
+    parser.add_argument("--upscale_policy", default=None, choices=["gated", "legacy", "never", "always"],
+                        help="Upscale decision (default: UPSCALE_POLICY, gated; see upscale_gate.py)")
     parser.add_argument("--quality_threshold", type=float, default=5500.0,
-                        help="Laplacian variance threshold")
+                        help="Laplacian variance threshold; only decides with --upscale_policy legacy "
+                             "(the gated policy ignores it and logs the legacy decision for comparison)")
     parser.add_argument("--base_name", default=None, help="Base name for output (used by API)")
+    parser.add_argument("--timings_out", default=None, help="Write per-stage timings (JSON) here")
+    parser.add_argument("--profile_dir", default=None, help="Write CPU/torch profiles into this directory")
+    parser.add_argument("--raster_out", default=None,
+                        help="Only write the raster VTracer would trace (upscaled if needed) here, e.g. for sweeps")
 
     # NEW: Tiling options
     parser.add_argument("--tile", type=int, default=1024,
@@ -130,11 +163,16 @@ def main():
     parser.add_argument("--segment_length", type=int, default=10)
     parser.add_argument("--splice_threshold", type=int, default=80)
     parser.add_argument("--path_precision", type=int, default=1)
+    return parser
 
-    args = parser.parse_args()
-    ensure_vtracer()
 
-    if not os.path.isfile(args.model_path):
+def main():
+    args = build_parser().parse_args()
+    args.tracer = tracers.resolve("vectorize", args.tracer)
+
+    if args.upscale_tier != "fast":
+        args.model_path = args.model_path or upscalers.WEIGHTS[args.upscale_tier]
+    if args.upscale_tier != "fast" and not os.path.isfile(args.model_path):
         raise FileNotFoundError(f"ESRGAN model not found: {args.model_path}")
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -157,7 +195,10 @@ def main():
     else:
         if not args.input.lower().endswith(valid_exts):
             raise ValueError("Unsupported image format.")
-        process_image(args.input, args, device)
+        timer = StageTimer()
+        with cpu_profile(args.profile_dir, "vectorize"):
+            process_image(args.input, args, device, timer)
+        timer.dump(args.timings_out)
 
     print("✅ All conversions complete.")
 
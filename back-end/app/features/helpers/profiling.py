@@ -0,0 +1,147 @@
+"""
+Opt-in profiling for conversion/recommendation requests.
+
+A request is profiled when it sends `X-Profile: 1` (or `?profile=1`) together with
+`X-Admin-Token: $PROFILE_ADMIN_TOKEN`, or when it is picked by sampling
+(PROFILE_SAMPLE_RATE=N profiles 1 in N requests; 0 disables sampling).
+
+Profilers write their artifacts into a per-request directory: a sampling CPU profile
+(pyinstrument when installed, cProfile otherwise) and torch profiler tables/traces around
+ESRGAN and CLIP. The pipeline child processes receive the same directory via --profile_dir,
+so their profiles land next to the API process' ones. The router stores the files in the
+`profile_artifacts` table keyed by conversion/image id.
+"""
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:  # pragma: no cover - optional dependency
+    SamplingProfiler = None
+
+ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+_TRUTHY = {"1", "true", "yes"}
+_CONTENT_TYPES = {
+    ".html": "text/html",
+    ".txt": "text/plain",
+    ".json": "application/json",
+    ".prof": "application/octet-stream",
+}
+
+
+def is_admin(request: Request) -> bool:
+    token = request.headers.get("x-admin-token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+def require_admin(request: Request):
+    """FastAPI dependency guarding profile retrieval."""
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+class ProfileSession:
+    """Per-request artifact directory plus how the request got selected."""
+
+    def __init__(self, reason: str):
+        self.reason = reason  # requested | sampled
+        self.dir = tempfile.mkdtemp(prefix="imageuplift-profile-")
+
+    def collect(self) -> List[Tuple[str, str, bytes]]:
+        """Return (name, content_type, data) for every artifact written so far."""
+        out = []
+        for path in sorted(Path(self.dir).iterdir()):
+            if path.is_file():
+                out.append((path.name, _CONTENT_TYPES.get(path.suffix, "application/octet-stream"), path.read_bytes()))
+        return out
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def request_profiling(request: Request) -> Iterator[Optional[ProfileSession]]:
+    """
+    FastAPI dependency: yields a ProfileSession when this request should be profiled, else None.
+    Explicit profiling without a valid admin token is rejected with 403.
+    """
+    requested = (
+        request.headers.get("x-profile", "").lower() in _TRUTHY
+        or request.query_params.get("profile", "").lower() in _TRUTHY
+    )
+    if requested and not is_admin(request):
+        raise HTTPException(status_code=403, detail="Profiling requires an admin token")
+
+    session = None
+    if requested:
+        session = ProfileSession("requested")
+    elif SAMPLE_RATE > 0 and random.randrange(SAMPLE_RATE) == 0:
+        session = ProfileSession("sampled")
+    try:
+        yield session
+    finally:
+        if session:
+            session.cleanup()
+
+
+@contextmanager
+def cpu_profile(out_dir: Optional[str], name: str):
+    """Sampling CPU profile of the enclosed block, written to `out_dir` (no-op when None)."""
+    if not out_dir:
+        yield
+        return
+
+    if SamplingProfiler is not None:
+        profiler = SamplingProfiler(async_mode="disabled")
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            Path(out_dir, f"{name}.cpu.html").write_text(profiler.output_html())
+            Path(out_dir, f"{name}.cpu.txt").write_text(profiler.output_text(unicode=True))
+        return
+
+    # cProfile fallback (deterministic, higher overhead) when pyinstrument is not installed
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(str(Path(out_dir, f"{name}.cpu.prof")))
+        buf = io.StringIO()
+        pstats.Stats(profiler, stream=buf).sort_stats("cumulative").print_stats(60)
+        Path(out_dir, f"{name}.cpu.txt").write_text(buf.getvalue())
+
+
+@contextmanager
+def torch_profile(out_dir: Optional[str], name: str):
+    """torch.profiler around a model call: op table (.txt) + Chrome trace (.json)."""
+    if not out_dir:
+        yield
+        return
+
+    import torch
+    from torch.profiler import ProfilerActivity, profile
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    with profile(activities=activities) as prof:
+        yield
+    sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+    Path(out_dir, f"{name}.torch.txt").write_text(prof.key_averages().table(sort_by=sort_by, row_limit=50))
+    prof.export_chrome_trace(str(Path(out_dir, f"{name}.torch.json")))
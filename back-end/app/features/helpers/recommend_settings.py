@@ -1,6 +1,7 @@
 import os
 import argparse
 import json
+import time
 from collections import Counter
 
 import cv2
@@ -10,6 +11,18 @@ from PIL import Image
 import torch
 import clip  # local CLIP – requires: pip install git+https://github.com/openai/CLIP.git
 
+from app import metrics
+from app.features.conversion import tiled_io
+from app.features.helpers.profiling import torch_profile
+
+# Stored recommendations are reused for identical uploads (conversion/recommend_cache.py). Bump
+# METADATA_VERSION when extract_image_metadata (or the CLIP prompts) measures differently: older
+# entries are recomputed from the image. Bump HEURISTICS_VERSION when recommend_vector_settings,
+# recommend_outline_settings or recommend_conversion change: older entries get their settings
+# recomputed from the stored metadata, without CLIP.
+METADATA_VERSION = 1
+HEURISTICS_VERSION = 1
+
 
 # -----------------------
 # Helpers
@@ -61,13 +74,17 @@ _CLIP_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 def load_clip_model():
     global _CLIP_MODEL, _CLIP_PREPROCESS
-    if _CLIP_MODEL is None or _CLIP_PREPROCESS is None:
+    cached = _CLIP_MODEL is not None and _CLIP_PREPROCESS is not None
+    metrics.cache_lookup("clip_model", cached)
+    if not cached:
+        start = time.perf_counter()
         _CLIP_MODEL, _CLIP_PREPROCESS = clip.load("ViT-B/32", device=_CLIP_DEVICE)
         _CLIP_MODEL.eval()
+        metrics.MODEL_LOAD_SECONDS.labels(model="clip_vit_b32").observe(time.perf_counter() - start)
     return _CLIP_MODEL, _CLIP_PREPROCESS
 
 
-def classify_with_clip(pil_img):
+def classify_with_clip(pil_img, profile_dir=None):
     model, preprocess = load_clip_model()
 
     text_prompts = [
@@ -79,7 +96,7 @@ def classify_with_clip(pil_img):
         "a realistic photograph of a landscape or scene"
     ]
 
-    with torch.no_grad():
+    with torch.no_grad(), torch_profile(profile_dir, "clip"):
         image_input = preprocess(pil_img).unsqueeze(0).to(_CLIP_DEVICE)
         text_tokens = clip.tokenize(text_prompts).to(_CLIP_DEVICE)
 
@@ -113,14 +130,20 @@ def classify_with_clip(pil_img):
 # Metadata extraction
 # -----------------------
 
-def extract_image_metadata(image_path):
-    img_cv = cv2.imread(image_path)
-    if img_cv is None:
-        raise ValueError(f"Could not read image: {image_path}")
+def extract_image_metadata(image_path, profile_dir=None):
+    factor = 1
+    if tiled_io.is_large(image_path):
+        # too large to decode in memory: measure a reduced copy (see tiled_io.read_downscaled)
+        img_cv, factor, (w, h) = tiled_io.read_downscaled(image_path, tiled_io.TILED_ANALYSIS_SIDE)
+        pil_img = Image.fromarray(cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB))
+    else:
+        img_cv = cv2.imread(image_path)
+        if img_cv is None:
+            raise ValueError(f"Could not read image: {image_path}")
 
-    pil_img = Image.open(image_path).convert("RGB")
+        pil_img = Image.open(image_path).convert("RGB")
 
-    h, w, _ = img_cv.shape
+        h, w, _ = img_cv.shape
     resolution = f"{w}x{h}"
     aspect_ratio = round(w / h, 2)
     file_size = os.path.getsize(image_path)
@@ -131,9 +154,10 @@ def extract_image_metadata(image_path):
     color_count = get_color_count(pil_img)
     dominant_colors = get_dominant_colors(pil_img)
     noise_level = estimate_noise(img_cv)
-    edge_complexity = estimate_edge_complexity(img_cv)
+    # edges are lines, so their pixel count shrinks about linearly with the reduction
+    edge_complexity = estimate_edge_complexity(img_cv) * factor
 
-    clip_label, clip_conf, clip_raw = classify_with_clip(pil_img)
+    clip_label, clip_conf, clip_raw = classify_with_clip(pil_img, profile_dir)
 
     metadata = {
         "file_name": os.path.basename(image_path),
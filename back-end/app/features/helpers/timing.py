@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# set by the API for pipeline child processes; their timers then announce stages on stdout
+PROGRESS_ENV = "IMAGEUPLIFT_PROGRESS"
+PROGRESS_PREFIX = "@@progress "
+
+StageListener = Callable[[str, str], None]  # (stage, "start" | "finish")
+
+
+def print_progress(stage: str, phase: str):
+    """Stage listener for child processes: one machine-readable line the parent relays to its job."""
+    sys.stdout.write(PROGRESS_PREFIX + json.dumps({"stage": stage, "phase": phase}) + "\n")
+    sys.stdout.flush()
+
+
+class StageTimer:
+    """
+    Collects wall-clock seconds per named pipeline stage (upload, decode, esrgan, trace, ...).
+    Re-entering a stage adds to its total. An optional listener is told when each stage starts and
+    finishes (progress reporting); it may raise to abort before a stage starts (cancellation).
+    """
+
+    def __init__(self, listener: Optional[StageListener] = None):
+        self.stages: Dict[str, float] = {}
+        if listener is None and os.getenv(PROGRESS_ENV):
+            listener = print_progress
+        self.listener = listener
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.listener:
+            self.listener(name, "start")
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+            if self.listener:
+                self.listener(name, "finish")
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + max(seconds, 0.0)
+
+    def merge(self, stages: Optional[Dict[str, float]]):
+        for name, seconds in (stages or {}).items():
+            self.add(name, float(seconds))
+
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+    def as_dict(self) -> Dict[str, float]:
+        return {name: round(seconds, 4) for name, seconds in self.stages.items()}
+
+    def dump(self, path: Optional[str]):
+        """Write timings as JSON so a parent process can merge them (used by the CLI scripts)."""
+        if not path:
+            return
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f)
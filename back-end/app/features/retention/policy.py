@@ -0,0 +1,468 @@
+"""
+Retention and compaction for stored blobs and history.
+
+Policies (env, 0 disables each):
+- RETENTION_OUTPUT_DAYS (30): outputs older than this are demoted to thumbnail-only
+  (the gallery-size thumbnail is cached first, then output_blob is dropped; SVGs that cannot
+  be rasterized keep their SVG as the legacy thumbnail)
+- RETENTION_ORIGINAL_DAYS (30): uploaded originals older than this are dropped
+- RETENTION_MAX_CONVERSIONS (0): keep at most this many conversions, deleting the oldest
+- RETENTION_MAX_BLOB_MB (0): total blob budget; oldest outputs, then oldest originals, are
+  dropped until the stored blobs fit
+- RETENTION_JOB_DAYS (7): finished conversion_jobs rows (CONVERSION_QUEUE=1) are deleted
+  this long after they finished
+- RETENTION_ORPHAN_GRACE_HOURS (1): images with no conversion, recommendation or queued job
+  left are deleted once older than this
+
+Work is done in batches of RETENTION_BATCH_SIZE rows, one short transaction each, with a
+RETENTION_BATCH_PAUSE_MS pause in between so live requests keep getting the write lock. On
+SQLite freed pages are then returned to the filesystem with `PRAGMA incremental_vacuum`
+(RETENTION_VACUUM_PAGES per step); databases created before auto_vacuum=INCREMENTAL need one
+offline `--full_vacuum`. PostgreSQL's autovacuum takes care of its own compaction.
+
+Retention keeps analytics history: rollup counters are not decremented for rows it removes
+(unlike DELETE /conversion/{id}), so `rebuild_rollups` afterwards only covers what is left.
+
+Runs every RETENTION_INTERVAL_MINUTES in the API process (0 = off), from the admin endpoint
+POST /retention/run, or from the CLI:
+
+    python -m app.features.retention.policy [--full_vacuum]
+"""
+import argparse
+import asyncio
+import datetime as dt
+import hashlib
+import os
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+from loguru import logger
+from sqlalchemy import and_, case, exists, func, update
+from sqlalchemy.orm import Session
+
+from app import metrics
+from app.db import SessionLocal, engine
+from app.db.models import (
+    Conversion, ConversionJob, ConversionStage, ConversionThumbnail, Image, ProfileArtifact, Recommendation,
+)
+from app.features.conversion import thumbnails
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX
+    fcntl = None
+
+RETENTION_OUTPUT_DAYS = float(os.getenv("RETENTION_OUTPUT_DAYS", "30"))
+RETENTION_ORIGINAL_DAYS = float(os.getenv("RETENTION_ORIGINAL_DAYS", "30"))
+RETENTION_MAX_CONVERSIONS = int(os.getenv("RETENTION_MAX_CONVERSIONS", "0"))
+RETENTION_MAX_BLOB_MB = float(os.getenv("RETENTION_MAX_BLOB_MB", "0"))
+RETENTION_JOB_DAYS = float(os.getenv("RETENTION_JOB_DAYS", "7"))
+RETENTION_ORPHAN_GRACE_HOURS = float(os.getenv("RETENTION_ORPHAN_GRACE_HOURS", "1"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "200"))
+RETENTION_BATCH_PAUSE_MS = float(os.getenv("RETENTION_BATCH_PAUSE_MS", "50"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "2000"))
+RETENTION_INTERVAL_MINUTES = float(os.getenv("RETENTION_INTERVAL_MINUTES", "0"))
+
+_SVG_MIME = "image/svg+xml"
+
+last_report: Optional[dict] = None
+
+
+def _cutoff(**delta) -> dt.datetime:
+    return dt.datetime.utcnow() - dt.timedelta(**delta)
+
+
+def _pause():
+    time.sleep(RETENTION_BATCH_PAUSE_MS / 1000.0)
+
+
+def _in_batches(select_ids: Callable[[Session], List[int]], apply: Callable[[Session, List[int]], None],
+                limit: Optional[int] = None):
+    """Repeatedly pick up to RETENTION_BATCH_SIZE ids and process them in their own transaction."""
+    done = 0
+    while limit is None or done < limit:
+        with SessionLocal() as db:
+            ids = select_ids(db)
+            if not ids:
+                return
+            apply(db, ids)
+            db.commit()
+        done += len(ids)
+        _pause()
+
+
+def _reclaimed(report: Counter, kind: str, nbytes: int):
+    report[f"reclaimed_{kind}_bytes"] += nbytes
+    metrics.RETENTION_RECLAIMED_BYTES.labels(kind=kind).inc(nbytes)
+
+
+# -----------------------
+# Policies
+# -----------------------
+
+def _encoded_output_bytes():
+    """SUM of the pre-compressed output variants (gzip/br)."""
+    return (
+        func.coalesce(func.sum(func.length(Conversion.output_gzip_blob)), 0)
+        + func.coalesce(func.sum(func.length(Conversion.output_br_blob)), 0)
+    )
+
+
+def demote_outputs(report: Counter, before: Optional[dt.datetime] = None, limit: Optional[int] = None):
+    """Drop output blobs (oldest first), keeping a thumbnail; `before=None` ignores age."""
+    def select_ids(db):
+        q = db.query(Conversion.id).filter(Conversion.output_blob.isnot(None))
+        if before is not None:
+            q = q.filter(Conversion.created_at < before)
+        return [r.id for r in q.order_by(Conversion.created_at).limit(RETENTION_BATCH_SIZE)]
+
+    def apply(db, ids):
+        # render the gallery thumbnail while the output is still there (reads only, so the write
+        # lock is not held during rendering)
+        has_thumb = exists().where(
+            ConversionThumbnail.conversion_id == Conversion.id, ConversionThumbnail.size == thumbnails.DEFAULT_SIZE
+        )
+        cached_ids = {r.id for r in db.query(Conversion.id).filter(Conversion.id.in_(ids), has_thumb)}
+        new_thumbs = []
+        for conv_id in set(ids) - cached_ids:
+            conv = db.query(Conversion.output_blob, Conversion.output_mime).filter(Conversion.id == conv_id).one()
+            data = thumbnails.render(conv.output_blob, conv.output_mime, thumbnails.DEFAULT_SIZE)
+            if data is not None:
+                new_thumbs.append(ConversionThumbnail(
+                    conversion_id=conv_id, size=thumbnails.DEFAULT_SIZE, mime="image/webp", blob=data
+                ))
+                cached_ids.add(conv_id)
+        db.add_all(new_thumbs)
+
+        # with a cached thumbnail the legacy one is redundant; otherwise an SVG without a thumbnail
+        # keeps its SVG there so the gallery can still show it
+        thumb_cached = Conversion.id.in_(cached_ids)
+        svg_without_thumb = and_(
+            ~thumb_cached, Conversion.output_thumb_blob.is_(None), Conversion.output_mime == _SVG_MIME
+        )
+        freed = db.query(
+            func.coalesce(func.sum(func.length(Conversion.output_blob)), 0)
+            + func.coalesce(func.sum(case((thumb_cached, func.length(Conversion.output_thumb_blob)), else_=0)), 0)
+        ).filter(Conversion.id.in_(ids), ~svg_without_thumb).scalar()
+        freed += db.query(_encoded_output_bytes()).filter(Conversion.id.in_(ids)).scalar()
+        db.execute(
+            update(Conversion)
+            .where(Conversion.id.in_(ids))
+            .values(
+                output_thumb_blob=case(
+                    (thumb_cached, None),
+                    (svg_without_thumb, Conversion.output_blob),
+                    else_=Conversion.output_thumb_blob,
+                ),
+                output_blob=None,
+                output_gzip_blob=None,
+                output_br_blob=None,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        report["demoted_outputs"] += len(ids)
+        _reclaimed(report, "output", int(freed or 0) - sum(len(t.blob) for t in new_thumbs))
+
+    _in_batches(select_ids, apply, limit)
+
+
+def strip_originals(report: Counter, before: Optional[dt.datetime] = None, limit: Optional[int] = None):
+    """Drop uploaded originals (oldest first); the image row and its metadata stay."""
+    def select_ids(db):
+        q = db.query(Image.id).filter(Image.original_blob.isnot(None))
+        if before is not None:
+            q = q.filter(Image.created_at < before)
+        return [r.id for r in q.order_by(Image.created_at).limit(RETENTION_BATCH_SIZE)]
+
+    def apply(db, ids):
+        freed = db.query(func.coalesce(func.sum(func.length(Image.original_blob)), 0)).filter(Image.id.in_(ids)).scalar()
+        db.execute(
+            update(Image).where(Image.id.in_(ids)).values(original_blob=None)
+            .execution_options(synchronize_session=False)
+        )
+        report["stripped_originals"] += len(ids)
+        _reclaimed(report, "original", int(freed or 0))
+
+    _in_batches(select_ids, apply, limit)
+
+
+def _delete_conversions(db: Session, ids: List[int]) -> int:
+    """Delete conversions with their stage/profile/thumbnail/queued-job rows; returns blob bytes freed."""
+    freed = db.query(
+        func.coalesce(func.sum(func.length(Conversion.output_blob)), 0)
+        + func.coalesce(func.sum(func.length(Conversion.output_thumb_blob)), 0)
+        + _encoded_output_bytes()
+    ).filter(Conversion.id.in_(ids)).scalar()
+    freed += db.query(func.coalesce(func.sum(func.length(ConversionThumbnail.blob)), 0)).filter(
+        ConversionThumbnail.conversion_id.in_(ids)
+    ).scalar()
+    db.query(ConversionThumbnail).filter(ConversionThumbnail.conversion_id.in_(ids)).delete(synchronize_session=False)
+    db.query(ConversionStage).filter(ConversionStage.conversion_id.in_(ids)).delete(synchronize_session=False)
+    db.query(ProfileArtifact).filter(ProfileArtifact.conversion_id.in_(ids)).delete(synchronize_session=False)
+    db.query(ConversionJob).filter(ConversionJob.conversion_id.in_(ids)).delete(synchronize_session=False)
+    db.query(Conversion).filter(Conversion.id.in_(ids)).delete(synchronize_session=False)
+    return int(freed or 0)
+
+
+def enforce_max_conversions(report: Counter, keep: int):
+    def select_ids(db):
+        return [
+            r.id for r in db.query(Conversion.id)
+            .order_by(Conversion.created_at.desc(), Conversion.id.desc())
+            .offset(keep)
+            .limit(RETENTION_BATCH_SIZE)
+        ]
+
+    def apply(db, ids):
+        report["deleted_conversions"] += len(ids)
+        _reclaimed(report, "conversion", _delete_conversions(db, ids))
+
+    _in_batches(select_ids, apply)
+
+
+def blob_bytes(db: Session) -> dict:
+    """Stored blob bytes by kind."""
+    return {
+        "original": int(db.query(func.coalesce(func.sum(func.length(Image.original_blob)), 0)).scalar()),
+        "output": int(db.query(func.coalesce(func.sum(func.length(Conversion.output_blob)), 0)).scalar())
+        + int(db.query(_encoded_output_bytes()).scalar()),
+        "thumbnail": int(db.query(func.coalesce(func.sum(func.length(Conversion.output_thumb_blob)), 0)).scalar())
+        + int(db.query(func.coalesce(func.sum(func.length(ConversionThumbnail.blob)), 0)).scalar()),
+    }
+
+
+def enforce_blob_budget(report: Counter, max_bytes: int):
+    """Demote oldest outputs, then strip oldest originals, one batch at a time until under budget."""
+    for step in (demote_outputs, strip_originals):
+        while True:
+            with SessionLocal() as db:
+                total = sum(blob_bytes(db).values())
+            if total <= max_bytes:
+                return
+            before = dict(report)
+            step(report, limit=RETENTION_BATCH_SIZE)
+            if dict(report) == before:
+                break  # nothing left for this step
+
+
+def purge_finished_jobs(report: Counter, before: dt.datetime):
+    """Delete conversion_jobs rows that finished before `before` (their conversions stay)."""
+    def select_ids(db):
+        return [
+            r.id for r in db.query(ConversionJob.id)
+            .filter(ConversionJob.finished_at < before)
+            .limit(RETENTION_BATCH_SIZE)
+        ]
+
+    def apply(db, ids):
+        db.query(ConversionJob).filter(ConversionJob.id.in_(ids)).delete(synchronize_session=False)
+        report["deleted_jobs"] += len(ids)
+
+    _in_batches(select_ids, apply)
+
+
+def _orphaned(grace_cutoff: dt.datetime):
+    return and_(
+        Image.created_at < grace_cutoff,
+        ~exists().where(Conversion.image_id == Image.id),
+        ~exists().where(Recommendation.image_id == Image.id),
+        ~exists().where(ConversionJob.image_id == Image.id),
+    )
+
+
+def collect_orphan_images(report: Counter, grace_hours: float = RETENTION_ORPHAN_GRACE_HOURS):
+    cutoff = _cutoff(hours=grace_hours)
+
+    def select_ids(db):
+        return [r.id for r in db.query(Image.id).filter(_orphaned(cutoff)).limit(RETENTION_BATCH_SIZE)]
+
+    def apply(db, ids):
+        freed = db.query(func.coalesce(func.sum(func.length(Image.original_blob)), 0)).filter(Image.id.in_(ids)).scalar()
+        db.query(ProfileArtifact).filter(ProfileArtifact.image_id.in_(ids)).delete(synchronize_session=False)
+        db.query(Image).filter(Image.id.in_(ids)).delete(synchronize_session=False)
+        report["deleted_images"] += len(ids)
+        _reclaimed(report, "original", int(freed or 0))
+
+    _in_batches(select_ids, apply)
+
+
+def delete_image_if_orphaned(db: Session, image_id: Optional[int]):
+    """Delete an image (and its profiles) once nothing references it; does not commit."""
+    if image_id is None:
+        return
+    db.flush()
+    referenced = db.query(
+        exists().where(Conversion.image_id == image_id)
+        | exists().where(Recommendation.image_id == image_id)
+        | exists().where(ConversionJob.image_id == image_id)
+    ).scalar()
+    if not referenced:
+        db.query(ProfileArtifact).filter(ProfileArtifact.image_id == image_id).delete(synchronize_session=False)
+        db.query(Image).filter(Image.id == image_id).delete(synchronize_session=False)
+
+
+# -----------------------
+# Compaction
+# -----------------------
+
+def sqlite_storage() -> Optional[dict]:
+    if engine.dialect.name != "sqlite":
+        return None
+    with engine.connect() as conn:
+        page_size = conn.exec_driver_sql("PRAGMA page_size").scalar()
+        return {
+            "page_size": page_size,
+            "page_count": conn.exec_driver_sql("PRAGMA page_count").scalar(),
+            "freelist_pages": conn.exec_driver_sql("PRAGMA freelist_count").scalar(),
+            # 0 none, 1 full, 2 incremental
+            "auto_vacuum": conn.exec_driver_sql("PRAGMA auto_vacuum").scalar(),
+        }
+
+
+def incremental_vacuum(report: Counter):
+    """Return free pages to the filesystem a few thousand at a time."""
+    storage = sqlite_storage()
+    if storage is None:
+        return
+    if storage["auto_vacuum"] != 2:
+        if storage["freelist_pages"]:
+            logger.warning(
+                f"🧹 {storage['freelist_pages'] * storage['page_size']} bytes are free inside the database file but "
+                "auto_vacuum is not INCREMENTAL; run `python -m app.features.retention.policy --full_vacuum` once."
+            )
+        return
+    while True:
+        with engine.begin() as conn:
+            free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            if not free:
+                break
+            # each step of this pragma frees one page, so the cursor must be drained
+            cursor = conn.connection.driver_connection.cursor()
+            cursor.execute(f"PRAGMA incremental_vacuum({min(free, RETENTION_VACUUM_PAGES)})")
+            cursor.fetchall()
+            cursor.close()
+            pages = free - conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        if pages <= 0:
+            break
+        report["vacuumed_pages"] += pages
+        _reclaimed(report, "file", pages * storage["page_size"])
+        _pause()
+    with engine.connect() as conn:
+        # fold the WAL back into the main file without waiting on readers
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+
+
+def full_vacuum():
+    """Offline: switch to incremental auto_vacuum and rebuild the file (blocks all writers)."""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+
+
+# -----------------------
+# Runner
+# -----------------------
+
+@contextmanager
+def _exclusive() -> Iterator[bool]:
+    """Host-wide lock so only one worker process runs retention at a time."""
+    if fcntl is None:
+        yield True
+        return
+    key = hashlib.sha1(str(engine.url).encode()).hexdigest()[:12]
+    with open(os.path.join(tempfile.gettempdir(), f"imageuplift-retention-{key}.lock"), "w") as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def run_retention() -> dict:
+    """Apply every configured policy, then compact. Returns the report (also kept in last_report)."""
+    global last_report
+    report = Counter()
+    start = time.perf_counter()
+    with _exclusive() as acquired:
+        if not acquired:
+            return {"skipped": "retention already running"}
+        if RETENTION_OUTPUT_DAYS > 0:
+            demote_outputs(report, before=_cutoff(days=RETENTION_OUTPUT_DAYS))
+        if RETENTION_ORIGINAL_DAYS > 0:
+            strip_originals(report, before=_cutoff(days=RETENTION_ORIGINAL_DAYS))
+        if RETENTION_MAX_CONVERSIONS > 0:
+            enforce_max_conversions(report, RETENTION_MAX_CONVERSIONS)
+        if RETENTION_MAX_BLOB_MB > 0:
+            enforce_blob_budget(report, int(RETENTION_MAX_BLOB_MB * 1024 * 1024))
+        if RETENTION_JOB_DAYS > 0:
+            purge_finished_jobs(report, before=_cutoff(days=RETENTION_JOB_DAYS))
+        collect_orphan_images(report)
+        incremental_vacuum(report)
+
+    result = dict(report)
+    result["reclaimed_bytes"] = sum(v for k, v in report.items() if k.startswith("reclaimed_") and k != "reclaimed_file_bytes")
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    result["finished_at"] = dt.datetime.utcnow().isoformat()
+    last_report = result
+    logger.info(f"🧹 Retention run: {result}")
+    return result
+
+
+async def _loop():
+    while True:
+        await asyncio.sleep(RETENTION_INTERVAL_MINUTES * 60)
+        try:
+            # policies block on the DB; keep them off the event loop
+            await asyncio.to_thread(run_retention)
+        except Exception as e:
+            logger.error(f"Retention run failed: {e}")
+
+
+_task: Optional[asyncio.Task] = None
+
+
+def start():
+    """Start the periodic retention loop (no-op when RETENTION_INTERVAL_MINUTES is 0)."""
+    global _task
+    if RETENTION_INTERVAL_MINUTES > 0 and _task is None:
+        _task = asyncio.get_running_loop().create_task(_loop())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply retention policies and compact the database")
+    parser.add_argument("--full_vacuum", action="store_true",
+                        help="Also rebuild the SQLite file with incremental auto_vacuum (blocks writers)")
+    args = parser.parse_args()
+
+    report = run_retention()
+    if args.full_vacuum:
+        before = sqlite_storage()
+        full_vacuum()
+        after = sqlite_storage()
+        if before and after:
+            report["full_vacuum_freed_bytes"] = (before["page_count"] - after["page_count"]) * after["page_size"]
+    print(f"✅ Retention done: {report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.db import get_db
+from app.db import models
+from app.features.helpers import profiling
+from app.features.retention import policy
+
+router = APIRouter(prefix="/retention", tags=["Retention"], dependencies=[Depends(profiling.require_admin)])
+
+
+@router.get("/status")
+def retention_status(db: Session = Depends(get_db)):
+    """
+    Stored blob bytes, row counts, SQLite file/free-list size, active policies and the last run's report.
+    """
+    demoted = (
+        db.query(func.count(models.Conversion.id))
+        .filter(models.Conversion.output_blob.is_(None), models.Conversion.output_size_bytes.isnot(None))
+        .scalar()
+    )
+    return {
+        "blob_bytes": policy.blob_bytes(db),
+        "rows": {
+            "images": db.query(func.count(models.Image.id)).scalar(),
+            "conversions": db.query(func.count(models.Conversion.id)).scalar(),
+            "demoted_conversions": demoted,
+            "recommendations": db.query(func.count(models.Recommendation.id)).scalar(),
+        },
+        "sqlite": policy.sqlite_storage(),
+        "policy": {
+            "output_days": policy.RETENTION_OUTPUT_DAYS,
+            "original_days": policy.RETENTION_ORIGINAL_DAYS,
+            "max_conversions": policy.RETENTION_MAX_CONVERSIONS,
+            "max_blob_mb": policy.RETENTION_MAX_BLOB_MB,
+            "orphan_grace_hours": policy.RETENTION_ORPHAN_GRACE_HOURS,
+            "interval_minutes": policy.RETENTION_INTERVAL_MINUTES,
+        },
+        "last_run": policy.last_report,
+    }
+
+
+@router.post("/run")
+async def run_retention():
+    """
+    Runs every policy plus compaction now (batched, off the event loop) and returns the reclaimed bytes.
+    """
+    return await run_in_threadpool(policy.run_retention)
@@ -1,16 +1,20 @@
+import os
+import time
 from pathlib import Path
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from starlette.exceptions import HTTPException
 from app.features.conversion import router as conversion_router
 from app.features.analytics import router as analytics_router
+from app.features.retention import policy as retention
+from app.features.retention import router as retention_router
 from loguru import logger
 
-from app.db import Base, engine
-import app.db.models  # noqa: F401 - ensure models are registered
+from app import metrics
+from app.db import migrate, writer
 
 app = FastAPI(title="ImageUpLift Service", version="0.1.0")
 REPO_ROOT = Path(__file__).resolve().parents[2]
@@ -33,11 +37,25 @@ class SPAStaticFiles(StaticFiles):
 
 @app.on_event("startup")
 def on_startup():
-    # Create DB file/tables if they don't exist
-    if engine.url.drivername.startswith("sqlite") and engine.url.database:
-        db_path = Path(engine.url.database)
-        db_path.parent.mkdir(parents=True, exist_ok=True)
-    Base.metadata.create_all(bind=engine)
+    # One version lookup when the schema is current; creates/migrates the DB otherwise
+    migrate.ensure_schema()
+
+
+@app.on_event("startup")
+async def start_background_jobs():
+    retention.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    await retention.stop()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    # flush batched writes before the process exits
+    writer.shutdown()
+    metrics.mark_process_dead(os.getpid())
 
 
 # ✅ Log incoming origins for debugging
@@ -51,6 +69,24 @@ async def log_request_origin(request: Request, call_next):
     return response
 
 
+# ✅ Request latency per route template (not raw path, to keep label cardinality bounded)
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.REQUEST_LATENCY.labels(
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=str(status),
+        ).observe(time.perf_counter() - start)
+
+
 # ✅ Proper CORS — allow frontend on localhost:3000
 app.add_middleware(
     CORSMiddleware,
@@ -64,6 +100,7 @@ app.add_middleware(
 # ✅ Include feature routers
 app.include_router(conversion_router.router)
 app.include_router(analytics_router.router)
+app.include_router(retention_router.router)
 
 
 # ✅ API root endpoint
@@ -78,6 +115,12 @@ def health_check():
     return {"status": "ok"}
 
 
+# ✅ Prometheus scrape endpoint
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
 if FRONTEND_BUILD_DIR.exists():
     app.mount("/", SPAStaticFiles(directory=FRONTEND_BUILD_DIR, html=True), name="frontend")
 else:
@@ -0,0 +1,154 @@
+# app/metrics.py
+"""
+Prometheus metrics for the service, exposed at GET /metrics.
+
+prometheus_client keeps every sample in its own value slot, so recording is a few hundred
+nanoseconds with no shared lock across routes. With several uvicorn workers, point
+PROMETHEUS_MULTIPROC_DIR at an empty directory before starting them (clear it on restart):
+each worker, and every pipeline child process that inherits the variable, writes its own
+mmap file and /metrics aggregates all of them through the multiprocess collector.
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# conversions run from milliseconds (outline on a logo) to minutes (4x CPU upscale)
+LATENCY_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REQUEST_LATENCY = Histogram(
+    "imageuplift_request_duration_seconds",
+    "HTTP request latency by route template.",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+CONVERSIONS_IN_FLIGHT = Gauge(
+    "imageuplift_conversions_in_flight",
+    "Conversions currently running a pipeline.",
+    ["mode"],
+    multiprocess_mode="livesum",
+)
+CONVERSIONS_CANCELLED = Counter(
+    "imageuplift_conversions_cancelled_total",
+    "Conversions cancelled through /conversion/jobs/{id}/cancel.",
+    ["mode"],
+)
+CONVERSIONS_COALESCED = Counter(
+    "imageuplift_conversions_coalesced_total",
+    "Conversions served by an identical conversion already in flight.",
+    ["mode"],
+)
+QUEUE_DEPTH = Gauge(
+    "imageuplift_conversion_queue_depth",
+    "Conversion requests received but not yet running a pipeline.",
+    multiprocess_mode="livesum",
+)
+MODEL_LOAD_SECONDS = Histogram(
+    "imageuplift_model_load_seconds",
+    "Time spent loading model weights.",
+    ["model"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+CACHE_REQUESTS = Counter(
+    "imageuplift_cache_requests_total",
+    "Cache lookups by cache and result (hit | miss); hit ratio = hit / total.",
+    ["cache", "result"],
+)
+SUBPROCESS_SPAWNS = Counter(
+    "imageuplift_subprocess_spawns_total",
+    "External processes started by conversion pipelines.",
+    ["tool"],
+)
+DB_BLOB_BYTES = Counter(
+    "imageuplift_db_blob_bytes_total",
+    "Bytes of blob data written to the database.",
+    ["kind"],
+)
+SVG_BYTES = Counter(
+    "imageuplift_svg_bytes_total",
+    "SVG output bytes by stage (raw | optimized | gzip | br); optimized / raw = minification ratio.",
+    ["stage"],
+)
+RASTER_BYTES = Counter(
+    "imageuplift_raster_bytes_total",
+    "Encoded raster output bytes (enhance) by format (png | webp | avif | jpeg).",
+    ["format"],
+)
+ENCODE_SECONDS = Histogram(
+    "imageuplift_encode_seconds",
+    "Time spent encoding raster outputs, by format.",
+    ["format"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+ADMISSION_BUDGET_USED = Gauge(
+    "imageuplift_admission_budget_used_seconds",
+    "Estimated seconds of admitted /convert and /recommend work in flight (see conversion/admission.py).",
+    multiprocess_mode="livesum",
+)
+ADMISSION_BUDGET_SECONDS = Gauge(
+    "imageuplift_admission_budget_seconds",
+    "Global admission cost budget; used / budget = budget usage.",
+    multiprocess_mode="livesum",
+)
+ADMISSION_REJECTED = Counter(
+    "imageuplift_admission_rejected_total",
+    "Requests answered 429 by admission control, by endpoint and exhausted budget (client | global).",
+    ["endpoint", "reason"],
+)
+RETENTION_RECLAIMED_BYTES = Counter(
+    "imageuplift_retention_reclaimed_bytes_total",
+    "Bytes freed by retention (output | original | conversion blobs, file = pages vacuumed).",
+    ["kind"],
+)
+
+
+class QueueSlot:
+    """
+    One unit of QUEUE_DEPTH, held from the time a conversion request is accepted until its
+    pipeline starts (or the request ends without running one).
+    """
+
+    def __init__(self):
+        self._queued = True
+        QUEUE_DEPTH.inc()
+
+    def release(self):
+        if self._queued:
+            self._queued = False
+            QUEUE_DEPTH.dec()
+
+
+def queue_slot():
+    """FastAPI dependency yielding a QueueSlot that is always released."""
+    slot = QueueSlot()
+    try:
+        yield slot
+    finally:
+        slot.release()
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def render() -> bytes:
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def mark_process_dead(pid: int):
+    """Drop a finished worker's live gauges (no-op outside multiprocess mode)."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
+
@@ -0,0 +1,265 @@
+"""
+Conversion worker: runs the conversions that API nodes with CONVERSION_QUEUE=1 put in the shared
+database (see app/features/conversion/job_store.py).
+
+    cd back-end
+    DATABASE_URL=postgresql://... python -m app.worker --concurrency 2
+    python -m app.worker --modes enhance          # e.g. only on GPU nodes
+
+Each of the --concurrency threads claims a job, runs the same pipeline an inline /convert runs
+(ESRGAN scripts and tracers as child processes), heartbeats its lease while it runs and stores
+the result as a conversions row (output blobs, stages, rollups) together with the job's final
+state. A failed attempt is retried with backoff; a cancel request (POST /conversion/queue/{id}/
+cancel, or /conversion/jobs/{job_id}/cancel) kills the pipeline's child processes at the next
+heartbeat. SIGTERM/SIGINT stop claiming and let running jobs finish; a worker killed outright
+leaves its jobs to be claimed again once their leases expire.
+
+Locally, several workers can share one SQLite file (WAL):
+
+    DATABASE_URL=sqlite:///./queue.db CONVERSION_QUEUE=1 uvicorn app.main:app
+    DATABASE_URL=sqlite:///./queue.db python -m app.worker &
+    DATABASE_URL=sqlite:///./queue.db python -m app.worker &
+"""
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from loguru import logger
+
+from app import metrics
+from app.db import CONVERSION_WORKERS, SessionLocal, migrate, models
+from app.features.analytics import rollup
+from app.features.conversion import job_store, jobs, thumbnails
+from app.features.conversion.pipeline import PIPELINES, execute
+from app.features.helpers.timing import StageTimer
+
+# how often an idle worker also fails jobs abandoned on their final attempt
+_EXPIRE_EVERY_SECONDS = 30.0
+
+
+def _device() -> str:
+    try:
+        import torch  # only here: nodes that only run the fast tier need not have it
+    except ImportError:
+        return "cpu"
+    return "gpu" if torch.cuda.is_available() else "cpu"
+
+
+class Heartbeat(threading.Thread):
+    """Extends the lease of one job while it runs; cancels the local run on lost lease or cancel request."""
+
+    def __init__(self, queued: models.ConversionJob, worker: str, job: jobs.Job):
+        super().__init__(name=f"heartbeat-{queued.id}", daemon=True)
+        self.queued, self.worker, self.job = queued, worker, job
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(job_store.QUEUE_HEARTBEAT_SECONDS):
+            try:
+                held, cancel_requested = job_store.heartbeat(self.queued.id, self.worker, self._progress())
+            except Exception as e:  # DB briefly unavailable: the lease has some slack
+                logger.warning(f"Heartbeat for job {self.queued.id} failed: {e}")
+                continue
+            if not held:
+                logger.warning(f"Lost the lease on job {self.queued.id}; stopping it")
+                self.lost = True
+            if not held or cancel_requested:
+                self.job.cancel()
+                return
+
+    def _progress(self) -> dict:
+        snapshot = self.job.snapshot()
+        progress = snapshot["progress"] or {}
+        return {"stage": snapshot["stage"], "done": progress.get("done"), "total": progress.get("total")}
+
+    def stop(self):
+        """Stop heartbeating and wait for a beat in progress, so it cannot race the final state."""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+def _store(queued: models.ConversionJob, worker: str, duration: float, device: str, timer: StageTimer,
+           params: dict, result=None, error: Optional[str] = None) -> Optional[int]:
+    """Conversion + stage/rollup rows and the job's final state in one transaction; None if the lease was lost."""
+    path, mime, data, encoded, output_stats, ran_tier = result or (None, None, None, {}, None, None)
+    if ran_tier:
+        params = {**params, "upscale_tier": ran_tier}
+    if params.get("output_format") and output_stats:
+        params = {**params, "output_format": output_stats["format"]}  # tiled outputs are always PNG
+    with SessionLocal() as db:
+        try:
+            with timer.stage("db_write"):
+                conv = models.Conversion(
+                    image_id=queued.image_id,
+                    image_name=queued.image_name,
+                    image_type=queued.image_type,
+                    mode=queued.mode,
+                    time_taken=duration,
+                    device=device,
+                    chosen_params=params,
+                    output_mime=mime,
+                    output_size_bytes=len(data) if data else None,
+                    output_blob=data,
+                    output_gzip_blob=encoded.get("gzip"),
+                    output_br_blob=encoded.get("br"),
+                    output_stats=output_stats,
+                    preview=queued.preview,
+                )
+                db.add(conv)
+                db.flush()
+            conversion_id = conv.id
+            stages = timer.as_dict()
+            db.add_all(
+                models.ConversionStage(conversion_id=conversion_id, stage=stage, seconds=seconds)
+                for stage, seconds in stages.items()
+            )
+            rollup.record_conversion(db, conv, stages)
+            status = "done" if data else "failed"
+            if not job_store.finish(db, queued.id, worker, status, conversion_id=conversion_id, error=error):
+                db.rollback()
+                return None
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    metrics.DB_BLOB_BYTES.labels(kind="output").inc(len(data or b"") + sum(map(len, encoded.values())))
+    return conversion_id
+
+
+def _finish_without_output(queued: models.ConversionJob, worker: str, status: str, error: Optional[str] = None):
+    with SessionLocal() as db:
+        job_store.finish(db, queued.id, worker, status, error=error)
+        db.commit()
+
+
+def run_job(queued: models.ConversionJob, worker: str, device: str):
+    """Run one claimed job to its final (or retry) state."""
+    label = f"job {queued.id} ({queued.mode}, attempt {queued.attempts}/{queued.max_attempts})"
+    logger.info(f"▶️  {worker} running {label}")
+    job = jobs.Job(queued.job_id or f"queue-{queued.id}")
+    job.mode = queued.mode
+    timer = StageTimer(listener=job.on_stage)
+    heartbeat = Heartbeat(queued, worker, job)
+    heartbeat.start()
+    start = time.perf_counter()
+    try:
+        with SessionLocal() as db:
+            image = db.get(models.Image, queued.image_id)
+            source = image.original_blob if image is not None else None
+        if not source:
+            raise RuntimeError("Stored image is missing")
+        with jobs.activate(job):
+            result = execute(queued.mode, queued.preview, source, Path(queued.image_name).stem,
+                             dict(queued.params or {}), timer)
+    except jobs.JobCancelled:
+        heartbeat.stop()
+        if not heartbeat.lost:
+            _finish_without_output(queued, worker, "cancelled")
+            metrics.CONVERSIONS_CANCELLED.labels(mode=queued.mode).inc()
+        logger.info(f"⏹️  {label} cancelled" + (" (lease lost)" if heartbeat.lost else ""))
+        return
+    except Exception as e:
+        heartbeat.stop()
+        error = str(e) or type(e).__name__
+        if queued.attempts >= queued.max_attempts:
+            # the last attempt is stored like a failed inline conversion (history, analytics)
+            stored = _store(queued, worker, time.perf_counter() - start, device, timer, dict(queued.params or {}),
+                            error=error)
+            status = "failed" if stored is not None else None
+        else:
+            status = job_store.retry_or_fail(queued.id, worker, queued.attempts, queued.max_attempts, error)
+        logger.error(f"❌ {label} failed ({status or 'lease lost'}): {error}")
+        return
+    heartbeat.stop()
+    conversion_id = _store(queued, worker, time.perf_counter() - start, device, timer, dict(queued.params or {}),
+                           result)
+    if conversion_id is None:
+        logger.warning(f"⚠️  {label} finished after its lease was taken over; result discarded")
+        return
+    logger.info(f"✅ {label} stored as conversion {conversion_id} in {time.perf_counter() - start:.2f}s")
+    if thumbnails.THUMBNAIL_PREWARM and not queued.preview:
+        try:
+            thumbnails.prewarm(conversion_id)
+        except Exception as e:
+            logger.warning(f"Thumbnail prewarm for conversion {conversion_id} failed: {e}")
+
+
+def work(worker: str, modes: Optional[List[str]], poll_interval: float, once: bool, stop: threading.Event,
+         device: str):
+    """One worker thread: claim and run jobs until `stop` (or, with `once`, until the queue is empty)."""
+    last_expire = 0.0
+    while not stop.is_set():
+        if time.monotonic() - last_expire > _EXPIRE_EVERY_SECONDS:
+            last_expire = time.monotonic()
+            try:
+                expired = job_store.expire_abandoned()
+            except Exception as e:  # e.g. "database is locked": try again next round
+                logger.error(f"Expiring abandoned jobs failed: {e}")
+                expired = 0
+            if expired:
+                logger.warning(f"Gave up on {expired} abandoned job(s)")
+        try:
+            queued = job_store.claim(worker, modes)
+        except Exception as e:
+            logger.error(f"Claiming a job failed: {e}")
+            queued = None
+        if queued is None:
+            if once:
+                return
+            stop.wait(poll_interval)
+            continue
+        try:
+            run_job(queued, worker, device)
+        except Exception as e:  # e.g. the database went away while storing; the lease runs out and it is retried
+            logger.exception(f"Job {queued.id} could not be completed: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued conversions from the shared database")
+    parser.add_argument("--concurrency", type=int, default=CONVERSION_WORKERS,
+                        help=f"Jobs run at the same time (default: CONVERSION_WORKERS, {CONVERSION_WORKERS})")
+    parser.add_argument("--worker_id", type=str, default=f"{socket.gethostname()}:{os.getpid()}",
+                        help="Lease holder name (default: host:pid)")
+    parser.add_argument("--modes", type=str, default=None,
+                        help=f"Comma-separated modes to run (default: all of {', '.join(PIPELINES)})")
+    parser.add_argument("--poll_interval", type=float, default=1.0, help="Seconds between claims when idle")
+    parser.add_argument("--once", action="store_true", help="Exit once the queue is empty")
+    args = parser.parse_args()
+
+    migrate.ensure_schema()
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()] if args.modes else None
+    device = _device()
+    stop = threading.Event()
+
+    def request_stop(signum, _frame):
+        logger.info(f"🛑 {signal.Signals(signum).name}: finishing running jobs, not claiming new ones")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    print(f"👷 Worker {args.worker_id} on {device} with {args.concurrency} thread(s)"
+          + (f" for {', '.join(modes)}" if modes else ""))
+    threads = [
+        threading.Thread(target=work, name=f"worker-{i}",
+                         args=(f"{args.worker_id}/{i}", modes, args.poll_interval, args.once, stop, device))
+        for i in range(max(args.concurrency, 1))
+    ]
+    for thread in threads:
+        thread.start()
+    while any(t.is_alive() for t in threads):
+        for thread in threads:
+            thread.join(timeout=0.5)
+    metrics.mark_process_dead(os.getpid())
+    print(f"✅ Worker {args.worker_id} stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Dialect check for the analytics SQL (app/features/analytics/queries.py and rollup.py).
+
+The rollup rebuild and the expression index on recommendations are built from dialect-aware
+helpers, but day-to-day runs only ever execute them on SQLite. This compiles bucket_expr,
+json_text, the rebuild queries and the schema's indexes for SQLite and PostgreSQL (no server
+needed) and checks that each dialect got its own functions, so a PostgreSQL-only breakage shows
+up before a deployment does:
+
+    cd back-end
+    python -m benchmarks.analytics_dialects            # exits 1 on any failure
+    python -m benchmarks.analytics_dialects --show     # also prints the compiled SQL
+"""
+import argparse
+import sys
+from typing import Callable, List, Tuple
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateIndex
+
+from app.db import Base
+from app.db.models import Conversion, Recommendation
+from app.features.analytics import rollup
+from app.features.analytics.queries import bucket_expr, json_text
+
+DIALECTS = {"sqlite": sqlite.dialect(), "postgresql": postgresql.dialect()}
+# fragments the compiled SQL must contain (lower case), per dialect
+EXPECTED = {
+    "sqlite": {"bucket": ["strftime("], "json": ["json_extract("]},
+    "postgresql": {"bucket": ["to_char(", "date_trunc(", "timezone("], "json": ["->>"]},
+}
+
+
+def statements(dialect: str) -> List[Tuple[str, str, Callable]]:
+    """(name, kind, builder) for everything dialect-dependent; kind picks the EXPECTED fragments."""
+    checks = []
+    for granularity in rollup.GRANULARITIES:
+        checks += [
+            (f"bucket_expr[{granularity}]", "bucket", lambda g=granularity: bucket_expr(dialect, Conversion.created_at, g)),
+            (f"rebuild conversions[{granularity}]", "bucket", lambda g=granularity: rollup.conversion_counts(dialect, g)),
+            (f"rebuild image types[{granularity}]", "json", lambda g=granularity: rollup.image_type_counts(dialect, g)),
+        ]
+    checks.append(("json_text", "json", lambda: json_text(Recommendation.metadata_json, "ai_image_type")))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            # only expression indexes depend on the dialect
+            if any(not hasattr(e, "table") for e in index.expressions):
+                checks.append((f"index {index.name}", "json", lambda i=index: CreateIndex(i)))
+    return checks
+
+
+def check(dialect: str, show: bool) -> int:
+    failures = 0
+    for name, kind, build in statements(dialect):
+        try:
+            sql = str(build().compile(dialect=DIALECTS[dialect], compile_kwargs={"literal_binds": True}))
+        except Exception as e:
+            print(f"❌ {dialect:<10} {name}: {type(e).__name__}: {e}")
+            failures += 1
+            continue
+        missing = [f for f in EXPECTED[dialect][kind] if f not in sql.lower()]
+        if missing:
+            print(f"❌ {dialect:<10} {name}: missing {', '.join(missing)}")
+            failures += 1
+        else:
+            print(f"✅ {dialect:<10} {name}")
+        if show:
+            print("   " + " ".join(sql.split()))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the analytics SQL for every supported dialect")
+    parser.add_argument("--dialects", type=str, default=",".join(DIALECTS), help="Comma-separated dialects")
+    parser.add_argument("--show", action="store_true", help="Print the compiled SQL")
+    args = parser.parse_args()
+
+    failures = sum(check(d.strip(), args.show) for d in args.dialects.split(",") if d.strip())
+    if failures:
+        print(f"{failures} statement(s) failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+SQLite write-contention benchmark for the DB layer.
+
+N writer threads each store conversions the way /conversion/convert does (image + conversion
+blobs, stage rows, rollup counters) while R reader threads page through /conversion/list's
+query. Each configuration runs against a fresh database file:
+
+- baseline: rollback journal, synchronous=FULL, SQLAlchemy's default pool (the old setup)
+- wal:      app.db's pragmas (WAL, synchronous=NORMAL, mmap, cache) and pool sizing
+- wal_batch: wal + conversions committed through app.db.writer.BatchWriter
+
+Reports write throughput, per-write commit latency percentiles, lock errors and read
+throughput per configuration:
+
+    cd back-end
+    python -m benchmarks.db_contention --writers 1,4,16 --writes 50 --blob_kb 256
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from sqlalchemy import desc
+from sqlalchemy.orm import sessionmaker
+
+from app.db import Base, make_engine, sqlite_pragmas
+from app.db import models
+from app.db.writer import BatchWriter
+from app.features.analytics import rollup
+from benchmarks.pipelines import percentile
+
+CONFIGS = ["baseline", "wal", "wal_batch"]
+STAGES = {"upload": 0.01, "esrgan": 1.2, "trace": 0.4, "read_output": 0.002, "db_write": 0.05}
+
+
+def _engine_for(config: str, url: str):
+    if config == "baseline":
+        return make_engine(
+            url,
+            pragmas=["PRAGMA journal_mode=DELETE", "PRAGMA synchronous=FULL", "PRAGMA busy_timeout=5000"],
+            pool_size=5,
+            max_overflow=10,
+        )
+    return make_engine(url, pragmas=sqlite_pragmas())
+
+
+def _save(session, blob: bytes, mode: str) -> int:
+    image = models.Image(original_filename="bench.png", size_bytes=len(blob), original_blob=blob)
+    session.add(image)
+    session.flush()
+    conv = models.Conversion(
+        image_id=image.id,
+        image_name="bench.png",
+        image_type="image/png",
+        mode=mode,
+        time_taken=sum(STAGES.values()),
+        device="cpu",
+        chosen_params={"outputType": mode},
+        output_mime="image/svg+xml",
+        output_size_bytes=len(blob),
+        output_blob=blob,
+        output_thumb_blob=blob[: len(blob) // 8],
+    )
+    session.add(conv)
+    session.flush()
+    session.add_all(models.ConversionStage(conversion_id=conv.id, stage=s, seconds=v) for s, v in STAGES.items())
+    rollup.record_conversion(session, conv, STAGES)
+    return conv.id
+
+
+def run_config(config: str, writers: int, writes: int, readers: int, blob_kb: int) -> dict:
+    work_dir = Path(tempfile.mkdtemp(prefix="dbbench-"))
+    engine = _engine_for(config, f"sqlite:///{work_dir / 'bench.db'}")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    batch_writer = BatchWriter(session_factory=Session) if config == "wal_batch" else None
+
+    latencies: List[float] = []
+    errors: List[str] = []
+    reads = [0]
+    lock = threading.Lock()
+    stop_reading = threading.Event()
+
+    def writer_thread(index: int):
+        blob = os.urandom(blob_kb * 1024)
+        mode = ("outline", "vectorize", "enhance")[index % 3]
+        for _ in range(writes):
+            start = time.perf_counter()
+            try:
+                if batch_writer:
+                    batch_writer.submit(lambda s: _save(s, blob, mode)).result()
+                else:
+                    session = Session()
+                    try:
+                        _save(session, blob, mode)
+                        session.commit()
+                    except Exception:
+                        session.rollback()
+                        raise
+                    finally:
+                        session.close()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+            except Exception as e:
+                with lock:
+                    errors.append(type(e).__name__ + ": " + str(e).splitlines()[0])
+
+    def reader_thread():
+        while not stop_reading.is_set():
+            session = Session()
+            try:
+                session.query(models.Conversion.id, models.Conversion.mode, models.Conversion.created_at) \
+                    .order_by(desc(models.Conversion.created_at)).limit(8).all()
+                with lock:
+                    reads[0] += 1
+            except Exception as e:
+                with lock:
+                    errors.append("read " + type(e).__name__)
+            finally:
+                session.close()
+
+    read_threads = [threading.Thread(target=reader_thread) for _ in range(readers)]
+    write_threads = [threading.Thread(target=writer_thread, args=(i,)) for i in range(writers)]
+    start = time.perf_counter()
+    for t in read_threads + write_threads:
+        t.start()
+    for t in write_threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    stop_reading.set()
+    for t in read_threads:
+        t.join()
+    if batch_writer:
+        batch_writer.close()
+    engine.dispose()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    latencies.sort()
+    return {
+        "config": config,
+        "writers": writers,
+        "writes": len(latencies),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:3],
+        "writes_per_s": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_s": _round(percentile(latencies, 0.5)),
+        "p99_s": _round(percentile(latencies, 0.99)),
+        "reads_per_s": round(reads[0] / elapsed, 1) if elapsed else None,
+    }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 4) if value is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SQLite write contention across DB configurations")
+    parser.add_argument("--configs", default=",".join(CONFIGS), help=f"Comma-separated subset of {CONFIGS}")
+    parser.add_argument("--writers", default="1,4,16", help="Comma-separated concurrent writer counts")
+    parser.add_argument("--writes", type=int, default=50, help="Conversions stored per writer")
+    parser.add_argument("--readers", type=int, default=2, help="Concurrent list-query readers")
+    parser.add_argument("--blob_kb", type=int, default=256, help="Size of each original/output blob")
+    parser.add_argument("--out", default=None, help="Write JSON results here")
+    args = parser.parse_args()
+
+    results = []
+    for writers in [int(w) for w in args.writers.split(",") if w]:
+        for config in [c for c in args.configs.split(",") if c]:
+            print(f"⏱️  {config} with {writers} writers ...", flush=True)
+            results.append(run_config(config, writers, args.writes, args.readers, args.blob_kb))
+
+    header = f"{'config':<10} {'writers':>7} {'writes':>7} {'err':>5} {'w/s':>8} {'p50':>8} {'p99':>8} {'reads/s':>9}"
+    print("\n" + header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['config']:<10} {r['writers']:>7} {r['writes']:>7} {r['errors']:>5} {r['writes_per_s']:>8} "
+            f"{r['p50_s'] or '-':>8} {r['p99_s'] or '-':>8} {r['reads_per_s']:>9}"
+        )
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent=2))
+        print(f"\n✅ Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
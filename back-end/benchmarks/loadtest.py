@@ -0,0 +1,361 @@
+"""
+Open-loop load generator for the API.
+
+Drives a weighted mix of /conversion/recommend, /conversion/convert (per mode), /conversion/list
+and /conversion/thumb traffic at a series of target request rates (Poisson arrivals), and reports
+achieved throughput, error rate and latency percentiles per step and per endpoint. The highest
+step that keeps up with its offered rate within the error/latency SLO is reported as saturation.
+
+Targets:
+- in-process (default): the ASGI app through httpx, temporary SQLite DB
+- --url http://localhost:5001: an already running server
+- --spawn: starts `uvicorn --workers N` on localhost for the run (compare worker counts,
+  pool sizes via --env KEY=VALUE, or DB backends via --database_url)
+
+The app's admission control (app/features/conversion/admission.py) sees every request from one
+client address, so the in-process and --spawn targets run with ADMISSION_ENABLED=0 unless
+--env ADMISSION_ENABLED=1 is given. 429s are counted as errors and also reported as `rejected`.
+
+Stub pipelines are used automatically when the ESRGAN/CLIP weights or tracer binaries are
+missing (force with --stub / --no_stub). Examples:
+
+    cd back-end
+    python -m benchmarks.loadtest --rates 1,2,4,8 --duration 30
+    python -m benchmarks.loadtest --spawn --workers 4 --rates 2,4,8,16 --out load-w4.json
+    python -m benchmarks.loadtest --mix "convert:outline=3,list=2,thumb=5" --rates 5,10,20
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import cv2
+import httpx
+
+from benchmarks import stubs
+from benchmarks.pipelines import BACKEND_ROOT, SAMPLE_EXTS, SAMPLES_DIR, percentile, synthetic_image
+
+DEFAULT_MIX = "recommend=1,convert:outline=2,convert:vectorize=2,convert:enhance=1,list=2,thumb=4"
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    for name in mix:
+        if name not in {"recommend", "list", "thumb"} and not name.startswith("convert:"):
+            raise ValueError(f"unknown traffic class: {name}")
+    return mix
+
+
+def load_images(size: int, use_samples: bool) -> List[tuple]:
+    images = []
+    if use_samples:
+        for path in sorted(SAMPLES_DIR.iterdir()):
+            if path.suffix.lower() in SAMPLE_EXTS:
+                images.append((path.name, path.read_bytes()))
+    if size:
+        ok, buf = cv2.imencode(".png", synthetic_image(size, int(size * 0.75), seed=size))
+        images.append((f"synthetic_{size}.png", buf.tobytes()))
+    return images
+
+
+class LoadRun:
+    def __init__(self, client: httpx.AsyncClient, mix: Dict[str, float], images: List[tuple], timeout: float):
+        self.client = client
+        self.classes = list(mix)
+        self.weights = [mix[c] for c in self.classes]
+        self.images = images
+        self.timeout = timeout
+        self.conversion_ids: List[int] = []
+        self.samples: List[dict] = []
+
+    async def seed_ids(self):
+        try:
+            resp = await self.client.get("/conversion/list", params={"page_size": 50}, timeout=self.timeout)
+            self.conversion_ids = [item["id"] for item in resp.json().get("items", []) if item.get("has_thumb")]
+        except Exception:
+            self.conversion_ids = []
+
+    async def request(self, kind: str):
+        name, data = random.choice(self.images)
+        start = time.perf_counter()
+        status, error = None, None
+        try:
+            if kind == "recommend":
+                resp = await self.client.post(
+                    "/conversion/recommend", files={"file": (name, io.BytesIO(data))}, timeout=self.timeout
+                )
+            elif kind.startswith("convert:"):
+                resp = await self.client.post(
+                    "/conversion/convert",
+                    files={"file": (name, io.BytesIO(data))},
+                    data={"outputType": kind.split(":", 1)[1]},
+                    timeout=self.timeout,
+                )
+                conv_id = resp.headers.get("x-conversion-id")
+                if conv_id:
+                    self.conversion_ids.append(int(conv_id))
+            elif kind == "list":
+                resp = await self.client.get("/conversion/list", params={"page": random.randint(1, 3)}, timeout=self.timeout)
+            else:  # thumb
+                if not self.conversion_ids:
+                    return  # nothing converted yet; not counted
+                conv_id = random.choice(self.conversion_ids[-200:])
+                resp = await self.client.get(f"/conversion/thumb/{conv_id}", timeout=self.timeout)
+            status = resp.status_code
+        except Exception as e:
+            error = type(e).__name__
+        self.samples.append(
+            {
+                "kind": kind,
+                "start": start,
+                "latency": time.perf_counter() - start,
+                "status": status,
+                "ok": error is None and status is not None and status < 400,
+                "error": error,
+            }
+        )
+
+    async def step(self, rate: float, duration: float, max_in_flight: int) -> dict:
+        """Offer `rate` req/s for `duration` seconds (Poisson arrivals), then wait for stragglers."""
+        self.samples = []
+        tasks = set()
+        gate = asyncio.Semaphore(max_in_flight)
+        dropped = 0
+        step_start = time.perf_counter()
+        next_at = step_start
+        while True:
+            next_at += random.expovariate(rate)
+            if next_at - step_start > duration:
+                break
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            if gate.locked():
+                dropped += 1  # client-side cap reached: the server is not keeping up
+                continue
+            kind = random.choices(self.classes, self.weights)[0]
+
+            async def guarded(k=kind):
+                async with gate:
+                    await self.request(k)
+
+            task = asyncio.create_task(guarded())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.sleep(max(0.0, step_start + duration - time.perf_counter()))
+        if tasks:
+            await asyncio.wait(tasks)
+        elapsed = time.perf_counter() - step_start
+        return summarize(self.samples, rate, duration, elapsed, dropped)
+
+
+def _latency_stats(latencies: List[float]) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "p50_s": _round(percentile(latencies, 0.5)),
+        "p90_s": _round(percentile(latencies, 0.9)),
+        "p99_s": _round(percentile(latencies, 0.99)),
+        "max_s": _round(latencies[-1] if latencies else None),
+    }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 4) if value is not None else None
+
+
+def summarize(samples: List[dict], rate: float, duration: float, elapsed: float, dropped: int) -> dict:
+    total = len(samples) + dropped
+    ok = [s for s in samples if s["ok"]]
+    by_kind = {}
+    for kind in sorted({s["kind"] for s in samples}):
+        ks = [s for s in samples if s["kind"] == kind]
+        by_kind[kind] = {
+            "requests": len(ks),
+            "errors": sum(1 for s in ks if not s["ok"]),
+            "rejected": sum(1 for s in ks if s["status"] == 429),
+            **_latency_stats([s["latency"] for s in ks if s["ok"]]),
+        }
+    return {
+        "offered_rps": rate,
+        "duration_s": duration,
+        "elapsed_s": round(elapsed, 3),
+        "requests": total,
+        # Poisson arrivals scatter around the target; saturation compares against what was actually sent
+        "arrival_rps": round(total / duration, 3) if duration else 0.0,
+        "dropped": dropped,
+        "errors": total - len(ok),
+        "error_rate": round((total - len(ok)) / total, 4) if total else 0.0,
+        # admission 429s (included in errors): shed load rather than failures
+        "rejected": sum(1 for s in samples if s["status"] == 429),
+        # completions over the offered window plus drain time: falls below offered when saturated
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        **_latency_stats([s["latency"] for s in ok]),
+        "endpoints": by_kind,
+    }
+
+
+def saturation(steps: List[dict], max_error_rate: float, slo_p99: Optional[float]) -> Optional[dict]:
+    """Highest step that kept up (>= 90% of the arrival rate) within the error and p99 SLO."""
+    best = None
+    for s in steps:
+        keeps_up = s["throughput_rps"] >= 0.9 * s["arrival_rps"]
+        within_slo = s["error_rate"] <= max_error_rate and (slo_p99 is None or (s["p99_s"] or 0) <= slo_p99)
+        if keeps_up and within_slo:
+            best = s
+    if best is None:
+        return None
+    return {"offered_rps": best["offered_rps"], "throughput_rps": best["throughput_rps"], "p99_s": best["p99_s"]}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def target(args, use_stubs: bool):
+    """Yield an httpx client pointed at the app under test."""
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url) as client:
+            yield client
+        return
+
+    work_dir = Path(tempfile.mkdtemp(prefix="loadtest-"))
+    database_url = args.database_url or f"sqlite:///{work_dir / 'loadtest.db'}"
+
+    if args.spawn:
+        port = _free_port()
+        env = {**os.environ, "DATABASE_URL": database_url, "ADMISSION_ENABLED": "0"}
+        env.update(dict(kv.split("=", 1) for kv in args.env))
+        app_path = "benchmarks.stub_app:app" if use_stubs else "app.main:app"
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", app_path, "--port", str(port), "--workers", str(args.workers),
+             "--log-level", "warning"],
+            cwd=BACKEND_ROOT,
+            env=env,
+        )
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            async with httpx.AsyncClient(base_url=base_url) as client:
+                for _ in range(120):
+                    try:
+                        if (await client.get("/health")).status_code == 200:
+                            break
+                    except httpx.TransportError:
+                        pass
+                    await asyncio.sleep(0.5)
+                else:
+                    raise RuntimeError("uvicorn did not become healthy")
+                yield client
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+        return
+
+    # in-process ASGI app: note the app shares this event loop with the load generator
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["ADMISSION_ENABLED"] = "0"
+    for kv in args.env:
+        key, value = kv.split("=", 1)
+        os.environ[key] = value
+    from app.main import app
+
+    if use_stubs:
+        stubs.install()
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+            yield client
+
+
+async def run(args) -> dict:
+    use_stubs = args.stub if args.stub is not None else not stubs.models_present()
+    mix = parse_mix(args.mix)
+    images = load_images(args.image_size, not args.no_samples)
+    rates = [float(r) for r in args.rates.split(",") if r]
+    print(f"🎯 mix={mix} rates={rates} duration={args.duration}s stubs={'on' if use_stubs else 'off'}")
+
+    steps = []
+    async with target(args, use_stubs) as client:
+        runner = LoadRun(client, mix, images, args.timeout)
+        await runner.seed_ids()
+        for rate in rates:
+            print(f"⏱️  {rate} req/s for {args.duration}s ...", flush=True)
+            result = await runner.step(rate, args.duration, args.max_in_flight)
+            steps.append(result)
+            print(
+                f"   throughput={result['throughput_rps']} req/s errors={result['error_rate']:.1%} "
+                f"rejected={result['rejected']} "
+                f"p50={result['p50_s']} p90={result['p90_s']} p99={result['p99_s']} dropped={result['dropped']}"
+            )
+
+    return {
+        "config": {
+            "mix": mix,
+            "rates": rates,
+            "duration_s": args.duration,
+            "target": args.url or ("uvicorn" if args.spawn else "in-process"),
+            "workers": args.workers if args.spawn else None,
+            "database_url": args.database_url,
+            "env": args.env,
+            "stubs": use_stubs,
+        },
+        "saturation": saturation(steps, args.max_error_rate, args.slo_p99),
+        "steps": steps,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the ImageUpLift API with a mixed workload")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="Weighted traffic classes: recommend, convert:<mode>, list, thumb")
+    parser.add_argument("--rates", default="1,2,4,8", help="Comma-separated offered request rates (req/s)")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per rate step")
+    parser.add_argument("--max_in_flight", type=int, default=256, help="Client-side concurrency cap")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout (s)")
+    parser.add_argument("--image_size", type=int, default=512, help="Synthetic upload width (0 to disable)")
+    parser.add_argument("--no_samples", action="store_true", help="Do not upload the bundled samples/")
+    parser.add_argument("--url", default=None, help="Test an already running server instead")
+    parser.add_argument("--spawn", action="store_true", help="Start uvicorn on localhost for the run")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers with --spawn")
+    parser.add_argument("--database_url", default=None, help="DATABASE_URL for the app (default: temp SQLite)")
+    parser.add_argument("--env", action="append", default=[], help="Extra KEY=VALUE for the app (repeatable)")
+    stub_group = parser.add_mutually_exclusive_group()
+    stub_group.add_argument("--stub", dest="stub", action="store_true", default=None, help="Force stub pipelines")
+    stub_group.add_argument("--no_stub", dest="stub", action="store_false", help="Force real pipelines")
+    parser.add_argument("--max_error_rate", type=float, default=0.01, help="Error budget for saturation")
+    parser.add_argument("--slo_p99", type=float, default=None, help="p99 latency SLO (s) for saturation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="Write JSON results here")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    os.chdir(BACKEND_ROOT)
+    report = asyncio.run(run(args))
+
+    sat = report["saturation"]
+    if sat:
+        print(f"\n✅ Saturation: ~{sat['throughput_rps']} req/s (offered {sat['offered_rps']}, p99 {sat['p99_s']}s)")
+    else:
+        print("\n⚠️  No step stayed within the SLO; try lower --rates.")
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2))
+        print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
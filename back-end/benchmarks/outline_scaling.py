@@ -0,0 +1,117 @@
+"""
+Core scaling of the tiled outline trace (app/features/conversion/tiled_outline.py).
+
+Builds one synthetic image of --megapixels (20+ MP by default), runs Canny and writes the edge
+PBM once, then traces that PBM
+
+- single:  one potrace process over the whole bitmap (what outline.py does below the threshold)
+- tiled:   tiled_outline.trace with 1, 2, 4, ... worker threads (one potrace process each)
+
+and reports wall time, speed-up and parallel efficiency against the single trace, plus the tile
+count and merged SVG size. Needs potrace on PATH:
+
+    cd back-end
+    python -m benchmarks.outline_scaling --megapixels 24 --workers 1,2,4,8 --out outline_scaling.json
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+
+from app.features.conversion import outline, tiled_outline
+from benchmarks.pipelines import environment_info, synthetic_image
+
+
+def prepare(megapixels: float, work_dir: Path) -> Path:
+    """Edge PBM of a synthetic image of about `megapixels` at 3:2."""
+    height = int(math.sqrt(megapixels * 1e6 / 1.5))
+    width = int(height * 1.5)
+    image_path = work_dir / "input.png"
+    # shapes drawn at a quarter of the size and scaled up keep the image traceable at 20+ MP
+    small = synthetic_image(width // 4, height // 4)
+    cv2.imwrite(str(image_path), cv2.resize(small, (width, height), interpolation=cv2.INTER_NEAREST))
+    pbm_path = work_dir / "edges.pbm"
+    outline.save_as_pbm(outline.detect_edges(str(image_path)), str(pbm_path))
+    return pbm_path
+
+
+def run_single(pbm_path: Path, work_dir: Path) -> dict:
+    svg_path = work_dir / "single.svg"
+    start = time.perf_counter()
+    outline.potrace_to_svg(str(pbm_path), str(svg_path))
+    return {"run": "single", "workers": 1, "tiles": 1, "seconds": round(time.perf_counter() - start, 3),
+            "svg_bytes": svg_path.stat().st_size}
+
+
+def run_tiled(pbm_path: Path, work_dir: Path, workers: int, tile: int, margin: int) -> dict:
+    svg_path = work_dir / f"tiled_{workers}.svg"
+    previous = tiled_outline.TRACE_EXECUTOR
+    tiled_outline.TRACE_EXECUTOR = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="trace")
+    try:
+        start = time.perf_counter()
+        tiles = tiled_outline.trace(str(pbm_path), str(svg_path), outline.potrace_to_svg, tile=tile, margin=margin)
+        seconds = time.perf_counter() - start
+    finally:
+        tiled_outline.TRACE_EXECUTOR.shutdown()
+        tiled_outline.TRACE_EXECUTOR = previous
+    return {"run": "tiled", "workers": workers, "tiles": tiles, "seconds": round(seconds, 3),
+            "svg_bytes": svg_path.stat().st_size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tiled potrace scaling across worker counts")
+    parser.add_argument("--megapixels", type=float, default=24, help="Size of the synthetic input")
+    parser.add_argument("--workers", default="1,2,4,8", help="Comma-separated trace worker counts")
+    parser.add_argument("--tile", type=int, default=tiled_outline.OUTLINE_TILE, help="Tile side in pixels")
+    parser.add_argument("--margin", type=int, default=tiled_outline.OUTLINE_TILE_MARGIN, help="Tile margin in pixels")
+    parser.add_argument("--out", default=None, help="Write JSON results here")
+    args = parser.parse_args()
+
+    if shutil.which("potrace") is None:
+        print("❌ potrace not found on PATH")
+        return
+
+    work_dir = Path(tempfile.mkdtemp(prefix="outline-scaling-"))
+    try:
+        print(f"🖼️  Preparing a {args.megapixels:g} MP edge map ...", flush=True)
+        pbm_path = prepare(args.megapixels, work_dir)
+        width, height, _ = tiled_outline.pbm_header(pbm_path)
+
+        print("⏱️  single potrace ...", flush=True)
+        results = [run_single(pbm_path, work_dir)]
+        for workers in [int(w) for w in args.workers.split(",") if w]:
+            print(f"⏱️  tiled with {workers} workers ...", flush=True)
+            results.append(run_tiled(pbm_path, work_dir, workers, args.tile, args.margin))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = results[0]["seconds"]
+    for r in results:
+        r["speedup"] = round(baseline / r["seconds"], 2) if r["seconds"] else None
+        r["efficiency"] = round(r["speedup"] / r["workers"], 2) if r["speedup"] else None
+
+    header = f"{'run':<7} {'workers':>7} {'tiles':>6} {'seconds':>8} {'speedup':>8} {'eff':>6} {'svg KB':>8}"
+    print(f"\n{width}x{height} px, tile {args.tile}, margin {args.margin}, {os.cpu_count()} CPUs")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['run']:<7} {r['workers']:>7} {r['tiles']:>6} {r['seconds']:>8} {r['speedup'] or '-':>8} "
+            f"{r['efficiency'] or '-':>6} {r['svg_bytes'] / 1024:>8.0f}"
+        )
+    if args.out:
+        report = {"environment": environment_info(), "width": width, "height": height, "tile": args.tile,
+                  "margin": args.margin, "results": results}
+        Path(args.out).write_text(json.dumps(report, indent=2))
+        print(f"\n✅ Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+End-to-end benchmark for the conversion pipelines.
+
+Runs outline, vectorize (upscale gate forced off and forced on with --upscale_policy never /
+always), enhance (Real-ESRGAN x4plus and the interpolation tier) and recommend over the
+bundled samples/ images plus synthetic images at several resolutions, and reports throughput,
+latency percentiles, peak RSS and output size per mode. Two transports are measured:
+
+- inprocess: calls the pipeline code directly (outline/vectorization/enhance/recommend_settings)
+- http:      posts to the FastAPI app through TestClient (temporary SQLite DB), i.e. what a client sees
+
+Every (transport, mode) pair runs in a fresh process so peak RSS is attributable to that mode.
+Results are written as JSON and can be diffed between commits:
+
+    cd back-end
+    python -m benchmarks.pipelines --out bench-before.json
+    python -m benchmarks.pipelines --out bench-after.json --compare bench-before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import cv2
+import numpy as np
+
+BACKEND_ROOT = Path(__file__).resolve().parents[1]
+SAMPLES_DIR = BACKEND_ROOT / "samples"
+SAMPLE_EXTS = {".png", ".webp", ".jpg", ".jpeg"}
+
+MODES = ["outline", "vectorize", "vectorize_upscale", "enhance", "enhance_fast", "recommend"]
+TRANSPORTS = ["inprocess", "http"]
+DEFAULT_RESOLUTIONS = [256, 512, 1024, 2048]
+COMPARE_METRICS = ["throughput_ips", "p50_s", "p90_s", "p99_s", "peak_rss_mb", "mean_output_bytes"]
+
+
+# -----------------------
+# Inputs
+# -----------------------
+
+def synthetic_image(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Flat-colour shapes over a gradient with light noise: traceable, but not trivially so."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = np.stack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                    np.full((height, width), 128, np.float32)], axis=-1).astype(np.uint8).copy()
+    for _ in range(24):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+        r = int(rng.integers(max(width, height) // 40 + 1, max(width, height) // 6 + 2))
+        if rng.random() < 0.5:
+            cv2.circle(img, (cx, cy), r, color, -1)
+        else:
+            cv2.rectangle(img, (cx - r, cy - r // 2), (cx + r, cy + r // 2), color, -1)
+    noise = rng.normal(0, 4, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+def collect_inputs(resolutions: List[int], work_dir: Path, use_samples: bool = True) -> List[dict]:
+    inputs = []
+    if use_samples:
+        for path in sorted(SAMPLES_DIR.iterdir()):
+            if path.suffix.lower() in SAMPLE_EXTS:
+                inputs.append({"name": f"sample/{path.name}", "path": str(path)})
+    for size in resolutions:
+        path = work_dir / f"synthetic_{size}.png"
+        cv2.imwrite(str(path), synthetic_image(size, int(size * 0.75), seed=size))
+        inputs.append({"name": f"synthetic/{size}x{int(size * 0.75)}", "path": str(path)})
+    return inputs
+
+
+# -----------------------
+# Runners: fn(image_path, out_dir) -> output size in bytes
+# -----------------------
+
+def _newest(out_dir: str, suffix: str) -> Path:
+    files = [f for f in Path(out_dir).iterdir() if f.suffix.lower() == suffix]
+    if not files:
+        raise RuntimeError(f"no {suffix} output produced")
+    return max(files, key=lambda f: f.stat().st_mtime)
+
+
+def inprocess_runner(mode: str) -> Callable[[str, str], Optional[int]]:
+    if mode == "outline":
+        from app.features.conversion.outline import process_image
+
+        def run(path, out_dir):
+            process_image(path, out_dir, 100, 200)
+            return _newest(out_dir, ".svg").stat().st_size
+
+    elif mode in ("vectorize", "vectorize_upscale"):
+        import torch
+        from app.features.conversion import upscalers, vectorization
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        # force the branch: the gated policy would skip ESRGAN for flat or large inputs
+        policy = "always" if mode == "vectorize_upscale" else "never"
+
+        def run(path, out_dir):
+            args = vectorization.build_parser().parse_args(
+                ["--input", path, "--output", out_dir, "--upscale_policy", policy]
+            )
+            model_path = args.model_path or upscalers.WEIGHTS[args.upscale_tier]
+            if mode == "vectorize_upscale" and not os.path.isfile(model_path):
+                raise FileNotFoundError(f"ESRGAN model not found: {model_path}")
+            vectorization.process_image(path, args, device)
+            return _newest(out_dir, ".svg").stat().st_size
+
+    elif mode in ("enhance", "enhance_fast"):
+        from app.features.conversion import enhance, upscalers
+
+        tier = "fast" if mode == "enhance_fast" else upscalers.DEFAULT_TIER["enhance"]
+        if not upscalers.available(tier):
+            raise FileNotFoundError(f"ESRGAN model not found: {upscalers.WEIGHTS[tier]}")
+
+        def run(path, out_dir):
+            args = enhance.build_parser().parse_args(["--input", path, "--output", out_dir, "--tier", tier])
+            out_path = enhance.upscale(args)
+            if not out_path:
+                raise RuntimeError("enhance produced no output")
+            return os.path.getsize(out_path)
+
+    elif mode == "recommend":
+        from app.features.helpers.recommend_settings import extract_image_metadata, recommend_conversion
+
+        def run(path, out_dir):
+            recommend_conversion(extract_image_metadata(path))
+            return None
+
+    else:
+        raise ValueError(f"unknown mode: {mode}")
+    return run
+
+
+def http_runner(mode: str, work_dir: Path) -> Callable[[str, str], Optional[int]]:
+    if mode == "vectorize_upscale":
+        raise RuntimeError("the upscale gate is not exposed over HTTP; use the inprocess transport")
+    os.environ["DATABASE_URL"] = f"sqlite:///{work_dir / 'bench.db'}"
+    # every TestClient request comes from the same address; the per-client buckets would 429 the run
+    os.environ["ADMISSION_ENABLED"] = "0"
+
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    client = TestClient(app)
+    client.__enter__()  # run startup (table creation); the worker process exits afterwards
+
+    def run(path, out_dir):
+        files = {"file": (Path(path).name, Path(path).read_bytes(), "application/octet-stream")}
+        if mode == "recommend":
+            resp = client.post("/conversion/recommend", files=files)
+        elif mode == "enhance_fast":
+            # no budget is small enough for an ESRGAN tier, so the router picks the fast one
+            resp = client.post("/conversion/convert", files=files, data={"outputType": "enhance", "latency_budget": "0"})
+        else:
+            resp = client.post("/conversion/convert", files=files, data={"outputType": mode})
+        if resp.status_code != 200:
+            raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+        return None if mode == "recommend" else len(resp.content)
+
+    return run
+
+
+# -----------------------
+# Measurement
+# -----------------------
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    pos = q * (len(sorted_values) - 1)
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def _peak_rss_mb(who) -> float:
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)
+
+
+def run_mode(transport: str, mode: str, inputs: List[dict], repeat: int, warmup: int) -> dict:
+    """Benchmark one (transport, mode) pair. Runs inside a fresh worker process."""
+    os.chdir(BACKEND_ROOT)
+    work_dir = Path(tempfile.mkdtemp(prefix=f"bench-{transport}-{mode}-"))
+    try:
+        try:
+            runner = inprocess_runner(mode) if transport == "inprocess" else http_runner(mode, work_dir)
+        except Exception as e:
+            return {"skipped": f"{type(e).__name__}: {e}"}
+
+        for item in inputs[:warmup]:
+            try:
+                runner(item["path"], tempfile.mkdtemp(dir=work_dir))
+            except Exception:
+                pass
+
+        latencies, sizes, errors, per_input = [], [], [], {}
+        wall_start = time.perf_counter()
+        for _ in range(repeat):
+            for item in inputs:
+                out_dir = tempfile.mkdtemp(dir=work_dir)
+                start = time.perf_counter()
+                try:
+                    size = runner(item["path"], out_dir)
+                except Exception as e:
+                    errors.append(f"{item['name']}: {type(e).__name__}: {e}"[:300])
+                    continue
+                finally:
+                    shutil.rmtree(out_dir, ignore_errors=True)
+                elapsed = time.perf_counter() - start
+                latencies.append(elapsed)
+                per_input.setdefault(item["name"], []).append(round(elapsed, 4))
+                if size is not None:
+                    sizes.append(size)
+        wall = time.perf_counter() - wall_start
+
+        latencies.sort()
+        return {
+            "runs": len(latencies),
+            "errors": len(errors),
+            "error_samples": errors[:5],
+            "wall_s": round(wall, 3),
+            "throughput_ips": round(len(latencies) / wall, 4) if wall > 0 else None,
+            "mean_s": round(sum(latencies) / len(latencies), 4) if latencies else None,
+            "p50_s": _round(percentile(latencies, 0.5)),
+            "p90_s": _round(percentile(latencies, 0.9)),
+            "p99_s": _round(percentile(latencies, 0.99)),
+            "max_s": _round(latencies[-1] if latencies else None),
+            "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+            "peak_child_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "mean_output_bytes": round(sum(sizes) / len(sizes)) if sizes else None,
+            "total_output_bytes": sum(sizes) if sizes else None,
+            "per_input_s": per_input,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 4) if value is not None else None
+
+
+def run_isolated(transport: str, mode: str, inputs: List[dict], repeat: int, warmup: int) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(run_mode, transport, mode, inputs, repeat, warmup).result()
+
+
+def environment_info() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = None
+    try:
+        import torch
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    except ImportError:
+        device = None
+    return {
+        "git_commit": commit,
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "device": device,
+    }
+
+
+# -----------------------
+# Reporting
+# -----------------------
+
+def print_report(results: dict):
+    header = f"{'transport':<10} {'mode':<18} {'runs':>5} {'err':>4} {'ips':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'rss MB':>8} {'out KB':>9}"
+    print(header)
+    print("-" * len(header))
+    for transport, modes in results.items():
+        for mode, r in modes.items():
+            if "skipped" in r:
+                print(f"{transport:<10} {mode:<18} skipped: {r['skipped']}")
+                continue
+            out_kb = f"{r['mean_output_bytes'] / 1024:.1f}" if r["mean_output_bytes"] else "-"
+            print(
+                f"{transport:<10} {mode:<18} {r['runs']:>5} {r['errors']:>4} {_fmt(r['throughput_ips'])} "
+                f"{_fmt(r['p50_s'])} {_fmt(r['p90_s'])} {_fmt(r['p99_s'])} {r['peak_rss_mb']:>8} {out_kb:>9}"
+            )
+
+
+def _fmt(value: Optional[float]) -> str:
+    return f"{value:>8.3f}" if value is not None else f"{'-':>8}"
+
+
+def compare(base: dict, current: dict):
+    """Print per-metric deltas for every (transport, mode) present in both result files."""
+    print(f"\nComparison vs {base['meta'].get('git_commit')} ({base['meta'].get('timestamp')})")
+    for transport, modes in current["results"].items():
+        for mode, new in modes.items():
+            old = base["results"].get(transport, {}).get(mode)
+            if not old or "skipped" in old or "skipped" in new:
+                continue
+            parts = []
+            for metric in COMPARE_METRICS:
+                a, b = old.get(metric), new.get(metric)
+                if a is None or b is None:
+                    continue
+                delta = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+                parts.append(f"{metric}={a}→{b} ({delta})")
+            print(f"  {transport}/{mode}: " + ", ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ImageUpLift conversion pipelines")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"Comma-separated subset of {MODES}")
+    parser.add_argument("--transports", default=",".join(TRANSPORTS), help=f"Comma-separated subset of {TRANSPORTS}")
+    parser.add_argument("--resolutions", default=",".join(map(str, DEFAULT_RESOLUTIONS)),
+                        help="Synthetic image widths (height = 0.75 * width); empty for none")
+    parser.add_argument("--no_samples", action="store_true", help="Skip the bundled samples/ images")
+    parser.add_argument("--repeat", type=int, default=1, help="Passes over the input set per mode")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed warm-up runs per mode")
+    parser.add_argument("--out", default=None, help="Write JSON results here")
+    parser.add_argument("--compare", default=None, help="Baseline JSON results to diff against")
+    args = parser.parse_args()
+
+    modes = [m for m in args.modes.split(",") if m]
+    transports = [t for t in args.transports.split(",") if t]
+    resolutions = [int(r) for r in args.resolutions.split(",") if r]
+
+    input_dir = Path(tempfile.mkdtemp(prefix="bench-inputs-"))
+    try:
+        inputs = collect_inputs(resolutions, input_dir, use_samples=not args.no_samples)
+        print(f"📦 {len(inputs)} inputs, modes={modes}, transports={transports}")
+
+        results = {}
+        for transport in transports:
+            for mode in modes:
+                print(f"⏱️  {transport}/{mode} ...", flush=True)
+                results.setdefault(transport, {})[mode] = run_isolated(transport, mode, inputs, args.repeat, args.warmup)
+    finally:
+        shutil.rmtree(input_dir, ignore_errors=True)
+
+    report = {"meta": environment_info(), "inputs": [i["name"] for i in inputs], "results": results}
+    print()
+    print_report(results)
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2))
+        print(f"\n✅ Results written to {args.out}")
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), report)
+
+
+if __name__ == "__main__":
+    main()
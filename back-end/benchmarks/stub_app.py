@@ -0,0 +1,9 @@
+"""
+ASGI entry point with stub pipelines, for load testing over uvicorn:
+
+    uvicorn benchmarks.stub_app:app --workers 4 --port 5002
+"""
+from benchmarks import stubs
+from app.main import app  # noqa: F401 - re-exported for uvicorn
+
+stubs.install()
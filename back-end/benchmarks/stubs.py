@@ -0,0 +1,92 @@
+"""
+Stub pipelines for load testing on hosts without ESRGAN weights, vtracer/potrace or CLIP weights.
+
+`install()` swaps the conversion router's pipeline runners (and the recommendation metadata
+extractor) for stand-ins that block for a modelled duration and write a small, valid output.
+Blocking with time.sleep mirrors the real pipelines, which wait on a child process. Durations
+scale with input megapixels and can be scaled globally with LOADTEST_STUB_SCALE.
+"""
+import os
+import shutil
+import time
+from pathlib import Path
+from shutil import which
+
+from PIL import Image
+
+# seconds = base + per_mp * megapixels (rough CPU figures from the pipeline benchmark)
+STUB_COSTS = {
+    "outline": (0.05, 0.15),
+    "vectorize": (0.2, 1.5),
+    "enhance": (1.0, 8.0),
+    "recommend": (0.1, 0.05),
+}
+STUB_SCALE = float(os.getenv("LOADTEST_STUB_SCALE", "1.0"))
+_SVG = '<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}"><rect width="{w}" height="{h}" fill="#888"/></svg>'
+
+
+def _sleep_for(mode: str, megapixels: float):
+    base, per_mp = STUB_COSTS[mode]
+    time.sleep((base + per_mp * megapixels) * STUB_SCALE)
+
+
+def _size(path) -> tuple:
+    with Image.open(path) as img:
+        return img.size
+
+
+def stub_pipeline(mode: str):
+    def run(input_path, output_dir, base_name, params, timer, **_):
+        w, h = _size(input_path)
+        with timer.stage("stub"):
+            _sleep_for(mode, w * h / 1e6)
+        if mode == "enhance":
+            out = Path(output_dir) / f"{base_name}_real_upscaled.png"
+            shutil.copyfile(input_path, out)
+            return out, "image/png"
+        out = Path(output_dir) / f"{base_name}_{mode}.svg"
+        out.write_text(_SVG.format(w=w, h=h))
+        return out, "image/svg+xml"
+
+    return run
+
+
+def stub_metadata(image_path, profile_dir=None):
+    w, h = _size(image_path)
+    _sleep_for("recommend", w * h / 1e6)
+    return {
+        "file_name": os.path.basename(image_path),
+        "resolution": f"{w}x{h}",
+        "width": w,
+        "height": h,
+        "aspect_ratio": round(w / h, 2),
+        "file_size_bytes": os.path.getsize(image_path),
+        "sharpness": 1000.0,
+        "color_count": 256,
+        "dominant_colors": [],
+        "noise_level": 1000.0,
+        "edge_complexity": int(w * h * 0.02),
+        "ai_image_type": "graphic",
+        "ai_confidence": 0.9,
+        "ai_raw_probs": {},
+    }
+
+
+def models_present() -> bool:
+    """True when the real pipelines can run on this host."""
+    weights = ["app/weights/RealESRGAN_x4plus.pth", "app/weights/RealESRGAN_x4plus_anime_6B.pth"]
+    clip_cache = Path.home() / ".cache" / "clip" / "ViT-B-32.pt"
+    return (
+        all(os.path.isfile(w) for w in weights)
+        and which("vtracer") is not None
+        and which("potrace") is not None
+        and clip_cache.exists()
+    )
+
+
+def install():
+    from app.features.conversion import router
+
+    for mode in ("outline", "vectorize", "enhance"):
+        router.PIPELINES[mode] = stub_pipeline(mode)
+    router.extract_image_metadata = stub_metadata
@@ -0,0 +1,120 @@
+"""
+Tracer backend comparison (app/features/conversion/tracers.py).
+
+Traces the bundled samples/ images plus synthetic images with every backend available on this
+host, for vectorize (the raster as uploaded, no upscaling) and outline (the Canny edge PBM, made
+once per input), and reports per backend the trace latency (p50/p90), total time and the SVG size
+before and after svg_optimize. Backends that are not installed are listed as skipped:
+
+    cd back-end
+    python -m benchmarks.tracers --modes vectorize,outline --resolutions 512,1024,2048 --out tracers.json
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+from app.features.conversion import outline, svg_optimize, tracers
+from benchmarks.pipelines import collect_inputs, environment_info, percentile
+
+MODES = ["vectorize", "outline"]
+
+
+def prepare(mode: str, inputs: List[dict], work_dir: Path) -> List[dict]:
+    """What the mode's tracer gets: the image itself, or its edge PBM."""
+    if mode == "vectorize":
+        return inputs
+    prepared = []
+    for i, item in enumerate(inputs):
+        pbm_path = work_dir / f"edges_{i}.pbm"
+        outline.save_as_pbm(outline.detect_edges(item["path"]), str(pbm_path))
+        prepared.append({"name": item["name"], "path": str(pbm_path)})
+    return prepared
+
+
+def run_backend(mode: str, name: str, inputs: List[dict], work_dir: Path, repeat: int) -> dict:
+    tracer = tracers.get(name)
+    latencies, raw_bytes, optimized_bytes, errors = [], 0, 0, 0
+    for i, item in enumerate(inputs):
+        svg_path = work_dir / f"{mode}_{name}_{i}.svg"
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                tracer.trace(item["path"], str(svg_path), {})
+            except Exception as e:
+                errors += 1
+                print(f"   ❌ {item['name']}: {e}")
+                break
+            latencies.append(time.perf_counter() - start)
+        else:
+            svg = svg_path.read_bytes()
+            raw_bytes += len(svg)
+            optimized_bytes += len(svg_optimize.optimize(svg)[0])
+    latencies.sort()
+    p50, p90 = percentile(latencies, 0.5), percentile(latencies, 0.9)
+    return {
+        "mode": mode,
+        "tracer": name,
+        "runs": len(latencies),
+        "errors": errors,
+        "total_s": round(sum(latencies), 3),
+        "p50_s": round(p50, 4) if p50 is not None else None,
+        "p90_s": round(p90, 4) if p90 is not None else None,
+        "svg_kb": round(raw_bytes / 1024, 1),
+        "optimized_kb": round(optimized_bytes / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tracer backends for speed and output size")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"Comma-separated subset of {MODES}")
+    parser.add_argument("--tracers", default=None, help="Comma-separated backends (default: all available)")
+    parser.add_argument("--resolutions", default="512,1024,2048",
+                        help="Synthetic image widths (height = 0.75 * width); empty for none")
+    parser.add_argument("--no_samples", action="store_true", help="Skip the bundled samples/ images")
+    parser.add_argument("--repeat", type=int, default=1, help="Traces per input and backend")
+    parser.add_argument("--out", default=None, help="Write JSON results here")
+    args = parser.parse_args()
+
+    selected = [t for t in (args.tracers or "").split(",") if t]
+    work_dir = Path(tempfile.mkdtemp(prefix="bench-tracers-"))
+    results, skipped = [], []
+    try:
+        inputs = collect_inputs([int(r) for r in args.resolutions.split(",") if r], work_dir,
+                                use_samples=not args.no_samples)
+        print(f"📦 {len(inputs)} inputs")
+        for mode in [m for m in args.modes.split(",") if m]:
+            mode_inputs = prepare(mode, inputs, work_dir)
+            for name in tracers.PREFERENCE[mode]:
+                if selected and name not in selected:
+                    continue
+                if not tracers.get(name).available():
+                    skipped.append(name)
+                    continue
+                print(f"⏱️  {mode}/{name} ...", flush=True)
+                results.append(run_backend(mode, name, mode_inputs, work_dir, args.repeat))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    header = f"{'mode':<10} {'tracer':<12} {'runs':>5} {'err':>4} {'total s':>8} {'p50':>8} {'p90':>8} {'svg KB':>9} {'opt KB':>9}"
+    print("\n" + header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['mode']:<10} {r['tracer']:<12} {r['runs']:>5} {r['errors']:>4} {r['total_s']:>8} "
+            f"{r['p50_s'] or '-':>8} {r['p90_s'] or '-':>8} {r['svg_kb']:>9} {r['optimized_kb']:>9}"
+        )
+    if skipped:
+        print(f"\n⏭️  Not available here: {', '.join(skipped)}")
+    if args.out:
+        report = {"meta": environment_info(), "inputs": [i["name"] for i in inputs], "results": results,
+                  "skipped": skipped}
+        Path(args.out).write_text(json.dumps(report, indent=2))
+        print(f"\n✅ Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
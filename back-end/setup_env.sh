@@ -57,10 +57,12 @@ pip install --upgrade pip
 pip install torch==1.13.1 torchvision==0.14.1 torchaudio==0.13.1 --extra-index-url https://download.pytorch.org/whl/cu117
 
 pip install basicsr==1.4.2 realesrgan opencv-python-headless "numpy>=1.24,<1.27" scikit-image==0.21.0 "scipy>=1.10,<1.11"
-pip install fastapi==0.100.0 "uvicorn>=0.30,<0.31" python-multipart==0.0.20 pydantic==1.10.13 loguru==0.7.3
-pip install cairosvg cairocffi pillow tqdm
+pip install fastapi==0.100.0 "uvicorn>=0.30,<0.31" python-multipart==0.0.20 pydantic==1.10.13 loguru==0.7.3 prometheus-client httpx brotli
+pip install cairosvg cairocffi pillow tqdm pyinstrument
 pip install git+https://github.com/openai/CLIP.git
 pip install "sqlalchemy>=2.0" psycopg2-binary
+# in-process vtracer (tracers.py prefers it to the CLI below)
+pip install vtracer
 
 # Rust/Cargo + vtracer
 echo "Setting up VTracer (Rust)..."
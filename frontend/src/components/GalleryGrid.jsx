@@ -6,10 +6,8 @@ export default function GalleryGrid({ items, apiBase, onOpen, onDelete }) {
   return (
     <div className="gallery-grid">
       {items.map((item) => {
-        const mode = (item?.mode || '').toLowerCase();
-        const useOutput = mode === 'vectorize' || mode === 'outline';
         const thumbUrl = item
-          ? `${apiBase}/conversion/${useOutput ? 'output' : 'thumb'}/${item.id}`
+          ? `${apiBase}/conversion/thumb/${item.id}?size=256`
           : "/logo.svg";
         const badge = item.mode ? item.mode.toUpperCase() : "OUTPUT";
         const mime = item.output_mime || "";
@@ -1,4 +1,4 @@
-import { useEffect, useRef } from 'react';
+import { useEffect, useRef, useState } from 'react';
 import { getDefaultSettings, updateConvertCache } from '../state/convertCache';
 
 const API_BASE =
@@ -22,6 +22,36 @@ export default function SettingsPanel({
 }) {
   const mountedRef = useRef(true);
   useEffect(() => () => { mountedRef.current = false; }, []);
+  const jobIdRef = useRef(null);
+  const [progress, setProgress] = useState('');
+
+  const newJobId = () =>
+    (window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`)
+      .replace(/[^A-Za-z0-9_-]/g, '');
+
+  // Server-Sent Events from /conversion/jobs/{id}/events while the convert request runs
+  const watchJob = (jobId) => {
+    const events = new EventSource(`${API_BASE}/conversion/jobs/${jobId}/events`);
+    events.addEventListener('stage', (e) => {
+      const { stage, phase } = JSON.parse(e.data);
+      if (phase === 'start' && mountedRef.current) setProgress(`${stage}…`);
+    });
+    events.addEventListener('progress', (e) => {
+      const { stage, done, total } = JSON.parse(e.data);
+      if (mountedRef.current) setProgress(`${stage} ${done}/${total}`);
+    });
+    events.addEventListener('done', () => events.close());
+    return events;
+  };
+
+  const cancelConvert = async () => {
+    if (!jobIdRef.current) return;
+    try {
+      await fetch(`${API_BASE}/conversion/jobs/${jobIdRef.current}/cancel`, { method: 'POST', mode: 'cors' });
+    } catch (error) {
+      console.error('Cancel failed:', error);
+    }
+  };
 
   const set = (k, v) => setSettings({ ...settings, [k]: v });
   const resetSettings = () => {
@@ -53,6 +83,9 @@ export default function SettingsPanel({
       return;
     }
 
+    const jobId = newJobId();
+    jobIdRef.current = jobId;
+    const events = watchJob(jobId);
     try {
       if (mountedRef.current) setLoading(true);
       updateConvertCache({ isConverting: true, vectorSrc: '' });
@@ -61,6 +94,7 @@ export default function SettingsPanel({
       const fd = new FormData();
       fd.append("file", file);
       fd.append("outputType", settings.outputType);
+      fd.append("job_id", jobId);
 
       // vectorize mode params
       if (settings.outputType === "vectorize") {
@@ -92,6 +126,10 @@ export default function SettingsPanel({
         }
       });
 
+      if (response.status === 409) {
+        notify?.('Conversion cancelled', 'info');
+        return;
+      }
       if (!response.ok) {
         const errText = await response.text();
         throw new Error(`Server error: ${response.status} - ${errText}`);
@@ -117,7 +155,12 @@ export default function SettingsPanel({
       console.error('Conversion failed:', error);
       notify?.('Conversion failed. Check console for details.', 'error');
     } finally {
-      if (mountedRef.current) setLoading(false);
+      events.close();
+      jobIdRef.current = null;
+      if (mountedRef.current) {
+        setLoading(false);
+        setProgress('');
+      }
       updateConvertCache({ isConverting: false });
     }
   };
@@ -354,13 +397,22 @@ export default function SettingsPanel({
         >
           <span className={`convert-status ${loading ? "loading" : recommending ? "recommending" : "idle"}`}>
             {loading
-              ? "Converting…"
+              ? (progress ? `Converting… ${progress}` : "Converting…")
               : recommending
               ? "Getting recommendation…"
               : "Convert"}
           </span>
         </button>
-        {settings.outputType !== 'enhance' && (
+        {loading && (
+          <button
+            className="btn btn-secondary"
+            style={{ minWidth: 100 }}
+            onClick={cancelConvert}
+          >
+            Cancel
+          </button>
+        )}
+        {settings.outputType !== 'enhance' && !loading && (
           <button
             className="btn btn-secondary"
             style={{ minWidth: 140 }}